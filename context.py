@@ -1,6 +1,6 @@
 import argparse
 import sys
-from dataloaders.dataloader import DataLoader, create_batches, view_batch, make_bucket_batches
+from dataloaders.dataloader import DataLoader, create_batches, view_batch, bucket_batch_data, build_batches, close_batch_pools
 from dataloaders.squad_dataloader import SquadDataloader
 from models.context_model import ContextMRR
 from models.context_model_sep import ContextMRR_Sep
@@ -9,6 +9,9 @@ from dataloaders.utility import get_pretrained_emb
 import torch
 from torch import optim
 from dataloaders.utility import variable, view_data_point
+from dataloaders.embedding_store import to_tensor, ChunkGatherer
+from dataloaders.test_metrics import rouge_l_batch, cleaned_words
+from dataloaders.batching import length_mask, pad_embeddings, context_length_function, padding_efficiency, token_budget_batch_data
 import numpy as np
 from time import time
 import random
@@ -30,6 +33,32 @@ class Query_Embed(object):
         self.answer_indices = answer_indices
         self.query_embed = query_embed
 
+def embedding_store_path(name):
+	if args.embedding_store is None:
+		return None
+	return args.embedding_store + name
+
+chunk_gatherers = {}
+def get_chunk_gatherer(context_per_docid):
+	## one gatherer per split, so its cache survives repeated evaluations
+	key = id(context_per_docid)
+	if key not in chunk_gatherers:
+		chunk_gatherers[key] = ChunkGatherer(context_per_docid, args.gather_cache_size)
+	return chunk_gatherers[key]
+
+def encode_document(model, document_encodings, doc_id, batch_context, batch_context_length,
+					batch_candidates_embed_sorted, batch_candidate_lengths_sorted):
+	## the candidate encoding (and the context encoding, unless the context is reduced per question) is shared
+	## by all questions of a document
+	if doc_id not in document_encodings:
+		if args.reduced:
+			context_encoding = None
+		else:
+			context_encoding = model.encode_context(batch_context, batch_context_length)
+		candidates_encoding = model.encode_candidates(batch_candidates_embed_sorted, batch_candidate_lengths_sorted)
+		document_encodings[doc_id] = (context_encoding, candidates_encoding)
+	return document_encodings[doc_id]
+
 def get_random_batch_from_training(batches, num):
 	small = []
 	for i in range(num):
@@ -38,9 +67,109 @@ def get_random_batch_from_training(batches, num):
 	return small
 
 
+def make_batch_tensors(batch, candidates_embed_docid, context_per_docid, gather_context, volatile=False):
+	## padded inputs of ContextMRR*.forward_batch: contexts and candidate pools are included once per document
+	batch_doc_ids = batch['doc_ids']
+	batch_size = len(batch_doc_ids)
+
+	# queries (N, J, d)
+	query_lengths = np.array(batch['qlengths'])
+	queries = pad_embeddings(batch['q_embed'])
+	query_mask = length_mask(query_lengths, dtype=np.float32)
+
+	# distinct documents in order of appearance
+	documents = []
+	document_position = {}
+	for doc_id in batch_doc_ids:
+		if doc_id not in document_position:
+			document_position[doc_id] = len(documents)
+			documents.append(doc_id)
+
+	# contexts (M, T, d): one per document, or one per question with --reduced
+	if args.reduced:
+		contexts = [gather_context.gather(doc_id, batch['chunk_indices'][index]) for index, doc_id in enumerate(batch_doc_ids)]
+		context_index = np.arange(batch_size)
+	else:
+		contexts = [context_per_docid[doc_id] for doc_id in documents]
+		context_index = np.array([document_position[doc_id] for doc_id in batch_doc_ids])
+	context_lengths = np.array([len(context) for context in contexts])
+	batch_context = pad_embeddings(contexts)
+	context_mask = length_mask(context_lengths, dtype=np.float32)
+
+	# candidate pools (P, K, d) and the (question, candidate) pairs pointing into them
+	pool_lengths = []
+	for doc_id in documents:
+		pool_lengths.append(np.array(batch['candidates']['anslengths'][batch_doc_ids.index(doc_id)]))
+	pool_offsets = np.cumsum([0] + [len(lengths) for lengths in pool_lengths])
+	candidate_lengths = np.concatenate(pool_lengths)
+	batch_candidates = np.zeros((len(candidate_lengths), candidate_lengths.max(), args.embed_size), dtype=np.float32)
+	for position, doc_id in enumerate(documents):
+		pool = candidates_embed_docid[doc_id]
+		batch_candidates[pool_offsets[position]:pool_offsets[position + 1], :pool.shape[1]] = pool
+	candidate_mask = length_mask(candidate_lengths, batch_candidates.shape[1], dtype=np.float32)
+
+	pair_candidate_index = []
+	pair_question_index = []
+	pair_position = []
+	for index, doc_id in enumerate(batch_doc_ids):
+		position = document_position[doc_id]
+		num_pool = pool_offsets[position + 1] - pool_offsets[position]
+		pair_candidate_index.append(np.arange(pool_offsets[position], pool_offsets[position + 1]))
+		pair_question_index.append(np.repeat(index, num_pool))
+		pair_position.append(np.arange(num_pool))
+	num_candidates = max(len(lengths) for lengths in pool_lengths)
+
+	long_variable = lambda array: variable(torch.from_numpy(np.asarray(array, dtype=np.int64)), volatile=volatile)
+	float_variable = lambda array: variable(torch.from_numpy(array), volatile=volatile)
+	inputs = (float_variable(queries), query_lengths, float_variable(query_mask),
+			  float_variable(batch_context), context_lengths, float_variable(context_mask), long_variable(context_index),
+			  float_variable(batch_candidates), candidate_lengths, float_variable(candidate_mask),
+			  long_variable(np.concatenate(pair_candidate_index)), long_variable(np.concatenate(pair_question_index)),
+			  long_variable(np.concatenate(pair_position)), num_candidates)
+	return inputs, long_variable(batch['answer_indices'])
+
+
+def evaluate_batched(model, batches, candidates_embed_docid, context_per_docid, candidates_per_docid, fout=None):
+	mrr_value = []
+	top_predictions = []
+	gold_answers = []
+	model.train(False)
+	gather_context = get_chunk_gatherer(context_per_docid)
+	for iteration in range(len(batches)):
+
+		batch = batches[iteration]
+		inputs, _ = make_batch_tensors(batch, candidates_embed_docid, context_per_docid, gather_context, volatile=True)
+		indices = model.eval_batch(*inputs).data.cpu().numpy()
+
+		for index, doc_id in enumerate(batch['doc_ids']):
+			fout.write("\nQ: {0}".format(" ".join(loader.vocab.decode(batch['q_tokens'][index]))))
+			position_gold_sorted = np.nonzero(indices[index] == batch['answer_indices'][index])[0][0]
+			rank = position_gold_sorted + 1
+			mrr_value.append(1.0 / rank)
+
+			candidates = candidates_per_docid[doc_id]
+			top_predictions.append(cleaned_words(candidates[indices[index][0]]))
+			gold_answers.append([cleaned_words(candidates[batch['answer_indices'][index]])])
+			fout.write("\nRank: {0} / {1}   Gold: {2}\n".format(rank, len(candidates)," ".join(candidates[indices[index][position_gold_sorted]])))
+			for cand in range(min(10, len(candidates))):
+				fout.write("C: {0}\n".format(" ".join(candidates[indices[index][cand]])))
+
+	mean_rr = np.mean(mrr_value)
+	print("MRR :{0}".format(mean_rr))
+	## ROUGE-L of the top ranked candidate against the gold answer, both cleaned as in Performance.computeMetrics
+	print("ROUGE-L :{0}".format(np.mean(rouge_l_batch(top_predictions, gold_answers))))
+	model.train(True)
+	return mean_rr
+
 def evaluate(model, batches,  candidates_embed_docid, context_per_docid, candidates_per_docid, fout=None):
+	if args.batched:
+		return evaluate_batched(model, batches, candidates_embed_docid, context_per_docid, candidates_per_docid, fout)
 	mrr_value = []
+	top_predictions = []
+	gold_answers = []
 	model.train(False)
+	gather_context = get_chunk_gatherer(context_per_docid)
+	document_encodings = {}
 	for iteration in range(len(batches)):
 
 		batch = batches[iteration]
@@ -51,11 +180,11 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, candida
 		batch_reduced_context_indices = batch['chunk_indices']
 		for index, query_embed in enumerate(batch['q_embed']):
 
-			fout.write("\nQ: {0}".format(" ".join(batch_q_tokens[index])))
+			fout.write("\nQ: {0}".format(" ".join(loader.vocab.decode(batch_q_tokens[index]))))
 			# query tokens
 			batch_query = variable(torch.FloatTensor(query_embed), volatile=True)
 			batch_query_length = np.array([batch['qlengths'][index]])
-			batch_question_mask = variable(torch.FloatTensor(np.array([1 for x in range(batch_query_length)])))
+			batch_question_mask = variable(torch.ones(int(batch_query_length[0])))
 
 
 
@@ -65,8 +194,11 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, candida
 			candidate_sort = np.argsort(batch_candidate_lengths)[::-1].copy()
 
 			doc_id = batch_doc_ids[index]
+			if doc_id not in document_encodings:
+				## evaluation batches are grouped by document, so only the current document is kept
+				document_encodings.clear()
 			batch_candidates_embed_sorted = variable(
-				torch.FloatTensor(candidates_embed_docid[doc_id][candidate_sort, ...]))
+				to_tensor(candidates_embed_docid[doc_id][candidate_sort, ...]))
 			batch_candidate_lengths_sorted = batch_candidate_lengths[candidate_sort]
 			batch_candidate_masks_sorted = variable(torch.FloatTensor(batch_candidate_mask[candidate_sort]))
 
@@ -74,24 +206,23 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, candida
 			# context tokens
 			## if using reduced context
 			if args.reduced:
-				context_embeddings =  context_per_docid[doc_id]
-				reduced_context_embeddings = []
-				ranges = batch_reduced_context_indices[index]
-				for r in ranges:
-				   reduced_context_embeddings += context_embeddings[r[0]:r[1]].tolist()
-				batch_context = variable(torch.FloatTensor(reduced_context_embeddings))
+				batch_context = variable(gather_context(doc_id, batch_reduced_context_indices[index]))
 			else:
-				batch_context = variable(torch.FloatTensor(context_per_docid[doc_id]))
+				batch_context = variable(to_tensor(context_per_docid[doc_id]))
 
 			batch_context_length = np.array([batch_context.size(0)])
-			batch_context_mask = variable(torch.FloatTensor(np.array([1 for x in range(batch_context_length[0])])))
+			batch_context_mask = variable(torch.ones(int(batch_context_length[0])))
 
 			batch_len = len(batch_candidate_lengths_sorted)
 			batch_candidate_unsort = variable(torch.LongTensor(np.argsort(candidate_sort)), volatile=True)
 
+			context_encoding, candidates_encoding = encode_document(model, document_encodings, doc_id,
+																	batch_context, batch_context_length,
+																	batch_candidates_embed_sorted, batch_candidate_lengths_sorted)
 			indices = model.eval(batch_query, batch_query_length,batch_question_mask,
 								 batch_context, batch_context_length,batch_context_mask,
-								 batch_candidates_embed_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,batch_candidate_unsort)
+								 batch_candidates_embed_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,batch_candidate_unsort,
+								 context_encoding=context_encoding, candidates_encoding=candidates_encoding)
 
 			if args.use_cuda:
 				indices = indices.data.cpu()
@@ -106,12 +237,16 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, candida
 			mrr_value.append(1.0 / (index))
 
 			candidates = candidates_per_docid[doc_id]
+			top_predictions.append(cleaned_words(candidates[indices[0].numpy()[0]]))
+			gold_answers.append([cleaned_words(candidates[gold_index])])
 			fout.write("\nRank: {0} / {1}   Gold: {2}\n".format(index, len(candidates)," ".join(candidates[indices[position_gold_sorted].numpy()[0]])))
 			for cand in range(10):
 				fout.write("C: {0}\n".format(" ".join(candidates[indices[cand].numpy()[0]])))
 
 	mean_rr = np.mean(mrr_value)
 	print("MRR :{0}".format(mean_rr))
+	## ROUGE-L of the top ranked candidate against the gold answer, both cleaned as in Performance.computeMetrics
+	print("ROUGE-L :{0}".format(np.mean(rouge_l_batch(top_predictions, gold_answers))))
 	model.train(True)
 	return mean_rr
 
@@ -123,6 +258,7 @@ def train_epochs(model, vocab):
 	eval_interval = args.eval_interval
 
 	optimizer = optim.Adam(model.parameters(), lr=args.learning_rate)
+	train_gather_context = get_chunk_gatherer(train_context_per_docid)
 	train_loss = 0
 	train_denom = 0
 	validation_history = []
@@ -131,19 +267,26 @@ def train_epochs(model, vocab):
 
 	patience = 30
 
-	valid_batches = create_batches(valid_documents, args.batch_length,args.job_size, vocab)
-	test_batches = create_batches(test_documents,args.batch_length,args.job_size, vocab)
+	valid_batches = create_batches(valid_documents, args.batch_length,args.job_size, vocab, group_by_document=True)
+	test_batches = create_batches(test_documents,args.batch_length,args.job_size, vocab, group_by_document=True)
 
+	train_context_length = context_length_function(train_context_per_docid, args.reduced)
 	mrr_value = []
 	for epoch in range(args.num_epochs):
 
 		print("Creating train batches")
-		train_batches = make_bucket_batches(train_documents, args.batch_length, vocab)
+		if args.token_budget > 0:
+			train_batch_data = token_budget_batch_data(train_documents, args.token_budget, train_context_length)
+		else:
+			train_batch_data = bucket_batch_data(train_documents, args.batch_length, group_by_document=args.group_by_document)
+		print("Padding efficiency: {0:.3f}".format(padding_efficiency(train_batch_data, train_context_length)))
+		## batches are built by a background thread while the previous ones train
+		train_batches = build_batches(train_batch_data, args.prefetch)
 		print("Starting epoch {}".format(epoch))
 		fout.write("==========Epoch {0}=========\n".format(epoch))
 
 		saved = False
-		for iteration in range(len(train_batches)):
+		for iteration, batch in enumerate(train_batches):
 			optimizer.zero_grad()
 			if (iteration + 1) % eval_interval == 0:
 				print("iteration: {0} train loss: {1}".format(iteration + 1, train_loss / train_denom))
@@ -171,7 +314,6 @@ def train_epochs(model, vocab):
 							evaluate(model, test_batches, test_candidates_embed_docid, test_context_per_docid, test_candidate_per_docid, None)
 							exit(0)
 
-			batch = train_batches[iteration]
 			# view_batch(batch,loader.vocab)
 			batch_query_lengths = batch['qlengths']
 			batch_candidates = batch["candidates"]
@@ -179,66 +321,74 @@ def train_epochs(model, vocab):
 			batch_reduced_context_indices = batch['chunk_indices']
 			batch_answer_indices = batch['answer_indices']
 			batch_size = len(batch_query_lengths)
-			losses = variable(torch.zeros(batch_size))
-			for index, query_embed in enumerate(batch['q_embed']):
-				# query tokens
-				batch_query = variable(torch.FloatTensor(query_embed))
-				batch_query_length = np.array([batch['qlengths'][index]])
-				batch_question_mask = variable(torch.FloatTensor(np.array([1 for x in range(batch_query_length)])))
-
-				# Sort the candidates by length (only required if using an RNN)
-				batch_candidate_lengths = np.array(batch_candidates["anslengths"][index])
-				batch_candidate_mask = np.array(batch_candidates['mask'][index])
-				candidate_sort = np.argsort(batch_candidate_lengths)[::-1].copy()
-
-				# get candidates_embed from doc_id
-				doc_id = batch_doc_ids[index]
-				batch_candidates_embed_sorted = variable(
-					torch.FloatTensor(train_candidates_embed_docid[doc_id][candidate_sort, ...]))
-
-				batch_candidate_lengths_sorted = batch_candidate_lengths[candidate_sort]
-				batch_candidate_unsort = variable(torch.LongTensor(np.argsort(candidate_sort)))
-				batch_candidate_masks_sorted = variable(torch.FloatTensor(batch_candidate_mask[candidate_sort]))
-
-				batch_len = len(batch_candidate_lengths)
-
-				# context tokens
-				## if using reduced context
-				if args.reduced:
-					context_embeddings =  train_context_per_docid[doc_id]
-					reduced_context_embeddings = []
-					ranges = batch_reduced_context_indices[index]
-					for r in ranges:
-						reduced_context_embeddings += context_embeddings[r[0]:r[1]].tolist()
-					batch_context = variable(torch.FloatTensor(reduced_context_embeddings))
-				else:
-					batch_context = variable(torch.FloatTensor(train_context_per_docid[doc_id]))
-
-				batch_context_length = np.array([batch_context.size(0)])
-				batch_context_mask =variable(torch.FloatTensor(np.array([1 for x in range(batch_context_length[0])])))
-
-				gold_index = variable(torch.LongTensor([batch_answer_indices[index]]))
-				negative_indices = [idx for idx in range(batch_len)]
-				negative_indices.pop(batch_answer_indices[index])
-				negative_indices = variable(torch.LongTensor(negative_indices))
-
-
-
-				loss, indices = model(batch_query, batch_query_length,batch_question_mask,
-									batch_context, batch_context_length, batch_context_mask,
-									  batch_candidates_embed_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,
-										  batch_candidate_unsort,
-									gold_index, negative_indices
-									)
-
-				losses[index] = loss
-				mrr_value.append(train_mrr(index, indices, batch_answer_indices))
-
-			# loss.backward()
-			# torch.nn.utils.clip_grad_norm(model.parameters(), clip_threshold)
-			# optimizer.step()
-
-			mean_loss = losses.mean(0)
+			if args.batched:
+				## one padded forward pass for all questions of the batch
+				inputs, gold_index = make_batch_tensors(batch, train_candidates_embed_docid, train_context_per_docid, train_gather_context)
+				mean_loss, indices = model.forward_batch(*inputs, gold_index=gold_index)
+				for index in range(batch_size):
+					mrr_value.append(train_mrr(index, indices[index], batch_answer_indices))
+			else:
+				losses = variable(torch.zeros(batch_size))
+				## questions of the same document share one encoding, gradients of all their losses flow through it
+				document_encodings = {}
+				for index, query_embed in enumerate(batch['q_embed']):
+					# query tokens
+					batch_query = variable(torch.FloatTensor(query_embed))
+					batch_query_length = np.array([batch['qlengths'][index]])
+					batch_question_mask = variable(torch.ones(int(batch_query_length[0])))
+
+					# Sort the candidates by length (only required if using an RNN)
+					batch_candidate_lengths = np.array(batch_candidates["anslengths"][index])
+					batch_candidate_mask = np.array(batch_candidates['mask'][index])
+					candidate_sort = np.argsort(batch_candidate_lengths)[::-1].copy()
+
+					# get candidates_embed from doc_id
+					doc_id = batch_doc_ids[index]
+					batch_candidates_embed_sorted = variable(
+						to_tensor(train_candidates_embed_docid[doc_id][candidate_sort, ...]))
+
+					batch_candidate_lengths_sorted = batch_candidate_lengths[candidate_sort]
+					batch_candidate_unsort = variable(torch.LongTensor(np.argsort(candidate_sort)))
+					batch_candidate_masks_sorted = variable(torch.FloatTensor(batch_candidate_mask[candidate_sort]))
+
+					batch_len = len(batch_candidate_lengths)
+
+					# context tokens
+					## if using reduced context
+					if args.reduced:
+						batch_context = variable(train_gather_context(doc_id, batch_reduced_context_indices[index]))
+					else:
+						batch_context = variable(to_tensor(train_context_per_docid[doc_id]))
+
+					batch_context_length = np.array([batch_context.size(0)])
+					batch_context_mask =variable(torch.ones(int(batch_context_length[0])))
+
+					gold_index = variable(torch.LongTensor([batch_answer_indices[index]]))
+					negative_indices = [idx for idx in range(batch_len)]
+					negative_indices.pop(batch_answer_indices[index])
+					negative_indices = variable(torch.LongTensor(negative_indices))
+
+
+
+					context_encoding, candidates_encoding = encode_document(model, document_encodings, doc_id,
+																			batch_context, batch_context_length,
+																			batch_candidates_embed_sorted, batch_candidate_lengths_sorted)
+					loss, indices = model(batch_query, batch_query_length,batch_question_mask,
+										batch_context, batch_context_length, batch_context_mask,
+										  batch_candidates_embed_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,
+											  batch_candidate_unsort,
+										gold_index, negative_indices,
+										context_encoding=context_encoding, candidates_encoding=candidates_encoding
+										)
+
+					losses[index] = loss
+					mrr_value.append(train_mrr(index, indices, batch_answer_indices))
+
+				# loss.backward()
+				# torch.nn.utils.clip_grad_norm(model.parameters(), clip_threshold)
+				# optimizer.step()
+
+				mean_loss = losses.mean(0)
 			mean_loss.backward()
 			torch.nn.utils.clip_grad_norm(model.parameters(), clip_threshold)
 			optimizer.step()
@@ -258,6 +408,7 @@ def train_epochs(model, vocab):
 	print("All epochs done")
 	model = torch.load(args.model_path)
 	evaluate(model, test_batches, test_candidates_embed_docid, test_context_per_docid )
+	close_batch_pools()
 
 def train_mrr(index, indices, batch_answer_indices):
 	if args.use_cuda:
@@ -269,7 +420,7 @@ def train_mrr(index, indices, batch_answer_indices):
 	return (1.0 / (index))
 
 def test_model(model, documents,vocab):
-    test_batches = create_batches(documents,args.batch_length,args.job_size, vocab)
+    test_batches = create_batches(documents,args.batch_length,args.job_size, vocab, group_by_document=True)
     print("Testing!")
     evaluate(model, test_batches)
 
@@ -286,6 +437,7 @@ if __name__ == "__main__":
 	parser.add_argument("--pickle_folder", type=str, default=None)
 	parser.add_argument("--job_size", type=int, default=5)
 	parser.add_argument("--pretrain_path", type=str, default=None, help="Path to the pre-trained word embeddings")
+	parser.add_argument("--pretrain_cache", type=str, default=None, help="Path prefix of the binary cache of --pretrain_path (.data and .index), next to it by default")
 	parser.add_argument("--max_documents", type=int, default=0, help="If greater than 0, load at most this many documents")
 	parser.add_argument("--debug_file", type=str, default=None)
 
@@ -309,6 +461,14 @@ if __name__ == "__main__":
 	parser.add_argument("--profile", action="store_true")
 	parser.add_argument("--squad", action="store_true")
 	parser.add_argument("--reduced", action="store_true")
+	parser.add_argument("--embedding_store", type=str, default=None, help="Folder of memory-mapped ELMo embedding stores, created on first use and rebuilt when a split pickle changes")
+	parser.add_argument("--batched", action="store_true", help="Run all questions of a batch through one padded forward pass")
+	parser.add_argument("--group_by_document", action="store_true", help="Fill training batches with questions of one document so they share its encoding")
+	parser.add_argument("--gather_cache_size", type=int, default=512, help="Number of reduced context index arrays cached per split")
+	parser.add_argument("--embedding_dtype", type=str, default="float16", help="float16 or float32")
+	parser.add_argument("--prefetch", type=int, default=4, help="Number of training batches built ahead in the background, 0 builds all of them up front")
+	parser.add_argument("--token_budget", type=int, default=0, help="If greater than 0, fill training batches up to this many padded context x candidate cells instead of bucketing by question length")
+	parser.add_argument("--tfidf_index", type=str, default=None, help="Corpus level tfidf vocabulary and idf used to select the reduced context, fitted on the training documents if the file does not exist")
 
 	args = parser.parse_args()
 
@@ -328,31 +488,27 @@ if __name__ == "__main__":
 		valid_documents = loader.load_documents_with_candidates(args.valid_path)
 		test_documents = loader.load_documents_with_candidates(args.valid_path)
 	elif args.elmo:
+		## every split is read one at a time, and not at all when its embedding store is valid
 		loader = DataLoader(args)
-		with open(args.train_path, "r") as fin:
-			t_documents = pickle.load(fin)
-		with open(args.valid_path, "r") as fin:
-			v_documents = pickle.load(fin)
-		with open(args.test_path, "r") as fin:
-			te_documents = pickle.load(fin)
-
-		train_documents, train_candidates_embed_docid,train_candidate_per_docid,train_context_per_docid,_,_ = loader.load_documents_elmo(t_documents,split=False)
-		valid_documents,valid_candidates_embed_docid,valid_candidate_per_docid,valid_context_per_docid,_,_ = loader.load_documents_elmo(v_documents,split=False)
-		test_documents, test_candidates_embed_docid,test_candidate_per_docid,test_context_per_docid,_,_ = loader.load_documents_elmo(te_documents,split=False)
+		train_documents, train_candidates_embed_docid,train_candidate_per_docid,train_context_per_docid,_,_ = loader.load_elmo_split(args.train_path,split=False,
+			embedding_store=embedding_store_path("train_document"), dtype=args.embedding_dtype)
+		valid_documents,valid_candidates_embed_docid,valid_candidate_per_docid,valid_context_per_docid,_,_ = loader.load_elmo_split(args.valid_path,split=False,
+			embedding_store=embedding_store_path("valid_document"), dtype=args.embedding_dtype)
+		test_documents, test_candidates_embed_docid,test_candidate_per_docid,test_context_per_docid,_,_ = loader.load_elmo_split(args.test_path,split=False,
+			embedding_store=embedding_store_path("test_document"), dtype=args.embedding_dtype)
 	elif args.reduced:
 		loader = DataLoader(args)
-		with open(args.train_path, "r") as fin:
-			t_documents = pickle.load(fin)
-		with open(args.valid_path, "r") as fin:
-			v_documents = pickle.load(fin)
-		with open(args.test_path, "r") as fin:
-			te_documents = pickle.load(fin)
+		if args.tfidf_index is not None:
+			loader.load_tfidf_index(args.tfidf_index, args.train_path)
 		print("Loading training documents")
-		train_documents, train_candidates_embed_docid, train_context_per_docid = loader.load_documents_split_sentences(t_documents)
+		train_documents, train_candidates_embed_docid, train_context_per_docid = loader.load_reduced_split(args.train_path,
+			embedding_store=embedding_store_path("train_reduced"), dtype=args.embedding_dtype)
 		print("Loading validation documents")
-		valid_documents, valid_candidates_embed_docid, valid_context_per_docid = loader.load_documents_split_sentences(v_documents)
+		valid_documents, valid_candidates_embed_docid, valid_context_per_docid = loader.load_reduced_split(args.valid_path,
+			embedding_store=embedding_store_path("valid_reduced"), dtype=args.embedding_dtype)
 		print("Loading testing documents")
-		test_documents, test_candidates_embed_docid, test_context_per_docid = loader.load_documents_split_sentences(te_documents)
+		test_documents, test_candidates_embed_docid, test_context_per_docid = loader.load_reduced_split(args.test_path,
+			embedding_store=embedding_store_path("test_reduced"), dtype=args.embedding_dtype)
 		with open(args.pickle_folder + "train_reduced_summaries.pickle", "wb") as fout:
 			pickle.dump(train_documents, fout)
 		with open(args.pickle_folder + "valid_reduced_summaries.pickle", "wb") as fout:
@@ -371,7 +527,7 @@ if __name__ == "__main__":
 
 	# Get pre_trained embeddings
 	if args.pretrain_path is not None:
-		word_embedding = get_pretrained_emb(args.pretrain_path, loader.vocab.vocabulary, args.embed_size)
+		word_embedding = get_pretrained_emb(args.pretrain_path, loader.vocab.vocabulary, args.embed_size, cache_path=args.pretrain_cache)
 		loader.pretrain_embedding = word_embedding
 
 	#model = ContextMRR_Sep(args, loader)
@@ -1,12 +1,14 @@
 import argparse
 import sys
-from dataloaders.dataloader import DataLoader, create_batches, view_batch, make_bucket_batches
+from dataloaders.dataloader import DataLoader, create_batches, view_batch, bucket_batch_data, build_batches, close_batch_pools
 from dataloaders.squad_dataloader import SquadDataloader
 from models.context_model_sentence_level import ContextMRR_Sentence_Level
 from dataloaders.utility import get_pretrained_emb
 import torch
 from torch import optim
 from dataloaders.utility import variable, view_data_point
+from dataloaders.embedding_store import to_tensor, ChunkGatherer
+from dataloaders.batching import context_length_function, padding_efficiency, token_budget_batch_data
 import numpy as np
 from time import time
 import random
@@ -27,6 +29,19 @@ class Query_Embed(object):
         self.answer_indices = answer_indices
         self.query_embed = query_embed
 
+def embedding_store_path(name):
+	if args.embedding_store is None:
+		return None
+	return args.embedding_store + name
+
+chunk_gatherers = {}
+def get_chunk_gatherer(context_per_docid):
+	## one gatherer per split, so its cache survives repeated evaluations
+	key = id(context_per_docid)
+	if key not in chunk_gatherers:
+		chunk_gatherers[key] = ChunkGatherer(context_per_docid, args.gather_cache_size)
+	return chunk_gatherers[key]
+
 def get_random_batch_from_training(batches, num):
 	small = []
 	for i in range(num):
@@ -38,6 +53,7 @@ def get_random_batch_from_training(batches, num):
 def evaluate(model, batches,  candidates_embed_docid, context_per_docid, sentence_mask_doc_id, sentence_lengths_doc):
 	mrr_value = []
 	model.train(False)
+	gather_context = get_chunk_gatherer(context_per_docid)
 	for iteration in range(len(batches)):
 
 		batch = batches[iteration]
@@ -50,7 +66,7 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, sentenc
 			# query tokens
 			batch_query = variable(torch.FloatTensor(query_embed), volatile=True)
 			batch_query_length = np.array([batch['qlengths'][index]])
-			batch_question_mask = variable(torch.FloatTensor(np.array([1 for x in range(batch_query_length)])))
+			batch_question_mask = variable(torch.ones(int(batch_query_length[0])))
 
 
 
@@ -61,7 +77,7 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, sentenc
 
 			doc_id = batch_doc_ids[index]
 			batch_candidates_embed_sorted = variable(
-				torch.FloatTensor(candidates_embed_docid[doc_id][candidate_sort, ...]))
+				to_tensor(candidates_embed_docid[doc_id][candidate_sort, ...]))
 			batch_candidate_lengths_sorted = batch_candidate_lengths[candidate_sort]
 			batch_candidate_masks_sorted = variable(torch.FloatTensor(batch_candidate_mask[candidate_sort]))
 
@@ -69,17 +85,12 @@ def evaluate(model, batches,  candidates_embed_docid, context_per_docid, sentenc
 			# context tokens
 			## if using reduced context
 			if args.reduced:
-				context_embeddings =  context_per_docid[doc_id]
-				reduced_context_embeddings = []
-				ranges = batch_reduced_context_indices[index]
-				for r in ranges:
-				   reduced_context_embeddings += context_embeddings[r[0]:r[1]].tolist()
-				batch_context = variable(torch.FloatTensor(reduced_context_embeddings))
+				batch_context = variable(gather_context(doc_id, batch_reduced_context_indices[index]))
 			else:
 				sentence_context_lengths = sentence_lengths_doc[doc_id]
 				context_sentence_sort = np.argsort(sentence_context_lengths)[::-1].copy()
 				batch_context_embed_sorted = variable(
-					torch.FloatTensor(context_per_docid[doc_id][context_sentence_sort, ...]))
+					to_tensor(context_per_docid[doc_id][context_sentence_sort, ...]))
 				batch_context_lengths_sorted = sentence_context_lengths[context_sentence_sort]
 				batch_context_unsort = variable(torch.LongTensor(np.argsort(context_sentence_sort)))
 				batch_context_sentence_masks_sorted = variable(
@@ -116,6 +127,7 @@ def train_epochs(model, vocab):
 	eval_interval = args.eval_interval
 
 	optimizer = optim.Adam(model.parameters(), lr=args.learning_rate)
+	train_gather_context = get_chunk_gatherer(train_context_per_docid)
 	train_loss = 0
 	train_denom = 0
 	validation_history = []
@@ -127,15 +139,22 @@ def train_epochs(model, vocab):
 	valid_batches = create_batches(valid_documents, args.batch_length,args.job_size, vocab)
 	test_batches = create_batches(test_documents,args.batch_length,args.job_size, vocab)
 
+	train_context_length = context_length_function(train_context_per_docid, args.reduced)
 	mrr_value = []
 	for epoch in range(args.num_epochs):
 
 		print("Creating train batches")
-		train_batches = make_bucket_batches(train_documents, args.batch_length, vocab)
+		if args.token_budget > 0:
+			train_batch_data = token_budget_batch_data(train_documents, args.token_budget, train_context_length)
+		else:
+			train_batch_data = bucket_batch_data(train_documents, args.batch_length)
+		print("Padding efficiency: {0:.3f}".format(padding_efficiency(train_batch_data, train_context_length)))
+		## batches are built by a background thread while the previous ones train
+		train_batches = build_batches(train_batch_data, args.prefetch)
 		print("Starting epoch {}".format(epoch))
 
 		saved = False
-		for iteration in range(len(train_batches)):
+		for iteration, batch in enumerate(train_batches):
 			optimizer.zero_grad()
 			if (iteration + 1) % eval_interval == 0:
 				print("iteration: {0} train loss: {1}".format(iteration + 1, train_loss / train_denom))
@@ -163,7 +182,6 @@ def train_epochs(model, vocab):
 							evaluate(model, test_batches, test_candidates_embed_docid, test_context_per_docid, test_sentence_mask_doc_id,test_sentence_lengths_doc )
 							exit(0)
 
-			batch = train_batches[iteration]
 			# view_batch(batch,loader.vocab)
 			batch_query_lengths = batch['qlengths']
 			batch_candidates = batch["candidates"]
@@ -176,7 +194,7 @@ def train_epochs(model, vocab):
 				# query tokens
 				batch_query = variable(torch.FloatTensor(query_embed))
 				batch_query_length = np.array([batch['qlengths'][index]])
-				batch_question_mask = variable(torch.FloatTensor(np.array([1 for x in range(batch_query_length)])))
+				batch_question_mask = variable(torch.ones(int(batch_query_length[0])))
 
 				# Sort the candidates by length (only required if using an RNN)
 				batch_candidate_lengths = np.array(batch_candidates["anslengths"][index])
@@ -186,7 +204,7 @@ def train_epochs(model, vocab):
 				# get candidates_embed from doc_id
 				doc_id = batch_doc_ids[index]
 				batch_candidates_embed_sorted = variable(
-					torch.FloatTensor(train_candidates_embed_docid[doc_id][candidate_sort, ...]))
+					to_tensor(train_candidates_embed_docid[doc_id][candidate_sort, ...]))
 
 				batch_candidate_lengths_sorted = batch_candidate_lengths[candidate_sort]
 				batch_candidate_unsort = variable(torch.LongTensor(np.argsort(candidate_sort)))
@@ -197,16 +215,11 @@ def train_epochs(model, vocab):
 				# context tokens
 				## if using reduced context
 				if args.reduced:
-					context_embeddings =  train_context_per_docid[doc_id]
-					reduced_context_embeddings = []
-					ranges = batch_reduced_context_indices[index]
-					for r in ranges:
-						reduced_context_embeddings += context_embeddings[r[0]:r[1]].tolist()
-					batch_context = variable(torch.FloatTensor(reduced_context_embeddings))
+					batch_context = variable(train_gather_context(doc_id, batch_reduced_context_indices[index]))
 				else:
 					sentence_context_lengths = train_sentence_lengths_doc[doc_id]
 					context_sentence_sort = np.argsort(sentence_context_lengths)[::-1].copy()
-					batch_context_embed_sorted = variable(torch.FloatTensor(train_context_per_docid[doc_id][context_sentence_sort,...]))
+					batch_context_embed_sorted = variable(to_tensor(train_context_per_docid[doc_id][context_sentence_sort,...]))
 					batch_context_lengths_sorted = sentence_context_lengths[context_sentence_sort]
 					batch_context_unsort = variable(torch.LongTensor(np.argsort(context_sentence_sort)))
 					batch_context_sentence_masks_sorted = variable(torch.FloatTensor(train_sentence_mask_doc_id[doc_id][context_sentence_sort]))
@@ -254,6 +267,7 @@ def train_epochs(model, vocab):
 	print("All epochs done")
 	model = torch.load(args.model_path)
 	evaluate(model, test_batches, test_candidates_embed_docid, test_context_per_docid )
+	close_batch_pools()
 
 def train_mrr(index, indices, batch_answer_indices):
 	if args.use_cuda:
@@ -282,6 +296,7 @@ if __name__ == "__main__":
 	parser.add_argument("--pickle_folder", type=str, default=None)
 	parser.add_argument("--job_size", type=int, default=5)
 	parser.add_argument("--pretrain_path", type=str, default=None, help="Path to the pre-trained word embeddings")
+	parser.add_argument("--pretrain_cache", type=str, default=None, help="Path prefix of the binary cache of --pretrain_path (.data and .index), next to it by default")
 	parser.add_argument("--max_documents", type=int, default=0, help="If greater than 0, load at most this many documents")
 
 	# Model parameters
@@ -304,6 +319,12 @@ if __name__ == "__main__":
 	parser.add_argument("--profile", action="store_true")
 	parser.add_argument("--squad", action="store_true")
 	parser.add_argument("--reduced", action="store_true")
+	parser.add_argument("--embedding_store", type=str, default=None, help="Folder of memory-mapped ELMo embedding stores, created on first use and rebuilt when a split pickle changes")
+	parser.add_argument("--gather_cache_size", type=int, default=512, help="Number of reduced context index arrays cached per split")
+	parser.add_argument("--embedding_dtype", type=str, default="float16", help="float16 or float32")
+	parser.add_argument("--prefetch", type=int, default=4, help="Number of training batches built ahead in the background, 0 builds all of them up front")
+	parser.add_argument("--token_budget", type=int, default=0, help="If greater than 0, fill training batches up to this many padded context x candidate cells instead of bucketing by question length")
+	parser.add_argument("--tfidf_index", type=str, default=None, help="Corpus level tfidf vocabulary and idf used to select the reduced context, fitted on the training documents if the file does not exist")
 
 	args = parser.parse_args()
 
@@ -323,31 +344,27 @@ if __name__ == "__main__":
 		valid_documents = loader.load_documents_with_candidates(args.valid_path)
 		test_documents = loader.load_documents_with_candidates(args.valid_path)
 	elif args.elmo:
+		## every split is read one at a time, and not at all when its embedding store is valid
 		loader = DataLoader(args)
-		with open(args.train_path, "r") as fin:
-			t_documents = pickle.load(fin)
-		with open(args.valid_path, "r") as fin:
-			v_documents = pickle.load(fin)
-		with open(args.test_path, "r") as fin:
-			te_documents = pickle.load(fin)
-
-		train_documents, train_candidates_embed_docid,train_context_per_docid,train_sentence_mask_doc_id,train_sentence_lengths_doc = loader.load_documents_elmo(t_documents)
-		valid_documents,valid_candidates_embed_docid,valid_context_per_docid,valid_sentence_mask_doc_id, valid_sentence_lengths_doc  = loader.load_documents_elmo(v_documents)
-		test_documents, test_candidates_embed_docid,test_context_per_docid,test_sentence_mask_doc_id ,test_sentence_lengths_doc = loader.load_documents_elmo(te_documents)
+		train_documents, train_candidates_embed_docid,_,train_context_per_docid,train_sentence_mask_doc_id,train_sentence_lengths_doc = loader.load_elmo_split(args.train_path,
+			embedding_store=embedding_store_path("train_sentences"), dtype=args.embedding_dtype)
+		valid_documents,valid_candidates_embed_docid,_,valid_context_per_docid,valid_sentence_mask_doc_id, valid_sentence_lengths_doc  = loader.load_elmo_split(args.valid_path,
+			embedding_store=embedding_store_path("valid_sentences"), dtype=args.embedding_dtype)
+		test_documents, test_candidates_embed_docid,_,test_context_per_docid,test_sentence_mask_doc_id ,test_sentence_lengths_doc = loader.load_elmo_split(args.test_path,
+			embedding_store=embedding_store_path("test_sentences"), dtype=args.embedding_dtype)
 	elif args.reduced:
 		loader = DataLoader(args)
-		with open(args.train_path, "r") as fin:
-			t_documents = pickle.load(fin)
-		with open(args.valid_path, "r") as fin:
-			v_documents = pickle.load(fin)
-		with open(args.test_path, "r") as fin:
-			te_documents = pickle.load(fin)
+		if args.tfidf_index is not None:
+			loader.load_tfidf_index(args.tfidf_index, args.train_path)
 		print("Loading training documents")
-		train_documents, train_candidates_embed_docid, train_context_per_docid= loader.load_documents_split_sentences(t_documents)
+		train_documents, train_candidates_embed_docid, train_context_per_docid= loader.load_reduced_split(args.train_path,
+			embedding_store=embedding_store_path("train_reduced"), dtype=args.embedding_dtype)
 		print("Loading validation documents")
-		valid_documents, valid_candidates_embed_docid, valid_context_per_docid= loader.load_documents_split_sentences(v_documents)
+		valid_documents, valid_candidates_embed_docid, valid_context_per_docid= loader.load_reduced_split(args.valid_path,
+			embedding_store=embedding_store_path("valid_reduced"), dtype=args.embedding_dtype)
 		print("Loading testing documents")
-		test_documents, test_candidates_embed_docid, test_context_per_docid= loader.load_documents_split_sentences(te_documents)
+		test_documents, test_candidates_embed_docid, test_context_per_docid= loader.load_reduced_split(args.test_path,
+			embedding_store=embedding_store_path("test_reduced"), dtype=args.embedding_dtype)
 		with open(args.pickle_folder + "train_reduced_summaries.pickle", "wb") as fout:
 			pickle.dump(train_documents, fout)
 		with open(args.pickle_folder + "valid_reduced_summaries.pickle", "wb") as fout:
@@ -366,7 +383,7 @@ if __name__ == "__main__":
 
 	# Get pre_trained embeddings
 	if args.pretrain_path is not None:
-		word_embedding = get_pretrained_emb(args.pretrain_path, loader.vocab.vocabulary, args.embed_size)
+		word_embedding = get_pretrained_emb(args.pretrain_path, loader.vocab.vocabulary, args.embed_size, cache_path=args.pretrain_cache)
 		loader.pretrain_embedding = word_embedding
 
 
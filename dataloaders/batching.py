@@ -0,0 +1,89 @@
+import numpy as np
+
+
+def length_mask(lengths, max_length=None, dtype=np.int64):
+    ## (N, max_length) mask with ones on the first lengths[i] positions of row i
+    lengths = np.asarray(lengths)
+    if max_length is None:
+        max_length = int(lengths.max()) if len(lengths) > 0 else 0
+    return (np.arange(max_length)[None, :] < lengths[:, None]).astype(dtype)
+
+
+def pad_sequences(sequences, max_length=None, pad_token=0, dtype=np.int64):
+    ## (N, max_length) array of token ids; unlike pad_seq the input lists are left untouched
+    lengths = [len(sequence) for sequence in sequences]
+    if max_length is None:
+        max_length = max(lengths) if len(lengths) > 0 else 0
+    padded = np.full((len(sequences), max_length), pad_token, dtype=dtype)
+    for index, sequence in enumerate(sequences):
+        padded[index, :lengths[index]] = sequence
+    return padded
+
+
+def pad_embeddings(matrices, max_length=None, dtype=np.float32):
+    ## (N, max_length, d) array of zero padded (length, d) matrices, written into one preallocated buffer
+    lengths = [len(matrix) for matrix in matrices]
+    if max_length is None:
+        max_length = max(lengths) if len(lengths) > 0 else 0
+    size = np.shape(matrices[0])[-1] if len(matrices) > 0 else 0
+    padded = np.zeros((len(matrices), max_length, size), dtype=dtype)
+    for index, matrix in enumerate(matrices):
+        if lengths[index] > 0:
+            padded[index, :lengths[index]] = matrix
+    return padded
+
+
+def context_length_function(context_per_docid, reduced=False):
+    ## number of context rows every question of an ElmoDataset is scored against: its retrieved chunks, or the whole
+    ## document
+    if reduced:
+        def reduced_context_length(data):
+            lengths = np.zeros(len(data.chunk_indices) + 1, dtype=np.int64)
+            lengths[1:] = np.cumsum(data.chunk_indices[:, 1] - data.chunk_indices[:, 0])
+            return lengths[data.chunk_offsets[1:]] - lengths[data.chunk_offsets[:-1]]
+        return reduced_context_length
+    def document_context_length(data):
+        lengths = np.array([int(np.prod(np.shape(context_per_docid[doc_id])[:-1])) for doc_id in data.doc_ids], dtype=np.int64)
+        return lengths[data.question_document]
+    return document_context_length
+
+
+def padding_efficiency(batch_data, context_length):
+    ## share of the padded (batch size x context length x candidate count) cells of all batches that are real
+    real = 0
+    padded = 0
+    for batch in batch_data:
+        lengths, counts = context_length(batch), batch.candidate_counts()
+        real += int(np.sum(lengths * counts))
+        padded += len(batch) * int(lengths.max()) * int(counts.max())
+    return float(real) / padded if padded > 0 else 1.0
+
+
+def token_budget_batch_data(data, token_budget, context_length):
+    """
+    Groups the questions of an ElmoDataset by (context length, candidate count) and fills each batch up to
+    token_budget padded context x candidate cells, instead of a fixed number of questions, so batches cost about the
+    same to run. A question over the budget gets a batch of its own. Returns the dataset slice of every batch, in
+    shuffled order.
+    """
+    sizes = list(zip(context_length(data).tolist(), data.candidate_counts().tolist()))
+    ## shuffling before the (stable) sort changes which equal sized questions share a batch between epochs
+    order = sorted(np.random.permutation(len(data)), key=lambda index: sizes[index])
+
+    batch_data = []
+    batch = []
+    max_length = max_count = 0
+    for index in order:
+        length, count = sizes[index]
+        batch_length, batch_count = max(max_length, length), max(max_count, count)
+        if len(batch) > 0 and (len(batch) + 1) * batch_length * batch_count > token_budget:
+            batch_data.append(batch)
+            batch = []
+            batch_length, batch_count = length, count
+        batch.append(index)
+        max_length, max_count = batch_length, batch_count
+    if len(batch) > 0:
+        batch_data.append(batch)
+
+    np.random.shuffle(batch_data)
+    return [data[indices] for indices in batch_data]
@@ -1,3 +1,6 @@
+import numpy as np
+from retrieval.preprocessing import flatten
+
 class Document:
     def __init__(self, id, set, kind, document_tokens, queries, entity_dictionary,other_dictionary, candidates,ner_candidates, pos_candidates):
         self.document_id = id
@@ -77,22 +80,124 @@ class Data_Point:
         self.ner_for_candidates = ner_for_candidates
         self.pos_for_candidates = pos_for_candidates
 
-class Elmo_Data_Point:
-
-    def __init__(self, question_tokens,question_embed,
-                 answer_indices, context_tokens, context_embed, candidates, candidates_embed, doc_id, chunk_indices=None):
+def gather_ranges(values, offsets, rows):
+    ## values[offsets[row]:offsets[row + 1]] of every row back to back, and the offsets of the rows in the result
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    gathered_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    gathered_offsets[1:] = np.cumsum(lengths)
+    index = np.arange(gathered_offsets[-1], dtype=np.int64) + np.repeat(starts - gathered_offsets[:-1], lengths)
+    return values[index], gathered_offsets
+
+class ElmoDataset(object):
+    """
+    The questions of a split as columns instead of one data point object per question. The token ids and ELMo rows
+    of all questions are stored back to back with offsets, and the candidate answers of a document once for all of
+    its questions; question i belongs to document question_document[i].
+    dataset[indices] is the dataset of only those questions and their documents, in the order of indices: batches are
+    built from such slices, and only the slice is sent to a batch worker.
+    """
+    def __init__(self, doc_ids, candidate_tokens, candidate_offsets, document_candidates,
+                 question_document, question_tokens, question_offsets, question_embed, embed_offsets,
+                 answer_indices, chunk_indices=None, chunk_offsets=None):
+        self.doc_ids = doc_ids
+        self.candidate_tokens = candidate_tokens
+        self.candidate_offsets = candidate_offsets
+        self.document_candidates = document_candidates
+        self.question_document = question_document
         self.question_tokens = question_tokens
+        self.question_offsets = question_offsets
         self.question_embed = question_embed
-        self.context_tokens = context_tokens
-        self.context_embed = context_embed
-        self.answer_indices =answer_indices
-        self.candidates = candidates
-        self.candidates_embed = candidates_embed
-        self.doc_id = doc_id
+        self.embed_offsets = embed_offsets
+        self.answer_indices = answer_indices
+        ## (chunks, 2) [start, end) rows of the retrieved chunks of every question, or None
         self.chunk_indices = chunk_indices
-
-
-
-
-
-
+        self.chunk_offsets = chunk_offsets
+
+    def __len__(self):
+        return len(self.question_document)
+
+    def question_doc_ids(self):
+        return [self.doc_ids[document] for document in self.question_document]
+
+    def question_lengths(self):
+        return np.diff(self.question_offsets)
+
+    def candidate_counts(self):
+        return np.diff(self.document_candidates)[self.question_document]
+
+    def question(self, index):
+        return self.question_tokens[self.question_offsets[index]:self.question_offsets[index + 1]]
+
+    def embed(self, index):
+        return self.question_embed[self.embed_offsets[index]:self.embed_offsets[index + 1]]
+
+    def candidate_lengths(self, index):
+        document = self.question_document[index]
+        return np.diff(self.candidate_offsets[self.document_candidates[document]:self.document_candidates[document + 1] + 1])
+
+    def candidates(self, index):
+        document = self.question_document[index]
+        return [self.candidate_tokens[self.candidate_offsets[candidate]:self.candidate_offsets[candidate + 1]]
+                for candidate in range(self.document_candidates[document], self.document_candidates[document + 1])]
+
+    def chunks(self, index):
+        if self.chunk_indices is None:
+            return None
+        return self.chunk_indices[self.chunk_offsets[index]:self.chunk_offsets[index + 1]]
+
+    def __getitem__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        documents, question_document = np.unique(self.question_document[indices], return_inverse=True)
+        candidates, document_candidates = gather_ranges(np.arange(len(self.candidate_offsets) - 1), self.document_candidates, documents)
+        candidate_tokens, candidate_offsets = gather_ranges(self.candidate_tokens, self.candidate_offsets, candidates)
+        question_tokens, question_offsets = gather_ranges(self.question_tokens, self.question_offsets, indices)
+        question_embed, embed_offsets = gather_ranges(self.question_embed, self.embed_offsets, indices)
+        chunk_indices, chunk_offsets = None, None
+        if self.chunk_indices is not None:
+            chunk_indices, chunk_offsets = gather_ranges(self.chunk_indices, self.chunk_offsets, indices)
+        return ElmoDataset([self.doc_ids[document] for document in documents], candidate_tokens, candidate_offsets,
+                           document_candidates, question_document.astype(np.int32), question_tokens, question_offsets,
+                           question_embed, embed_offsets, self.answer_indices[indices], chunk_indices, chunk_offsets)
+
+class ElmoDatasetBuilder(object):
+    ## collects the documents and questions of a split; close() returns the ElmoDataset
+    def __init__(self):
+        self.doc_ids = []
+        self.candidates = []
+        self.document_candidates = [0]
+        self.question_document = []
+        self.questions = []
+        self.question_embeds = []
+        self.answer_indices = []
+        self.chunks = []
+
+    def add_document(self, doc_id, candidates):
+        ## candidates are the token id lists of the candidate answers; returns the index of the document
+        self.doc_ids.append(doc_id)
+        self.candidates.extend(candidates)
+        self.document_candidates.append(len(self.candidates))
+        return len(self.doc_ids) - 1
+
+    def add_question(self, document, question_tokens, question_embed, answer_index, chunk_indices=None):
+        self.question_document.append(document)
+        self.questions.append(question_tokens)
+        self.question_embeds.append(np.asarray(question_embed, dtype=np.float32))
+        self.answer_indices.append(answer_index)
+        self.chunks.append(chunk_indices)
+
+    def close(self):
+        candidate_tokens, candidate_offsets = flatten(self.candidates, np.int32)
+        question_tokens, question_offsets = flatten(self.questions, np.int32)
+        embed_offsets = np.zeros(len(self.question_embeds) + 1, dtype=np.int64)
+        embed_offsets[1:] = np.cumsum([len(embed) for embed in self.question_embeds])
+        size = self.question_embeds[0].shape[-1] if len(self.question_embeds) > 0 else 0
+        question_embed = np.concatenate(self.question_embeds) if len(self.question_embeds) > 0 else np.zeros((0, size), dtype=np.float32)
+        chunk_indices, chunk_offsets = None, None
+        if len(self.chunks) > 0 and all(chunks is not None for chunks in self.chunks):
+            chunk_indices, chunk_offsets = flatten(self.chunks, np.int64)
+            chunk_indices = chunk_indices.reshape(-1, 2)
+        return ElmoDataset(self.doc_ids, candidate_tokens, candidate_offsets, np.array(self.document_candidates, dtype=np.int64),
+                           np.array(self.question_document, dtype=np.int32), question_tokens, question_offsets,
+                           question_embed, embed_offsets, np.array(self.answer_indices, dtype=np.int32), chunk_indices, chunk_offsets)
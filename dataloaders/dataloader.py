@@ -4,7 +4,8 @@ import os
 import glob
 from csv import reader
 import sys
-import re
+import hashlib
+import atexit
 try:
     import cPickle as pickle
 except:
@@ -13,20 +14,27 @@ except:
 import sys
 import spacy
 from nltk import word_tokenize
-from data import Document, Query, Data_Point, Elmo_Data_Point
-from utility import start_tags, end_tags, start_tags_with_attributes, pad_seq, view_data_point, pad_seq_elmo
+from data import Document, Query, Data_Point, ElmoDatasetBuilder
+from utility import view_data_point
+from embedding_store import EmbeddingStore, EmbeddingStoreWriter
+from batching import length_mask, pad_sequences, pad_embeddings
+## the document cache, html cleaning, spacy windows and tfidf scoring are shared with the retrieval package
+from retrieval.preprocessing import clean_html, pipe_windows, DocumentCache, file_digest
+from retrieval.tfidf import TfidfIndex
+from vocabulary import Vocabulary
 import random
 import numpy as np
 from collections import defaultdict
 from test_metrics import Performance
 from multiprocessing import Pool
+import threading
+try:
+    from Queue import Queue
+except:
+    from queue import Queue
 import spacy
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
-import re
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfTransformer
-from sklearn.metrics.pairwise import linear_kernel
 global vocab
 
 
@@ -51,16 +59,17 @@ def view_batch(batch,vocab):
     for index in range(len(q)):
         print(q[index] + " " +  q_ner[index] + " " + a[index] + " " + a_ner[index]+"\n")
 
-def make_bucket_batches(data, batch_size,vocab):
-    # Data are bucketed according to the length of the first item in the data_collections.
+def bucket_batch_data(data, batch_size, group_by_document=False):
+    # Questions of an ElmoDataset are bucketed according to their length.
+    # With group_by_document, they are bucketed by document instead so a batch shares one document encoding.
+    # Returns the dataset slice of every batch, in batch order; the batches themselves are built by the caller.
     buckets = defaultdict(list)
 
-    for data_item in data:
-        src = data_item.question_tokens
-        buckets[len(src)].append(data_item)
+    keys = data.question_document if group_by_document else data.question_lengths()
+    for index, key in enumerate(keys.tolist()):
+        buckets[key].append(index)
 
     batch_data = []
-    batches = []
     # np.random.seed(2)
     for src_len in buckets:
         bucket = buckets[src_len]
@@ -71,37 +80,76 @@ def make_bucket_batches(data, batch_size,vocab):
             cur_batch_size = batch_size if i < num_batches - 1 else len(bucket) - batch_size * i
             begin_index = i * batch_size
             end_index = begin_index + cur_batch_size
-            batch_data  =list(bucket[begin_index:end_index])
-            batch = create_single_batch_elmo(batch_data)
-            #view_batch(batch,vocab)
-            batches.append(batch)
+            batch_data.append(bucket[begin_index:end_index])
 
-    np.random.shuffle(batches)
+    np.random.shuffle(batch_data)
+    return [data[indices] for indices in batch_data]
+
+def make_bucket_batches(data, batch_size,vocab, group_by_document=False):
+    batches = build_batches(bucket_batch_data(data, batch_size, group_by_document))
+    #view_batch(batches[0],vocab)
     return batches
 
+class BatchPrefetcher(object):
+    """
+    Iterates over build(batch_data) for a list of batch data while a background thread builds the next batches.
+    The queue holds at most `depth` finished batches, so memory stays flat however long the epoch is.
+    """
+    _end = object()
+
+    def __init__(self, batch_data, build, depth=4):
+        self.batch_data = batch_data
+        self.build = build
+        self.queue = Queue(maxsize=max(1, depth))
+        self.thread = threading.Thread(target=self._produce)
+        ## a daemon thread never keeps the interpreter alive, e.g. after early stopping calls exit()
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            for batch_data in self.batch_data:
+                self.queue.put((self.build(batch_data), None))
+        except Exception as e:
+            self.queue.put((None, e))
+        self.queue.put((self._end, None))
+
+    def __len__(self):
+        return len(self.batch_data)
+
+    def __iter__(self):
+        while True:
+            batch, error = self.queue.get()
+            if error is not None:
+                raise error
+            if batch is self._end:
+                return
+            yield batch
+
+def build_batches(batch_data, prefetch=0):
+    ## with prefetch > 0 the batches are built by a background thread, at most prefetch of them ahead
+    if prefetch > 0:
+        return BatchPrefetcher(batch_data, create_single_batch_elmo, prefetch)
+    return [create_single_batch_elmo(data) for data in batch_data]
+
 def create_single_batch(batch_data):
 
     batch_query_lengths = np.array([len(data_point.question_tokens) for data_point in batch_data])
     maximum_query_length = max(batch_query_lengths)
-    query_length_mask = np.array([[int(x < batch_query_lengths[i])
-                                   for x in range(maximum_query_length)] for i in range(len(batch_data))])
+    query_length_mask = length_mask(batch_query_lengths, maximum_query_length)
 
-    queries = np.array([pad_seq(data_point.question_tokens, maximum_query_length)
-                        for data_point in batch_data])
+    queries = pad_sequences([data_point.question_tokens for data_point in batch_data], maximum_query_length)
 
     batch_context_lengths = np.array([len(data_point.context_tokens) for data_point in batch_data])
     maximum_context_length = max(batch_context_lengths)
-    contexts = np.array([pad_seq(data_point.context_tokens, maximum_context_length) for data_point in batch_data])
-    batch_context_mask = np.array([[int(x < batch_context_lengths[i])
-                                   for x in range(maximum_context_length)] for i in range(len(batch_data))])
+    contexts = pad_sequences([data_point.context_tokens for data_point in batch_data], maximum_context_length)
+    batch_context_mask = length_mask(batch_context_lengths, maximum_context_length)
 
 
 
-    queries_ner = np.array([pad_seq(data_point.ner_for_question, maximum_query_length)
-                        for data_point in batch_data])
+    queries_ner = pad_sequences([data_point.ner_for_question for data_point in batch_data], maximum_query_length)
 
-    queries_pos = np.array([pad_seq(data_point.pos_for_question, maximum_query_length)
-                            for data_point in batch_data])
+    queries_pos = pad_sequences([data_point.pos_for_question for data_point in batch_data], maximum_query_length)
 
 
     candidate_information = {}
@@ -121,12 +169,10 @@ def create_single_batch(batch_data):
 
         candidate_answer_lengths = [len(answer) for answer in candidates]
         max_candidate_length = max(candidate_answer_lengths)
-        candidate_padded_answers = np.array([pad_seq(answer, max_candidate_length) for answer in candidates])
-        candidate_padded_answers_ner = np.array([pad_seq(answer, max_candidate_length) for answer in candidates_ner])
-        candidate_padded_answers_pos = np.array([pad_seq(answer, max_candidate_length) for answer in candidates_pos])
-        candidate_answer_length_mask = np.array([[int(x < candidate_answer_lengths[i])
-                                                  for x in range(max_candidate_length)] for i in
-                                                 range(len(candidates))])
+        candidate_padded_answers = pad_sequences(candidates, max_candidate_length)
+        candidate_padded_answers_ner = pad_sequences(candidates_ner, max_candidate_length)
+        candidate_padded_answers_pos = pad_sequences(candidates_pos, max_candidate_length)
+        candidate_answer_length_mask = length_mask(candidate_answer_lengths, max_candidate_length)
 
         batch_candidate_answers_padded.append(candidate_padded_answers)
         batch_candidate_answer_lengths.append(candidate_answer_lengths)
@@ -158,37 +204,28 @@ def create_single_batch(batch_data):
     return batch
 
 def create_single_batch_elmo(batch_data):
-    doc_ids  = [data_point.doc_id for data_point in batch_data]
-    chunk_indices = [data_point.chunk_indices for data_point in batch_data]
-    batch_query_lengths = [len(data_point.question_tokens) for data_point in batch_data]
-    maximum_query_length = max(batch_query_lengths)
-    #query_length_mask = np.array([[int(x < batch_query_lengths[i])
-    #                              for x in range(maximum_query_length)] for i in range(len(batch_data))])
+    ## batch_data is the ElmoDataset slice of the questions of the batch
+    doc_ids  = batch_data.question_doc_ids()
+    chunk_indices = [batch_data.chunks(index) for index in range(len(batch_data))]
+    batch_query_lengths = batch_data.question_lengths().tolist()
 
-    queries_embed  = [data_point.question_embed for data_point in batch_data]
-    question_tokens =  [data_point.question_tokens for data_point in batch_data]
+    queries_embed  = [batch_data.embed(index) for index in range(len(batch_data))]
+    question_tokens =  [batch_data.question(index) for index in range(len(batch_data))]
 
     candidate_information = {}
     batch_candidate_answer_lengths = []
-    batch_answer_indices = []
+    batch_answer_indices = batch_data.answer_indices.tolist()
     batch_candidate_answer_length_mask = []
 
-    for index, data_point in enumerate(batch_data):
+    for index in range(len(batch_data)):
         # create a batch mask over candidates similar to the one over different questions
-        candidates = data_point.candidates
-        # candidates_embed = data_point.candidates_embed
-
-        candidate_answer_lengths = [len(answer) for answer in candidates]
+        candidate_answer_lengths = batch_data.candidate_lengths(index).tolist()
         max_candidate_length = max(candidate_answer_lengths)
-        candidate_answer_length_mask = np.array([[int(x < candidate_answer_lengths[i])
-                                                  for x in range(max_candidate_length)] for i in
-                                                 range(len(candidates))])
+        candidate_answer_length_mask = length_mask(candidate_answer_lengths, max_candidate_length)
 
         batch_candidate_answer_lengths.append(candidate_answer_lengths)
         batch_candidate_answer_length_mask.append(candidate_answer_length_mask)
 
-        batch_answer_indices.append(data_point.answer_indices[0])
-
 
     candidate_information["anslengths"] = batch_candidate_answer_lengths
     candidate_information["mask"] = batch_candidate_answer_length_mask
@@ -204,13 +241,34 @@ def create_single_batch_elmo(batch_data):
     return batch
 
 
-def create_batches(data, batch_size, job_size,vocab):
+batch_pools = {}
+
+def get_batch_pool(job_size):
+    ## one long-lived pool per size, shared by every create_batches call instead of forking a new one each time
+    if job_size not in batch_pools:
+        batch_pools[job_size] = Pool(job_size)
+    return batch_pools[job_size]
+
+def close_batch_pools():
+    ## stops the workers of every batch pool, a later create_batches starts a new pool
+    for job_pool in batch_pools.values():
+        job_pool.close()
+        job_pool.join()
+    batch_pools.clear()
+
+## also covers the runs that exit early, e.g. on patience
+atexit.register(close_batch_pools)
+
+def create_batches(data, batch_size, job_size,vocab, group_by_document=False):
     vocab = vocab
-    job_pool = Pool(job_size)
     end_index = 0
-    # shuffle the actual data
-    temp_data = list(data)
+    # shuffle the question indices of the ElmoDataset
+    temp_data = list(range(len(data)))
     random.shuffle(temp_data)
+    if group_by_document:
+        # questions of a document become consecutive (still shuffled within the document)
+        question_doc_ids = data.question_doc_ids()
+        temp_data.sort(key=lambda index: question_doc_ids[index])
 
 
 
@@ -231,12 +289,12 @@ def create_batches(data, batch_size, job_size,vocab):
 
     for j in range(number_batches - 1):
         begin_index, end_index = j * batch_size, (j + 1) * batch_size
-        job_data.append(list(temp_data[begin_index:end_index]))
+        job_data.append(data[temp_data[begin_index:end_index]])
     #batches = job_pool.map(create_single_batch, job_data)
-    batches = job_pool.map(create_single_batch_elmo, job_data)
-
-    job_pool.close()
-    job_pool.join()
+    if job_size > 1:
+        batches = get_batch_pool(job_size).map(create_single_batch_elmo, job_data)
+    else:
+        batches = [create_single_batch_elmo(batch_data) for batch_data in job_data]
 
 
     # for j in range(number_batches - 1):
@@ -248,13 +306,235 @@ def create_batches(data, batch_size, job_size,vocab):
        # batches.append(batch)
 
     #view_batch(batches[1], vocab)
-    batch_data = list(temp_data[end_index:])
+    batch_data = data[temp_data[end_index:]]
     # batches.append(create_single_batch(batch_data))
     batches.append(create_single_batch_elmo(batch_data))
 
     print("Created batches of batch_size {0} and number {1}".format(batch_size, number_batches))
     return batches
 
+def split_chunks(original_sentences, chunk_length=40):
+    ## cuts the sentences of a document into chunks of about chunk_length tokens, returns the chunks, their joined
+    ## strings and their [start, end) token positions in the document
+
+    ## each sentence should be fewer than 40 tokens long
+    sentences = []
+    for e, sent in enumerate(original_sentences):
+        if len(sent) > chunk_length:
+            position = 0
+            position_index = 0
+            while position < len(sent):
+                sentences.append(sent[position_index * chunk_length:(position_index + 1) * chunk_length])
+                position_index += 1
+                position += chunk_length
+        else:
+            sentences.append(sent)
+
+    chunk_storage = []
+    concat_chunk_storage= []
+    # sentence_boundaries_storage = []
+    chunk_boundaries_storage = []
+    e = 0
+    rolling_index = 0
+    while e < len(sentences):
+        previous_size = 0
+        current_chunk_size = 0
+        current_chunk = []
+        sentence_boundaries = []
+        while e < len(sentences) and current_chunk_size < chunk_length:
+            current_chunk += sentences[e]
+            previous_size = current_chunk_size
+            current_chunk_size += len(sentences[e])
+            sentence_boundaries.append(previous_size)
+            e += 1
+        ## guard against previous size being zero, guard against sentence size >= chunk_size, gaurd against e-=1 infinite loop
+        if abs(chunk_length - previous_size) < abs(current_chunk_size - chunk_length) and e != len(sentences):
+            current_chunk = current_chunk[:previous_size]
+            sentence_boundaries = sentence_boundaries[:-1]
+            ## restart from the previous chunk in this case
+            e -= 1
+            if len(current_chunk) > 0:
+                chunk_storage.append(current_chunk)
+                concat_chunk_storage.append(" ".join(current_chunk))
+                chunk_boundaries_storage.append([rolling_index, rolling_index + len(current_chunk)])
+                rolling_index += len(current_chunk)
+                # sentence_boundaries_storage.append(sentence_boundaries)
+        else:
+            ## if out of sentences, use the last chunk as is
+            if len(current_chunk) > 0:
+                chunk_storage.append(current_chunk)
+                concat_chunk_storage.append(" ".join(current_chunk))
+                chunk_boundaries_storage.append([rolling_index, rolling_index + len(current_chunk)])
+                rolling_index += len(current_chunk)
+                # sentence_boundaries_storage.append(sentence_boundaries)
+    return chunk_storage, concat_chunk_storage, chunk_boundaries_storage
+
+to_anonymize = ["GPE", "PERSON", "ORG", "LOC"]
+
+def document_entities(nlp, string_data):
+    ## (start_char, end_char, label, text) of the named entities, found on overlapping windows of the document; an
+    ## entity belongs to the window where it starts, and one that runs over a window boundary is not found twice
+    last_end = 0
+    for start, end, offset, doc in pipe_windows(nlp, string_data, ["ner"]):
+        for entity in doc.ents:
+            position = offset + entity.start_char
+            if start <= position < end and position >= last_end:
+                last_end = offset + entity.end_char
+                yield position, last_end, entity.label_, entity.text
+
+def anonymize_entities(entities, string_data, entity_dict, other_dict):
+    data = set(string_data.split())
+    NE_data = ""
+    start_pos = 0
+    for start, end, label, tokens in entities:
+        key = tokens.lower()
+        if label in to_anonymize:
+            if key not in data:
+                if key not in entity_dict:
+                    entity_dict[key] = "@ent" + str(len(entity_dict)) + "~ner:" + label
+                NE_data += string_data[start_pos:start] + entity_dict[key] + " "
+                start_pos = end + 1
+        else:
+            other_dict[key] = tokens + "~ner:" + label
+            NE_data += string_data[start_pos:start] + tokens + "~ner:" + label + " "
+            start_pos = end + 1
+
+    NE_data += string_data[start_pos:]
+    return NE_data.split()
+
+def read_document_tokens(input_folder, doc_id, kind, start_tag, end_tag):
+    document_tokens = []
+    filename = input_folder + doc_id + ".content"
+    if kind == "gutenberg":
+        try:
+            with codecs.open(filename, "r", encoding='utf-8', errors='replace') as fin:
+                data = fin.read()
+                data = data.replace('"', '')
+                tokenized_data = " ".join(word_tokenize(data))
+                start_index = tokenized_data.find(start_tag)
+                end_index = tokenized_data.rfind(end_tag, start_index)
+                filtered_data = tokenized_data[start_index:end_index]
+                if len(filtered_data) == 0:
+                    print("Error in book extraction: ",
+                            filename, start_tag, end_tag)
+                else:
+                    filtered_data = filtered_data.replace(
+                        " 's ", " s ")
+                    document_tokens = word_tokenize(filtered_data)
+
+        except Exception as error:
+            print(error)
+            print("Books for which 'utf-8' doesnt work: ", doc_id)
+    else:
+        try:
+            # Here we remove some annotation that is unique to movie scripts
+            with codecs.open(filename, "r", encoding="utf-8",
+                                errors="replace") as fin:
+                text = fin.read()
+                text = text.replace('"', '')
+                text = clean_html(text)
+                start_tag = start_tag.replace(
+                    " S ", " 'S ").replace(" s ", " 's ")
+                tokenized_data = " ".join(word_tokenize(text))
+                start_index = tokenized_data.find(start_tag)
+                if start_index == -1:
+                    pass
+                end_index = tokenized_data.rfind(end_tag, start_index)
+                filtered_data = tokenized_data[start_index:end_index]
+                if len(filtered_data) == 0:
+                    print("Error in movie extraction: ",
+                            filename, start_tag)
+                else:
+                    filtered_data == filtered_data.replace(
+                        " 's ", " s ")
+                    document_tokens = word_tokenize(filtered_data)
+
+        except Exception as error:
+            print(error)
+            print(
+                "Movie for which html extraction doesnt work doesnt work: ", doc_id)
+    return document_tokens
+
+def process_document(nlp, input_folder, doc_id, kind, start_tag, end_tag):
+    document_tokens = read_document_tokens(input_folder, doc_id, kind, start_tag, end_tag)
+
+    #Get NER
+    entity_dictionary = {}
+    other_dictionary = {}
+    title_document_tokens = [token.lower() if token.isupper() else token for token in document_tokens]
+    string_doc = " ".join(title_document_tokens)
+    NER_document_tokens = anonymize_entities(document_entities(nlp, string_doc), string_doc, entity_dictionary, other_dictionary)
+
+    return NER_document_tokens, entity_dictionary, other_dictionary
+
+def process_document_cached(nlp, cache, input_folder, doc_id, kind, start_tag, end_tag):
+    if cache is None:
+        return process_document(nlp, input_folder, doc_id, kind, start_tag, end_tag)
+    key = cache.key(input_folder + doc_id + ".content", kind, start_tag, end_tag)
+    processed = cache.load(doc_id, key)
+    if processed is None:
+        processed = process_document(nlp, input_folder, doc_id, kind, start_tag, end_tag)
+        cache.store(doc_id, key, processed)
+    else:
+        print("Loaded from cache:{0}".format(doc_id))
+    return processed
+
+def init_document_worker():
+    ## each worker process loads its own spacy model once
+    global worker_nlp
+    worker_nlp = spacy.load('en')
+
+def process_document_job(job):
+    ## every document is pickled to its own shard as soon as it is processed, so a worker holds one book at a time
+    index, shard_path, input_folder, (doc_id, kind, start_tag, end_tag), cache = job
+    print("Processing:{0}".format(doc_id))
+    try:
+        NER_document_tokens, entity_dictionary, other_dictionary = process_document_cached(worker_nlp, cache, input_folder, doc_id, kind, start_tag, end_tag)
+    except Exception as error:
+        ## a failing document only loses itself, the other documents are still processed
+        print("Failed to process {0}: {1}".format(doc_id, error))
+        return index, None
+    with open(shard_path, "wb") as fout:
+        pickle.dump((doc_id, NER_document_tokens, entity_dictionary, other_dictionary), fout, pickle.HIGHEST_PROTOCOL)
+    return index, shard_path
+
+def process_documents_parallel(filenames, input_folder, documents, shard_folder, workers, cache=None):
+    ## documents are dispatched one at a time, the largest first so no worker is left with a long book at the end;
+    ## the results are yielded in the order of filenames, as process_documents_serial does
+    jobs = []
+    for index, filename in enumerate(filenames):
+        doc_id = os.path.basename(filename).replace(".content", "")
+        (set, kind, start_tag, end_tag) = documents[doc_id]
+        jobs.append((index, shard_folder + "docs_shard_{0}.pickle".format(doc_id), input_folder, (doc_id, kind, start_tag, end_tag), cache))
+    jobs.sort(key=lambda job: os.path.getsize(filenames[job[0]]), reverse=True)
+
+    job_pool = Pool(workers, initializer=init_document_worker)
+    finished = {}
+    next_index = 0
+    for index, shard_path in job_pool.imap_unordered(process_document_job, jobs, chunksize=1):
+        finished[index] = shard_path
+        ## only the paths of documents that finished out of order are kept, the documents stay on disk
+        while next_index in finished:
+            shard_path = finished.pop(next_index)
+            next_index += 1
+            if shard_path is None:
+                continue
+            with open(shard_path, "rb") as fin:
+                processed = pickle.load(fin)
+            os.remove(shard_path)
+            yield processed
+    job_pool.close()
+    job_pool.join()
+
+
+def source_fingerprint(source_path, *settings):
+    ## identifies a source pickle by its path, size and modification time, and the settings a store is built with,
+    ## without reading the file
+    stat = os.stat(source_path)
+    key = (os.path.abspath(source_path), stat.st_size, stat.st_mtime) + settings
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
 class DataLoader():
     def __init__(self, args):
 
@@ -267,9 +547,12 @@ class DataLoader():
         self.nlp = spacy.load('en')
         self.stop_words = list(stopwords.words('english'))
         self.lemmatizer = WordNetLemmatizer()
+        self.tfidf = TfidfIndex(preprocessor=self.lemmatizer.lemmatize, stop_words=self.stop_words, ngram_range=(1, 2))
+        self.corpus_tfidf = False
+        self.tfidf_index_path = None
 
     # This function loads raw documents, summaries and queries, processes them, stores them in document class and finally saves to a pickle
-    def process_data(self, input_folder, summary_path, qap_path, document_path, pickle_folder, small_number=-1, summary_only=False, interval=50):
+    def process_data(self, input_folder, summary_path, qap_path, document_path, pickle_folder, small_number=-1, summary_only=False, interval=50, workers=1, cache_folder=None):
         reload(sys)
         sys.setdefaultencoding('utf8')
 
@@ -280,51 +563,27 @@ class DataLoader():
         # Not the documents themselves
         # assuming every unique id has one summary only
 
-        to_anonymize = ["GPE", "PERSON", "ORG", "LOC"]
-        def _getNER(string_data,entity_dict,other_dict):
-            doc = self.nlp(string_data)
-            data = string_data.split()
-            NE_data = ""
-            start_pos = 0
-            for ents in doc.ents:
-                start = ents.start_char
-                end = ents.end_char
-                label = ents.label_
-                tokens = ents.text
-                key = tokens.lower()
-                if label in to_anonymize:
-                    if key not in data:
-                        if key not in entity_dict:
-                            entity_dict[key] = "@ent" + str(len(entity_dict)) + "~ner:" + label
-                        NE_data += string_data[start_pos:start] + entity_dict[key] + " "
-                        start_pos = end + 1
-                else:
-                    other_dict[key] = tokens + "~ner:" + label
-                    NE_data += string_data[start_pos:start] + tokens + "~ner:" + label + " "
-                    start_pos = end + 1
-
-            NE_data += string_data[start_pos:]
-            return NE_data.split()
-
-
-        summaries = {}
+        summary_rows = []
         with codecs.open(summary_path, "r", encoding='utf-8', errors='replace') as fin:
             first = True
             for line in reader(fin):
                 if first:
                     first=False
                     continue
-                id = line[0]
-                summary_tokens = line[2]
-                ner_summary, pos_summary, tokens = self.getNER(line[2])
-                summaries[id] = (tokens, ner_summary, pos_summary)
+                summary_rows.append((line[0], line[2]))
+
+        summaries = {}
+        ## summaries go through spacy in batches rather than one string at a time
+        summary_tags = self.getNER_batch([summary for _, summary in summary_rows])
+        for (id, _), (ner_summary, pos_summary, tokens) in zip(summary_rows, summary_tags):
+            summaries[id] = (tokens, ner_summary, pos_summary)
         print("Loaded summaries")
         qaps = {}
 
         candidates_per_doc = defaultdict(list)
         ner_candidates_per_doc = defaultdict(list)
         pos_candidates_per_doc = defaultdict(list)
-        count = 0
+        qap_rows = []
         with codecs.open(qap_path, "r") as fin:
             first= True
             for line in reader(fin):
@@ -332,52 +591,37 @@ class DataLoader():
                 if first:
                     first= False
                     continue
-                id = line[0]
-
-                if id in qaps:
-
-
-
-                    ner_answer, pos_answer,tokens= self.getNER(line[3])
-                    ner_candidates_per_doc[id].append(ner_answer)
-                    pos_candidates_per_doc[id].append(pos_answer)
-                    candidates_per_doc[id].append(tokens)
-
-                    ner_answer, pos_answer,tokens = self.getNER(line[4])
-                    ner_candidates_per_doc[id].append(ner_answer)
-                    pos_candidates_per_doc[id].append(pos_answer)
-                    candidates_per_doc[id].append(tokens)
-
-                    indices = [candidate_index, candidate_index + 1]
-                    candidate_index += 2
-
-                    ner_question, pos_question,tokens = self.getNER(line[2])
-                    qaps[id].append(
-                        Query(tokens,ner_question, pos_question, indices))
-                else:
-                    #print(id)
-                    qaps[id] = []
-                    candidates_per_doc[id] = []
-                    candidate_index = 0
-
-
-                    ner_answer, pos_answer,tokens = self.getNER(line[3])
-                    ner_candidates_per_doc[id].append(ner_answer)
-                    pos_candidates_per_doc[id].append(pos_answer)
-                    candidates_per_doc[id].append(tokens)
-
-
-                    ner_answer, pos_answer,tokens = self.getNER(line[4])
-                    ner_candidates_per_doc[id].append(ner_answer)
-                    pos_candidates_per_doc[id].append(pos_answer)
-                    candidates_per_doc[id].append(tokens)
-
-                    indices= [candidate_index, candidate_index + 1]
-                    candidate_index += 2
-
-                    ner_question, pos_question,tokens = self.getNER(line[2])
-                    qaps[id].append(
-                        Query(tokens,ner_question, pos_question,indices))
+                qap_rows.append((line[0], line[3], line[4], line[2]))
+
+        ## every row contributes answer1, answer2 and the question, in that order
+        qap_strings = []
+        for _, answer1, answer2, question in qap_rows:
+            qap_strings += [answer1, answer2, question]
+        qap_tags = iter(self.getNER_batch(qap_strings))
+
+        for id, _, _, _ in qap_rows:
+            if id not in qaps:
+                #print(id)
+                qaps[id] = []
+                candidates_per_doc[id] = []
+                candidate_index = 0
+
+            ner_answer, pos_answer,tokens = next(qap_tags)
+            ner_candidates_per_doc[id].append(ner_answer)
+            pos_candidates_per_doc[id].append(pos_answer)
+            candidates_per_doc[id].append(tokens)
+
+            ner_answer, pos_answer,tokens = next(qap_tags)
+            ner_candidates_per_doc[id].append(ner_answer)
+            pos_candidates_per_doc[id].append(pos_answer)
+            candidates_per_doc[id].append(tokens)
+
+            indices = [candidate_index, candidate_index + 1]
+            candidate_index += 2
+
+            ner_question, pos_question,tokens = next(qap_tags)
+            qaps[id].append(
+                Query(tokens,ner_question, pos_question, indices))
 
         print("Loaded question answer pairs")
         documents = {}
@@ -453,101 +697,28 @@ class DataLoader():
         # Here we load documents, tokenize them, and create Document class instances
         print("Processing documents")
         filenames=glob.glob(os.path.join(input_folder, '*.content'))
-        for file_number in range(len(filenames)):
-            filename=filenames[file_number]
+        for filename in filenames:
             doc_id = os.path.basename(filename).replace(".content", "")
-            print("Processing:{0}".format(doc_id))
-            try:
-                (set, kind, start_tag, end_tag) = documents[doc_id]
-            except KeyError:
+            if doc_id not in documents:
                 print("Document id not found: {0}".format(doc_id))
-                exit(0)                
-
-            if kind == "gutenberg":
-                try:
-                    with codecs.open(input_folder + doc_id + ".content", "r", encoding='utf-8', errors='replace') as fin:
-                        data = fin.read()
-                        data = data.replace('"', '')
-                        tokenized_data = " ".join(word_tokenize(data))
-                        start_index = tokenized_data.find(start_tag)
-                        end_index = tokenized_data.rfind(end_tag, start_index)
-                        filtered_data = tokenized_data[start_index:end_index]
-                        if len(filtered_data) == 0:
-                            print("Error in book extraction: ",
-                                    filename, start_tag, end_tag)
-                        else:
-                            filtered_data = filtered_data.replace(
-                                " 's ", " s ")
-                            document_tokens = word_tokenize(filtered_data)
-
-                except Exception as error:
-                    print(error)
-                    print("Books for which 'utf-8' doesnt work: ", doc_id)
-            else:
-                try:
-                    # Here we remove some annotation that is unique to movie scripts
-                    with codecs.open(input_folder + doc_id + ".content", "r", encoding="utf-8",
-                                        errors="replace") as fin:
-                        text = fin.read()
-                        text = text.replace('"', '')
-                        script_regex = r"<script.*>.*?</script>|<SCRIPT.*>.*?</SCRIPT>"
-                        text = re.sub(script_regex, '', text)
-                        for tag in start_tags_with_attributes:
-                            my_regex = r'{0}.*=.*?>'.format(tag)
-                            text = re.sub(my_regex, '', text)
-                        for tag in end_tags:
-                            text = text.replace(tag, "")
-                        for tag in start_tags:
-                            text = text.replace(tag, "")
-                        start_tag = start_tag.replace(
-                            " S ", " 'S ").replace(" s ", " 's ")
-                        tokenized_data = " ".join(word_tokenize(text))
-                        start_index = tokenized_data.find(start_tag)
-                        if start_index == -1:
-                            pass
-                        end_index = tokenized_data.rfind(end_tag, start_index)
-                        filtered_data = tokenized_data[start_index:end_index]
-                        if len(filtered_data) == 0:
-                            print("Error in movie extraction: ",
-                                    filename, start_tag)
-                        else:
-                            filtered_data == filtered_data.replace(
-                                " 's ", " s ")
-                            document_tokens = word_tokenize(filtered_data)
-
-                except Exception as error:
-                    print(error)
-                    print(
-                        "Movie for which html extraction doesnt work doesnt work: ", doc_id)
-
-            #Get NER
-            entity_dictionary = {}
-            other_dictionary = {}
-            title_document_tokens = [token.lower() if token.isupper() else token for token in document_tokens]
-            string_doc = " ".join(title_document_tokens)
-            if len(string_doc) > 1000000:
-                q1 = len(string_doc) / 4
-
-                first_quarter = string_doc[0:q1]
-                second_quarter = string_doc[q1:q1*2]
-                third_quarter = string_doc[q1 * 2:q1*3]
-                fourth_quarter = string_doc[q1*3:]
-                first_q_tokens = _getNER(first_quarter,entity_dictionary,other_dictionary)
-                second_q_tokens = _getNER(second_quarter, entity_dictionary,other_dictionary)
-                third_q_tokens = _getNER(third_quarter, entity_dictionary,other_dictionary)
-                fourth_q_tokens = _getNER(fourth_quarter, entity_dictionary,other_dictionary)
-
-                NER_document_tokens = first_q_tokens + second_q_tokens + third_q_tokens + fourth_q_tokens
-            else:
-                NER_document_tokens = _getNER(string_doc,entity_dictionary,other_dictionary)
+                exit(0)
+
+        ## processed documents are cached one by one, so a crashed run resumes where it stopped
+        cache = None
+        if cache_folder is not None:
+            cache = DocumentCache(cache_folder, anonymization=to_anonymize)
 
+        if workers > 1 and small_number <= 0:
+            ## the workers tokenize and tag one document at a time, the documents are merged in the serial order below
+            processed_documents = process_documents_parallel(filenames, input_folder, documents, pickle_folder, workers, cache)
+        else:
+            processed_documents = self.process_documents_serial(filenames, input_folder, documents, interval, cache)
+
+        for (doc_id, NER_document_tokens, entity_dictionary, other_dictionary) in processed_documents:
+            (set, kind, _, _) = documents[doc_id]
             doc = Document(
                 doc_id, set, kind, NER_document_tokens, qaps[doc_id], entity_dictionary,other_dictionary,candidates_per_doc[doc_id],ner_candidates_per_doc[doc_id], pos_candidates_per_doc[doc_id])
 
-            
-            if (file_number+1) % interval == 0:
-                print("Processed {} documents".format(file_number+1))
-
             # If testing, add to test list, pickle and return when sufficient documents retrieved
             if small_number > 0:
                 small_docs.append(doc)
@@ -627,10 +798,27 @@ class DataLoader():
 
         return NER_sent
 
+    def process_documents_serial(self, filenames, input_folder, documents, interval=50, cache=None):
+        for file_number in range(len(filenames)):
+            filename=filenames[file_number]
+            doc_id = os.path.basename(filename).replace(".content", "")
+            print("Processing:{0}".format(doc_id))
+            (set, kind, start_tag, end_tag) = documents[doc_id]
+            NER_document_tokens, entity_dictionary, other_dictionary = process_document_cached(self.nlp, cache, input_folder, doc_id, kind, start_tag, end_tag)
+
+            if (file_number+1) % interval == 0:
+                print("Processed {} documents".format(file_number+1))
+            yield doc_id, NER_document_tokens, entity_dictionary, other_dictionary
+
     def getNER(self,string_data):
         string_data = string_data.decode('utf-8')
-        doc = self.nlp(string_data)
+        return self.get_tags(self.nlp(string_data))
+
+    def getNER_batch(self, strings, batch_size=1000):
+        strings = [string_data.decode('utf-8') for string_data in strings]
+        return [self.get_tags(doc) for doc in self.nlp.pipe(strings, batch_size=batch_size)]
 
+    def get_tags(self, doc):
         pos_tags = []
         ner_tags = []
         tokens = []
@@ -666,6 +854,12 @@ class DataLoader():
             anonymize_summary = True
             assert len(summary_documents) == len(documents)
 
+        if self.vocab.pruned() and not self.vocab.frozen:
+            ## the words of the first documents loaded (the training set) make up the vocabulary
+            self.vocab.build(word for document in documents
+                             for words in [query.question_tokens for query in document.queries] + document.candidates[0::2]
+                             for word in words)
+
         for index,document in enumerate(documents):
 
             # self.replace_entities(document.entity_dictionary, document.other_dictionary,document.document_tokens)
@@ -690,16 +884,14 @@ class DataLoader():
 
             candidate_per_doc = list(candidate_per_doc_per_answer)
 
+            ## bleu of every candidate against every other one, computed once for all queries of the document
+            bleu1_per_doc, _ = self.performance.bleu_matrix(candidate_per_doc, candidate_per_doc)
+
             for query in document.queries:
 
                 #computing bleu with respect to the first correct answer
-                metrics = []
                 #Pick alternate candidates as they are the first answers
-
-                for candidate_tokens in candidate_per_doc:
-                    self.performance.computeMetrics(candidate_tokens, [candidate_per_doc[query.answer_indices[0] / 2]])
-                    metrics.append(1.0 - self.performance.bleu1)
-                    i+= 2
+                metrics = [1.0 - bleu1[query.answer_indices[0] / 2] for bleu1 in bleu1_per_doc]
 
                 metrics_per_doc.append(metrics)
 
@@ -721,91 +913,102 @@ class DataLoader():
 
         return data_points
 
-    def load_documents_split_sentences(self, documents):
-        data_points = []
+    def load_elmo_split(self, source_path, embedding_store=None, dtype="float16", split=True):
+        ## load_documents_elmo of the ELMo pickle at source_path, which is only read when there is no valid store
+        return self.load_embedded_split(self.load_documents_elmo, source_path, embedding_store, dtype, split=split)
+
+    def load_reduced_split(self, source_path, embedding_store=None, dtype="float16"):
+        ## load_documents_split_sentences of the ELMo pickle at source_path; the retrieved chunks depend on the tfidf index
+        tfidf_index = file_digest(self.tfidf_index_path).hexdigest() if self.corpus_tfidf else None
+        return self.load_embedded_split(self.load_documents_split_sentences, source_path, embedding_store, dtype,
+                                        key=(tfidf_index,))
+
+    def load_embedded_split(self, load_documents, source_path, embedding_store, dtype, key=(), **settings):
+        """
+        Runs load_documents on the ELMo pickle at source_path, or reuses the stores written by an earlier run. Next to
+        the .context and .candidates stores, <embedding_store>.meta keeps everything else load_documents returned and
+        the vocabulary after loading, so a valid store never needs the pickle. A store is valid when it was built
+        from the same file (path, size and modification time), settings and vocabulary.
+        """
+        fingerprint = None
+        if embedding_store is not None:
+            fingerprint = source_fingerprint(source_path, load_documents.__name__, dtype, sorted(settings.items()),
+                                             self.vocab.digest(), key)
+            outputs = self.load_store_outputs(embedding_store, fingerprint)
+            if outputs is not None:
+                print("Reusing embedding store {0}".format(embedding_store))
+                return outputs
+        with open(source_path, "rb") as fin:
+            documents = pickle.load(fin)
+        outputs = load_documents(documents, embedding_store=embedding_store, dtype=dtype, fingerprint=fingerprint, **settings)
+        del documents
+        if embedding_store is not None:
+            self.save_store_outputs(embedding_store, fingerprint, outputs)
+        return outputs
+
+    def load_store_outputs(self, embedding_store, fingerprint):
+        paths = [embedding_store + ".context", embedding_store + ".candidates"]
+        if not os.path.exists(embedding_store + ".meta") or not all(EmbeddingStore.exists(path) for path in paths):
+            return None
+        with open(embedding_store + ".meta", "rb") as fin:
+            meta_fingerprint, vocab, outputs = pickle.load(fin)
+        if meta_fingerprint != fingerprint or not all(EmbeddingStore(path).fingerprint == fingerprint for path in paths):
+            print("Rebuilding embedding store {0}, it was built from another file or with other settings".format(embedding_store))
+            return None
+        self.vocab = vocab
+        return tuple(EmbeddingStore(value) if kind == "store" else value for kind, value in outputs)
+
+    def save_store_outputs(self, embedding_store, fingerprint, outputs):
+        ## the stores are referenced by path; the meta file is written last, so it only exists for complete stores
+        outputs = [("store", value.path) if isinstance(value, EmbeddingStore) else ("value", value) for value in outputs]
+        with open(embedding_store + ".meta.tmp", "wb") as fout:
+            pickle.dump((fingerprint, self.vocab, outputs), fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(embedding_store + ".meta.tmp", embedding_store + ".meta")
+
+    def open_embedding_stores(self, embedding_store, dtype, fingerprint):
+        return EmbeddingStoreWriter(embedding_store + ".context", dtype, fingerprint), \
+               EmbeddingStoreWriter(embedding_store + ".candidates", dtype, fingerprint)
+
+    def load_tfidf_index(self, path, documents_path):
+        ## corpus level tfidf vocabulary and idf for load_documents_split_sentences, fitted once on the chunks of
+        ## the documents pickled at documents_path and saved to path, or loaded from path if it exists
+        if os.path.exists(path):
+            self.tfidf.load(path)
+        else:
+            with open(documents_path, "rb") as fin:
+                documents = pickle.load(fin)
+            self.tfidf.reset()
+            for document in documents:
+                self.tfidf.partial_fit(split_chunks(document.document_tokens)[1])
+            del documents
+            self.tfidf.save(path)
+        self.corpus_tfidf = True
+        self.tfidf_index_path = path
+        print("Tfidf index of {0} chunks, {1} terms".format(self.tfidf.num_documents, len(self.tfidf.vocabulary)))
+
+    def load_documents_split_sentences(self, documents, embedding_store=None, dtype="float16", fingerprint=None):
+        dataset = ElmoDatasetBuilder()
         candidates_embed_docid = {}
         candidate_per_docid = {}
         context_per_docid = {}
+        if embedding_store is not None:
+            context_per_docid, candidates_embed_docid = self.open_embedding_stores(embedding_store, dtype, fingerprint)
         for index,document in enumerate(documents):
             print(index)
-            original_sentences = document.document_tokens
-            chunk_length = 40
             num_chunks = 10
-
-            ## each sentence should be fewer than 40 tokens long
-            sentences = []
-            for e, sent in enumerate(original_sentences):
-                if len(sent) > chunk_length:
-                    position = 0
-                    position_index = 0
-                    while position < len(sent):
-                        sentences.append(sent[position_index * chunk_length:(position_index + 1) * chunk_length])
-                        position_index += 1
-                        position += chunk_length
-                else:
-                    sentences.append(sent)
-
-            chunk_storage = []
-            concat_chunk_storage= []
-            # sentence_boundaries_storage = []
-            chunk_boundaries_storage = []
-            e = 0
-            rolling_index = 0
-            while e < len(sentences):
-                previous_size = 0
-                current_chunk_size = 0
-                current_chunk = []
-                sentence_boundaries = []
-                while e < len(sentences) and current_chunk_size < chunk_length:
-                    current_chunk += sentences[e]
-                    previous_size = current_chunk_size
-                    current_chunk_size += len(sentences[e])
-                    sentence_boundaries.append(previous_size)
-                    e += 1
-                ## guard against previous size being zero, guard against sentence size >= chunk_size, gaurd against e-=1 infinite loop
-                if abs(chunk_length - previous_size) < abs(current_chunk_size - chunk_length) and e != len(sentences):
-                    current_chunk = current_chunk[:previous_size]
-                    sentence_boundaries = sentence_boundaries[:-1]
-                    ## restart from the previous chunk in this case
-                    e -= 1
-                    if len(current_chunk) > 0:
-                        chunk_storage.append(current_chunk)
-                        concat_chunk_storage.append(" ".join(current_chunk))
-                        chunk_boundaries_storage.append([rolling_index, rolling_index + len(current_chunk)])
-                        rolling_index += len(current_chunk)
-                        # sentence_boundaries_storage.append(sentence_boundaries)
-                else:
-                    ## if out of sentences, use the last chunk as is
-                    if len(current_chunk) > 0:
-                        chunk_storage.append(current_chunk)
-                        concat_chunk_storage.append(" ".join(current_chunk))
-                        chunk_boundaries_storage.append([rolling_index, rolling_index + len(current_chunk)])
-                        rolling_index += len(current_chunk)
-                        # sentence_boundaries_storage.append(sentence_boundaries)
+            chunk_storage, concat_chunk_storage, chunk_boundaries_storage = split_chunks(document.document_tokens)
 
             top_chunks = []
             top_chunks_ids = []
 
             true_candidates = [document.candidates[i] for i in range(0, len(document.candidates), 2)]
 
-            length = len(chunk_storage)
-            ## append queries to the end of the vector
-            for reference in true_candidates:
-                chunk_storage.append(reference)
-                concat_chunk_storage.append(" ".join(reference))
-
-            vectorizer = CountVectorizer(preprocessor=self.lemmatizer.lemmatize, stop_words=self.stop_words,
-                                         ngram_range=(1, 2))
-            transformer = TfidfTransformer(sublinear_tf=True)
-            counts = vectorizer.fit_transform(concat_chunk_storage)
-            tfidf = transformer.fit_transform(counts)
-            chunk_docs = tfidf[0:length]
-            reference_docs = tfidf[length:]
-            related_docs_indices = linear_kernel(reference_docs, chunk_docs).argsort()[:, -num_chunks:]
+            ## the vectorizer is only refitted on the document when no corpus level index was loaded
+            concat_true_candidates = [" ".join(reference) for reference in true_candidates]
+            related_docs_indices = self.tfidf.top_k(concat_true_candidates, concat_chunk_storage, num_chunks, fit=not self.corpus_tfidf)
             for idx in range(len(true_candidates)):
                 chunks_per_ref = []
-                doc_ids = related_docs_indices[idx][::-1]
-                doc_ids = sorted(doc_ids)
+                doc_ids = sorted(related_docs_indices[idx])
                 for doc_id in doc_ids:
                     ## these have to be time ordered so that she can just concatenate
                     chunks_per_ref.append(chunk_boundaries_storage[doc_id])
@@ -827,33 +1030,37 @@ class DataLoader():
                 candidate_per_doc_per_answer_embed.append(document.candidates_embed[i])
                 i += 2
 
-            for query in document.qaps:
-                query.question_tokens = self.vocab.add_and_get_indices(query.question_tokens)
-                candidate_per_doc_per_answer[query.answer_indices[0] / 2] = self.vocab.add_and_get_indices(
-                    candidate_per_doc_per_answer[query.answer_indices[0] / 2])
+            document_index = dataset.add_document(document.id, [self.vocab.add_and_get_indices(answer)
+                                                                 for answer in candidate_per_doc_per_answer])
 
             candidate_answer_lengths = [len(answer) for answer in candidate_per_doc_per_answer]
             max_candidate_length = max(candidate_answer_lengths)
-            candidate_padded_answers_embed = np.array(
-                [pad_seq_elmo(answer, max_candidate_length) for answer in candidate_per_doc_per_answer_embed])
+            candidate_padded_answers_embed = pad_embeddings(candidate_per_doc_per_answer_embed, max_candidate_length)
 
             candidates_embed_docid[document.id] = candidate_padded_answers_embed
+            if embedding_store is not None:
+                ## the store owns the embeddings now
+                document.document_embed = None
+                document.candidates_embed = None
 
             for idx, query in enumerate(document.qaps):
-                query.answer_indices[0] = query.answer_indices[0] / 2
-                data_points.append(Elmo_Data_Point
-                                   (query.question_tokens, query.query_embed, query.answer_indices,
-                                    [], [], candidate_per_doc_per_answer, [], document.id, top_chunks[idx]))
+                dataset.add_question(document_index, self.vocab.add_and_get_indices(query.question_tokens),
+                                     query.query_embed, query.answer_indices[0] // 2, top_chunks[idx])
 
-        return data_points, candidates_embed_docid, context_per_docid
+        if embedding_store is not None:
+            context_per_docid = context_per_docid.close()
+            candidates_embed_docid = candidates_embed_docid.close()
+        return dataset.close(), candidates_embed_docid, context_per_docid
 
-    def load_documents_elmo(self, documents, split=True):
-        data_points = []
+    def load_documents_elmo(self, documents, split=True, embedding_store=None, dtype="float16", fingerprint=None):
+        dataset = ElmoDatasetBuilder()
         candidates_embed_docid = {}
         candidate_per_docid = {}
         context_per_docid = {}
         sentence_mask_doc_id = {}
         sentence_lengths_doc = {}
+        if embedding_store is not None:
+            context_per_docid, candidates_embed_docid = self.open_embedding_stores(embedding_store, dtype, fingerprint)
         for index, document in enumerate(documents):
 
             document_tokens = []
@@ -868,13 +1075,9 @@ class DataLoader():
 
 
             max_sentence_length = max(sentence_lengths)
-            sentence_padded_embed = np.array(
-                [pad_seq_elmo(sent, max_sentence_length) for sent in document.document_embed])
-            sentence_mask_doc_id[document.id] = np.array([[int(x < sentence_lengths[i])
-                                                  for x in range(max_sentence_length)] for i in
-                                                 range(len(sentence_lengths))])
+            sentence_mask_doc_id[document.id] = length_mask(sentence_lengths, max_sentence_length)
             if split:
-                context_per_docid[document.id] = sentence_padded_embed
+                context_per_docid[document.id] = pad_embeddings(document.document_embed, max_sentence_length)
             else:
                 context_per_docid[document.id] = np.concatenate(document.document_embed)
 
@@ -895,76 +1098,21 @@ class DataLoader():
 
             candidate_answer_lengths = [len(answer) for answer in candidate_per_doc_per_answer]
             max_candidate_length = max(candidate_answer_lengths)
-            candidate_padded_answers_embed = np.array(
-                [pad_seq_elmo(answer, max_candidate_length) for answer in candidate_per_doc_per_answer_embed])
+            candidate_padded_answers_embed = pad_embeddings(candidate_per_doc_per_answer_embed, max_candidate_length)
 
             candidates_embed_docid[document.id] = candidate_padded_answers_embed
+            if embedding_store is not None:
+                ## the store owns the embeddings now
+                document.document_embed = None
+                document.candidates_embed = None
             candidate_per_docid[document.id] = candidate_per_doc_per_answer
+            document_index = dataset.add_document(document.id, [self.vocab.add_and_get_indices(answer)
+                                                                 for answer in candidate_per_doc_per_answer])
             for idx, query in enumerate(document.qaps):
-                query.answer_indices[0] = query.answer_indices[0] / 2
-                data_points.append(Elmo_Data_Point
-                                   (query.question_tokens, query.query_embed, query.answer_indices,
-                                    [], [], candidate_per_doc_per_answer, [], document.id))
-
-        return data_points, candidates_embed_docid,candidate_per_docid, context_per_docid, sentence_mask_doc_id, sentence_lengths_doc
-
-
-class Vocabulary(object):
-    def __init__(self, pad_token='pad', unk='unk', sos='<sos>',eos='<eos>' ):
-
-        self.vocabulary = dict()
-        self.id_to_vocab = dict()
-        self.pad_token = pad_token
-        self.unk = unk
-        self.vocabulary[pad_token] = 0
-        self.vocabulary[unk] = 1
-        self.vocabulary[sos] = 2
-        self.vocabulary[eos] = 3
-
-        self.id_to_vocab[0] = pad_token
-        self.id_to_vocab[1] = unk
-        self.id_to_vocab[2] = sos
-        self.id_to_vocab[3] = eos
-
-        self.nertag_to_id = dict()
-        self.postag_to_id = dict()
-        self.id_to_nertag = dict()
-        self.id_to_postag = dict()
-
-
-    def add_and_get_index(self, word):
-        if word in self.vocabulary:
-            return self.vocabulary[word]
-        else:
-            length = len(self.vocabulary)
-            self.vocabulary[word] = length
-            self.id_to_vocab[length] = word
-            return length
-
-    def add_and_get_indices(self, words):
-        return [self.add_and_get_index(word) for word in words]
-
-    def get_index(self, word):
-        return self.vocabulary.get(word, self.vocabulary[self.unk])
-
-    def get_length(self):
-        return len(self.vocabulary)
-
-    def get_word(self,index):
-        if index < len(self.id_to_vocab):
-            return self.id_to_vocab[index]
-        else:
-            return ""
-
-    def ner_tag_size(self):
-        return len(self.nertag_to_id)
-
-    def pos_tag_size(self):
-        return len(self.postag_to_id)
-
-    def add_and_get_indices_NER(self, words):
-        return [self.add_and_get_index_NER(str(word)) for word in words]
-
-    def add_and_get_indices_POS(self, words):
-        return [self.add_and_get_index_POS(str(word)) for word in words]
+                dataset.add_question(document_index, self.vocab.add_and_get_indices(query.question_tokens),
+                                     query.query_embed, query.answer_indices[0] // 2)
 
+        if embedding_store is not None:
+            context_per_docid = context_per_docid.close()
+            candidates_embed_docid = candidates_embed_docid.close()
+        return dataset.close(), candidates_embed_docid,candidate_per_docid, context_per_docid, sentence_mask_doc_id, sentence_lengths_doc
@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import torch
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+
+class EmbeddingStore(object):
+    """
+    Read-only, dict-like view over per-document embedding matrices that are stored back to back in a single
+    memory-mapped file. Documents are only paged in when they are sliced, and the page cache is shared between
+    all processes that open the same store.
+
+    <path>.data  : contiguous array of all matrices (float16 or float32)
+    <path>.index : pickled (dtype, {doc_id: (offset, shape)}, fingerprint), offsets are counted in elements and the
+                   fingerprint identifies the documents and settings the store was built from
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".index", "rb") as fin:
+            state = pickle.load(fin)
+        ## stores written before fingerprints were kept have none and never match
+        self.dtype, self.index = state[:2]
+        self.fingerprint = state[2] if len(state) > 2 else None
+        self.dtype = np.dtype(self.dtype)
+        if os.path.getsize(path + ".data") > 0:
+            ## copy on write: slices are writable (torch.from_numpy needs that) but the file is never modified
+            self.data = np.memmap(path + ".data", dtype=self.dtype, mode="c")
+        else:
+            self.data = np.zeros(0, dtype=self.dtype)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + ".index") and os.path.exists(path + ".data")
+
+    def __getitem__(self, doc_id):
+        offset, shape = self.index[doc_id]
+        size = int(np.prod(shape))
+        return self.data[offset:offset + size].reshape(shape)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
+class EmbeddingStoreWriter(object):
+    """
+    Appends matrices to an embedding store one document at a time, so the full split never has to be held in
+    memory. Supports item assignment like the dicts it replaces; close() returns the finished EmbeddingStore.
+    """
+    def __init__(self, path, dtype="float16", fingerprint=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.fingerprint = fingerprint
+        self.index = {}
+        self.offset = 0
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.fout = open(path + ".data.tmp", "wb")
+
+    def __setitem__(self, doc_id, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        array.tofile(self.fout)
+        self.index[doc_id] = (self.offset, array.shape)
+        self.offset += array.size
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def close(self):
+        self.fout.close()
+        with open(self.path + ".index.tmp", "wb") as fout:
+            pickle.dump((self.dtype.str, self.index, self.fingerprint), fout, pickle.HIGHEST_PROTOCOL)
+        ## the index is renamed last, so a store without an index is never mistaken for a complete one
+        os.rename(self.path + ".data.tmp", self.path + ".data")
+        os.rename(self.path + ".index.tmp", self.path + ".index")
+        return EmbeddingStore(self.path)
+
+
+def to_tensor(array):
+    ## float32 slices of the store are shared with the memory map, float16 slices are widened to float32 here
+    return torch.from_numpy(np.ascontiguousarray(array)).float()
+
+
+class ChunkGatherer(object):
+    """
+    Builds the reduced context of a question (the rows of the retrieved chunks, in order) with one fancy-index
+    instead of concatenating Python lists. Only the index arrays are cached per chunk set, in a small LRU: reduced
+    chunk sets are rarely repeated across questions, and a cached float32 context of ~8 MB would cost more memory than
+    the float16 store saves. gather keeps the rows in the dtype of the store until the batch is built.
+    """
+    def __init__(self, context_per_docid, cache_size=512):
+        self.context_per_docid = context_per_docid
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def indices(self, ranges):
+        key = tuple((int(r[0]), int(r[1])) for r in ranges)
+        if key in self.cache:
+            ## re-insert to mark as most recently used
+            index = self.cache.pop(key)
+            self.cache[key] = index
+            return index
+        if len(key) == 0:
+            index = np.zeros(0, dtype=np.int64)
+        else:
+            index = np.concatenate([np.arange(start, end) for start, end in key])
+        if self.cache_size > 0:
+            self.cache[key] = index
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return index
+
+    def gather(self, doc_id, ranges):
+        return self.context_per_docid[doc_id][self.indices(ranges)]
+
+    def __call__(self, doc_id, ranges):
+        return to_tensor(self.gather(doc_id, ranges))
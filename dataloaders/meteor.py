@@ -4,6 +4,15 @@
 import subprocess, threading
 
 
+def meteor_command(path, language="en"):
+	return "java -Xmx2G -jar " + path + "meteor-*.jar - - -l " + language + " -stdio"
+
+
+def start_meteor_process(command):
+	return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+							shell=True, universal_newlines=True)
+
+
 class MeteorError(Exception):
 	def __init__(self, value):
 		self.value = value
@@ -19,7 +28,7 @@ class MeteorScorer():
 	installation. They need to be specified as follows:"meteor_language=lg,meteor_path=path" (any order).
 	"""
 
-	def __init__(self, path, language = "en"):
+	def __init__(self, path, language = "en", command = None):
 
 		# Lock for the METEOR process, which can only handle one request at a time:
 		self.lock = threading.Lock()
@@ -28,10 +37,10 @@ class MeteorScorer():
 		self._meteor_language = language
 		self._meteor_path = path
 
-		# Start a METEOR process:
-		command = "java -Xmx2G -jar " + self._meteor_path + "meteor-*.jar - - -l " + self._meteor_language + " -stdio"
-		self.meteor_process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-											   stderr=subprocess.PIPE, shell=True)
+		# Start a METEOR process (any command that speaks the METEOR -stdio protocol can stand in for it):
+		if command is None:
+			command = meteor_command(self._meteor_path, self._meteor_language)
+		self.meteor_process = start_meteor_process(command)
 
 	def set_reference(self, reference_tokens):
 		"""
@@ -79,6 +88,7 @@ class MeteorReference():
 		try:
 			self._meteor_scorer.meteor_process.stdin.write(
 				"SCORE ||| " + self._reference_string + " ||| " + hypothesis_string + "\n")
+			self._meteor_scorer.meteor_process.stdin.flush()
 		except:
 			raise MeteorError(
 				"Meteor returned the following error: " + self._meteor_scorer.meteor_process.stderr.readline().strip())
@@ -89,6 +99,7 @@ class MeteorReference():
 		# Pass feature values to METEOR process for computation of the final score
 		try:
 			self._meteor_scorer.meteor_process.stdin.write("EVAL ||| " + std_out)
+			self._meteor_scorer.meteor_process.stdin.flush()
 		except:
 			raise MeteorError(
 				"Meteor returned the following error: " + self._meteor_scorer.meteor_process.stderr.readline().strip())
@@ -112,4 +123,107 @@ class MeteorReference():
 		Scores every hypothesis in @param hypotheses against this reference.
 		@param hypothesis_matrix an iterable of iterables of tokens.
 		"""
-		return [self.score(hypothesis_tokens) for hypothesis_tokens in hypothesis_matrix]
\ No newline at end of file
+		return [self.score(hypothesis_tokens) for hypothesis_tokens in hypothesis_matrix]
+
+
+class MeteorScorerPool():
+	"""
+	Keeps K METEOR processes alive and scores batches of (reference, hypothesis) pairs on all of them at once.
+	Each process gets a contiguous share of the pairs; all its SCORE lines are written before the statistics are
+	read back (a writer thread keeps the pipes from filling up), then the same is done for the EVAL lines.
+	"""
+
+	def __init__(self, path, language = "en", processes = 4, command = None):
+		if command is None:
+			command = meteor_command(path, language)
+		self.meteor_processes = [start_meteor_process(command) for _ in range(max(1, processes))]
+		# Lock for the whole pool, one batch is scored at a time:
+		self.lock = threading.Lock()
+
+	def _request(self, process, lines):
+		## write every request of the batch while reading the responses, one response line per request line
+		def write():
+			try:
+				for line in lines:
+					process.stdin.write(line)
+				process.stdin.flush()
+			except (IOError, OSError, ValueError):
+				pass
+		writer = threading.Thread(target=write)
+		writer.daemon = True
+		writer.start()
+		responses = []
+		for _ in lines:
+			response = process.stdout.readline()
+			if response == "":
+				raise MeteorError("Meteor returned the following error: " + process.stderr.readline().strip())
+			responses.append(response)
+		writer.join()
+		return responses
+
+	def _score_shard(self, process, pairs, scores, offset, errors):
+		try:
+			stats = self._request(process, ["SCORE ||| " + " ".join(reference) + " ||| " + " ".join(hypothesis) + "\n"
+											for reference, hypothesis in pairs])
+			values = self._request(process, ["EVAL ||| " + line for line in stats])
+			for index, value in enumerate(values):
+				try:
+					scores[offset + index] = float(value)
+				except ValueError:
+					raise MeteorError("Meteor returned the following error: " + value.strip())
+		except Exception as e:
+			errors.append(e)
+
+	def score_pairs(self, pairs):
+		"""
+		Scores every (reference_tokens, hypothesis_tokens) pair, returns the scores in the same order.
+		"""
+		pairs = list(pairs)
+		scores = [0.0] * len(pairs)
+		errors = []
+		shard_size = (len(pairs) + len(self.meteor_processes) - 1) // len(self.meteor_processes)
+		with self.lock:
+			threads = []
+			for index, process in enumerate(self.meteor_processes):
+				offset = index * shard_size
+				if offset >= len(pairs):
+					break
+				thread = threading.Thread(target=self._score_shard,
+										  args=(process, pairs[offset:offset + shard_size], scores, offset, errors))
+				thread.start()
+				threads.append(thread)
+			for thread in threads:
+				thread.join()
+		if len(errors) > 0:
+			raise errors[0]
+		return scores
+
+	def score_batch(self, batch):
+		"""
+		Scores a list of (reference_tokens, hypotheses) entries, where hypotheses is a list of token lists.
+		Returns one list of scores per entry, like MeteorReference.score_matrix does for a single reference.
+		"""
+		batch = list(batch)
+		pairs = [(reference, hypothesis) for reference, hypotheses in batch for hypothesis in hypotheses]
+		scores = self.score_pairs(pairs)
+		results = []
+		offset = 0
+		for reference, hypotheses in batch:
+			results.append(scores[offset:offset + len(hypotheses)])
+			offset += len(hypotheses)
+		return results
+
+	def terminate_processes(self):
+		"""
+		Waits for the current batch to be scored and terminates the METEOR processes.
+		"""
+		with self.lock:
+			for process in self.meteor_processes:
+				process.terminate()
+
+	def kill_processes(self):
+		"""
+		Kills the METEOR processes right away.
+		"""
+		for process in self.meteor_processes:
+			process.kill()
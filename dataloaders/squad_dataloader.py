@@ -9,6 +9,7 @@ import pickle
 import argparse
 import random
 from test_metrics import Performance
+from vocabulary import Vocabulary
 
 class SquadDataloader():
 	def __init__(self, args):
@@ -121,11 +122,8 @@ class SquadDataloader():
 			## correct answer:
 			candidate_per_question = [correct_answer] + candidate_per_question
 			anonymized_candidates_per_question = [anonymized_correct_answer] + anonymized_candidates_per_question
-			metrics = []
-
-			for candidate in candidate_per_question:
-				self.performance.computeMetrics(candidate, [correct_answer])
-				metrics.append(1.0-self.performance.bleu1)
+			bleu1, _ = self.performance.bleu_matrix(candidate_per_question, [correct_answer])
+			metrics = [1.0 - row[0] for row in bleu1]
 
 			final_data_points.append(Data_Point(q_tokens, [0], anonymized_candidates_per_question, metrics, [], [], [], [] ,c_tokens))
 		return final_data_points
@@ -171,84 +169,6 @@ class SquadDataloader():
 			pickle.dump(data_points, fout)
 
 
-class Vocabulary(object):
-    def __init__(self, pad_token='pad', unk='unk', sos='<sos>',eos='<eos>' ):
-
-        self.vocabulary = dict()
-        self.id_to_vocab = dict()
-        self.pad_token = pad_token
-        self.unk = unk
-        self.vocabulary[pad_token] = 0
-        self.vocabulary[unk] = 1
-        self.vocabulary[sos] = 2
-        self.vocabulary[eos] = 3
-
-        self.id_to_vocab[0] = pad_token
-        self.id_to_vocab[1] = unk
-        self.id_to_vocab[2] = sos
-        self.id_to_vocab[3] = eos
-
-        self.nertag_to_id = dict()
-        self.postag_to_id = dict()
-        self.id_to_nertag = dict()
-        self.id_to_postag = dict()
-
-
-    def add_and_get_index(self, word):
-        if word in self.vocabulary:
-            return self.vocabulary[word]
-        else:
-            length = len(self.vocabulary)
-            self.vocabulary[word] = length
-            self.id_to_vocab[length] = word
-            return length
-
-    def add_and_get_indices(self, words):
-        return [self.add_and_get_index(word) for word in words]
-
-    def get_index(self, word):
-        return self.vocabulary.get(word, self.vocabulary[self.unk])
-
-    def get_length(self):
-        return len(self.vocabulary)
-
-    def get_word(self,index):
-        if index < len(self.id_to_vocab):
-            return self.id_to_vocab[index]
-        else:
-            return ""
-
-    def ner_tag_size(self):
-        return len(self.nertag_to_id)
-
-    def pos_tag_size(self):
-        return len(self.postag_to_id)
-
-    def add_and_get_indices_NER(self, words):
-        return [self.add_and_get_index_NER(str(word)) for word in words]
-
-    def add_and_get_indices_POS(self, words):
-        return [self.add_and_get_index_POS(str(word)) for word in words]
-
-    def add_and_get_index_NER(self, word):
-        if word in self.nertag_to_id:
-            return self.nertag_to_id[word]
-        else:
-            length = len(self.nertag_to_id)
-            self.nertag_to_id[word] = length
-            self.id_to_nertag[length] = word
-            return length
-
-    def add_and_get_index_POS(self, word):
-        if word in self.postag_to_id:
-            return self.postag_to_id[word]
-        else:
-            length = len(self.postag_to_id)
-            self.postag_to_id[word] = length
-            self.id_to_postag[length] = word
-            return length
-
-
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 
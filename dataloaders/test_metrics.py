@@ -1,10 +1,76 @@
 import math
 import operator
+from functools import reduce
+import numpy as np
 
-#from rougescore import rouge_l
 import nltk
 
 
+def lcs_masks(tokens):
+	## bit i of masks[token] is set when tokens[i] == token
+	masks = {}
+	for i, token in enumerate(tokens):
+		masks[token] = masks.get(token, 0) | (1 << i)
+	return masks
+
+def lcs_length(masks, length, tokens):
+	"""
+	Length of the longest common subsequence of a sequence of ``length`` tokens, given as its ``lcs_masks``, and
+	``tokens``. Bit-parallel (Allison and Dix): the whole DP column is one integer, updated once per token.
+	"""
+	all_bits = (1 << length) - 1
+	V = all_bits
+	for token in tokens:
+		U = V & masks.get(token, 0)
+		V = ((V + U) | (V - U)) & all_bits
+	## every zero bit of V is one step of the LCS
+	return length - bin(V).count("1")
+
+def rouge_l_batch(predictions, references, beta=1.2):
+	"""
+	ROUGE-L F-measure of every prediction (a token list) against its references (a list of token lists), with
+	precision and recall maximized over the references separately as in the coco-caption scorer.
+	"""
+	scores = []
+	for prediction, prediction_references in zip(predictions, references):
+		if len(prediction) == 0:
+			scores.append(0.0)
+			continue
+		masks = lcs_masks(prediction)
+		precision = 0.0
+		recall = 0.0
+		for reference in prediction_references:
+			if len(reference) == 0:
+				continue
+			lcs = lcs_length(masks, len(prediction), reference)
+			precision = max(precision, float(lcs) / len(prediction))
+			recall = max(recall, float(lcs) / len(reference))
+		if precision != 0 and recall != 0:
+			scores.append(((1 + beta ** 2) * precision * recall) / float(recall + beta ** 2 * precision))
+		else:
+			scores.append(0.0)
+	return scores
+
+def rouge_l(prediction, references, beta=1.2):
+	return rouge_l_batch([prediction], [references], beta)[0]
+
+def clean_output(token_string):
+	index_EOS = token_string.find("EOS_TOKEN")
+	token_string = token_string[:index_EOS].lower().split()
+
+	tokens = [p for p in token_string]
+	# remove one full stop at the end
+	if len(tokens) > 0 and tokens[-1] == ".":
+		tokens = tokens[:-1]
+	if len(tokens) == 0:
+		return [""]
+	else: return tokens
+
+def cleaned_words(tokens):
+	## a token list as Performance scores it: cleaned by clean_output, joined and split again
+	return " ".join(clean_output(" ".join(tokens))).split()
+
+
 # note that all metrics are implemented for a single question and we will have to average over all questions to get the final output of performance
 # hence I add a provision to __add__ to a Performance object to keep aggregating the results and a __divide__ method to scale it down finally by the
 # number of objects
@@ -23,6 +89,57 @@ class Performance():
 
 
 
+	def bleu_matrix(self, predictions, references):
+		"""
+		BLEU-1 and BLEU-4 of every prediction against every single reference, as two len(predictions) x len(references)
+		lists. Entry [i][j] is bit-identical to the bleu1/bleu4 set by computeMetrics(predictions[i], [references[j]]),
+		but every string is cleaned and split into n-grams once, and the clipped counts are taken for all pairs at once.
+		"""
+		prediction_words = [cleaned_words(p) for p in predictions]
+		reference_words = [cleaned_words(r) for r in references]
+		bleu1 = np.zeros((len(predictions), len(references)))
+		bleu4 = np.zeros((len(predictions), len(references)))
+		if len(references) > 0:
+			## BLEU_4 uses n = min(4, prediction length), so predictions are grouped by their n
+			for n in range(1, 5):
+				rows = [i for i, words in enumerate(prediction_words) if min(4, len(words)) == n]
+				if len(rows) > 0:
+					bleu4[rows] = self.bleu_ngram_matrix([prediction_words[i] for i in rows], reference_words, n)
+			rows = [i for i, words in enumerate(prediction_words) if len(words) > 0]
+			if len(rows) > 0:
+				bleu1[rows] = self.bleu_ngram_matrix([prediction_words[i] for i in rows], reference_words, 1)
+		return bleu1.tolist(), bleu4.tolist()
+
+	def bleu_ngram_matrix(self, prediction_words, reference_words, n):
+		## n-grams are interned as tuples and mapped to ids, so counts become rows of a (sentences, ngrams) matrix
+		ngram_ids = {}
+		def ngram_rows(sentences):
+			return [[ngram_ids.setdefault(tuple(words[i:i + n]), len(ngram_ids)) for i in range(len(words) - n + 1)]
+					for words in sentences]
+		prediction_ids = ngram_rows(prediction_words)
+		reference_ids = ngram_rows(reference_words)
+		prediction_counts = np.zeros((len(prediction_ids), len(ngram_ids)), dtype=np.int64)
+		reference_counts = np.zeros((len(reference_ids), len(ngram_ids)), dtype=np.int64)
+		for row, ids in enumerate(prediction_ids):
+			np.add.at(prediction_counts[row], ids, 1)
+		for row, ids in enumerate(reference_ids):
+			np.add.at(reference_counts[row], ids, 1)
+
+		## (P, R) clipped counts, as clip_count computes them for one pair
+		clipped = np.minimum(prediction_counts[:, None, :], reference_counts[None, :, :]).sum(axis=-1)
+		count = np.array([len(words) - n + 1 for words in prediction_words], dtype=np.float64)
+		precision = np.where(clipped == 0, 0.0, clipped / count[:, None])
+
+		## brevity_penalty uses math.exp, so it is evaluated per distinct (prediction, reference) length pair
+		prediction_lengths = [len(words) for words in prediction_words]
+		reference_lengths = [len(words) for words in reference_words]
+		penalties = {}
+		for c in set(prediction_lengths):
+			for r in set(reference_lengths):
+				penalties[(c, r)] = self.brevity_penalty(c, r)
+		penalty = np.array([[penalties[(c, r)] for r in reference_lengths] for c in prediction_lengths], dtype=np.float64)
+		return precision * penalty
+
 	def computeMetrics(self, prediction, candidates):
 		self.prediction = self.clean_output(" ".join(prediction))
 		self.candidates = [self.clean_output(" ".join(c)) for c in candidates]
@@ -31,14 +148,14 @@ class Performance():
 		self.all_candidates = [[c] for c in self.joint_candidates]
 
 		self.compute_bleu()
-		# self.rouge = self.compute_rouge()
+		self.rouge = self.compute_rouge()
 		#self.meteor = self.compute_meteor()
 
 		self.meteor = 0.0
 		self.sum_bleu1 += self.bleu1
 		self.sum_bleu4 += self.bleu4
 
-		#self.sum_rouge += self.rouge
+		self.sum_rouge += self.rouge
 		#self.sum_meteor += self.meteor
 
 
@@ -58,8 +175,10 @@ class Performance():
 			self.bleu4 = 0.0
 			self.bleu = 0.0
 
-	def compute_rouge(self):
-		 return rouge_l(self.joint_prediction, self.joint_candidates, 0.5)
+	## beta was 0.5 with the rougescore package; it is now 1.2, as in the coco-caption scorer, so ROUGE-L weighs
+	## recall higher than precision and scores are not comparable with those of older runs
+	def compute_rouge(self, beta=1.2):
+		 return rouge_l(self.joint_prediction.split(), [c.split() for c in self.joint_candidates], beta)
 		 # rouge = Pythonrouge(summary=[[self.joint_prediction]], reference=[[self.joint_candidates]], summary_file_exist=False,
 		 # 					n_gram=0, ROUGE_SU4=False, ROUGE_L=True, f_measure_only=True,
 		 # 					recall_only=False, stemming=True, stopwords=True,
@@ -84,16 +203,7 @@ class Performance():
 			return 0.
 
 	def clean_output(self, token_string):
-		index_EOS = token_string.find("EOS_TOKEN")
-		token_string = token_string[:index_EOS].lower().split()
-
-		tokens = [p for p in token_string]
-		# remove one full stop at the end
-		if len(tokens) > 0 and tokens[-1] == ".":
-			tokens = tokens[:-1]
-		if len(tokens) == 0:
-			return [""]
-		else: return tokens
+		return clean_output(token_string)
 
 	def count_ngram(self,candidate, references, n):
 		clipped_count = 0
@@ -1,18 +1,18 @@
 import torch
+from torch import nn, optim
 from torch.autograd import Variable
 import codecs
 import numpy as np
 import math
+import os
+try:
+    import cPickle as pickle
+except:
+    import pickle
 
 PAD_token = 0
 SOS_token = 1
 EOS_token = 2
-start_tags_with_attributes = ["<scr'+'ipt", "<!--", "<!DOCTYPE", "<a", "<abbr", "<acronym", "<address", "<applet", "<area", "<article", "<aside", "<audio", "<b", "<base", "<basefont", "<bdi", "<bdo", "<big", "<blockquote", "<body", "<br", "<button", "<canvas", "<caption", "<center", "<cite", "<code", "<col", "<colgroup", "<datalist", "<dd", "<del", "<details", "<dfn", "<dialog", "<dir", "<div", "<dl", "<dt", "<em", "<embed", "<fieldset", "<figcaption", "<figure", "<font", "<footer", "<form", "<frame", "<frameset", "<h1", "<head", "<header", "<hr", "<html", "<i", "<iframe", "<img", "<input", "<ins", "<kbd", "<label", "<legend", "<li", "<link", "<main", "<map", "<mark", "<menu", "<menuitem", "<meta", "<meter", "<nav", "<noframes", "<noscript", "<object", "<ol", "<optgroup", "<option", "<output", "<p", "<param", "<picture", "<pre", "<progress", "<q", "<rp", "<rt", "<ruby", "<s", "<samp", "<script", "<section", "<select", "<small", "<source", "<span", "<strike", "<strong", "<style", "<sub", "<summary", "<sup", "<table", "<tbody", "<td", "<template", "<textarea", "<tfoot", "<th", "<thead", "<time", "<title", "<tr", "<track", "<tt", "<u", "<ul", "<var",
-                              "<video", "<wbr", "<SCR'+'IPT", "<!--", "<!DOCTYPE", "<A", "<ABBR", "<ACRONYM", "<ADDRESS", "<APPLET", "<AREA", "<ARTICLE", "<ASIDE", "<AUDIO", "<B", "<BASE", "<BASEFONT", "<BDI", "<BDO", "<BIG", "<BLOCKQUOTE", "<BODY", "<BR", "<BUTTON", "<CANVAS", "<CAPTION", "<CENTER", "<CITE", "<CODE", "<COL", "<COLGROUP", "<DATALIST", "<DD", "<DEL", "<DETAILS", "<DFN", "<DIALOG", "<DIR", "<DIV", "<DL", "<DT", "<EM", "<EMBED", "<FIELDSET", "<FIGCAPTION", "<FIGURE", "<FONT", "<FOOTER", "<FORM", "<FRAME", "<FRAMESET", "<H1", "<HEAD", "<HEADER", "<HR", "<HTML", "<I", "<IFRAME", "<IMG", "<INPUT", "<INS", "<KBD", "<LABEL", "<LEGEND", "<LI", "<LINK", "<MAIN", "<MAP", "<MARK", "<MENU", "<MENUITEM", "<META", "<METER", "<NAV", "<NOFRAMES", "<NOSCRIPT", "<OBJECT", "<OL", "<OPTGROUP", "<OPTION", "<OUTPUT", "<P", "<PARAM", "<PICTURE", "<PRE", "<PROGRESS", "<Q", "<RP", "<RT", "<RUBY", "<S", "<SAMP", "<SCRIPT", "<SECTION", "<SELECT", "<SMALL", "<SOURCE", "<SPAN", "<STRIKE", "<STRONG", "<STYLE", "<SUB", "<SUMMARY", "<SUP", "<TABLE", "<TBODY", "<TD", "<TEMPLATE", "<TEXTAREA", "<TFOOT", "<TH", "<THEAD", "<TIME", "<TITLE", "<TR", "<TRACK", "<TT", "<U", "<UL", "<VAR", "<VIDEO", "<WBR"]
-end_tags = ["</scr'+'ipt>", "</!DOCTYPE>", "</a>", "</abbr>", "</acronym>", "</address>", "</applet>", "</area>", "</article>", "</aside>", "</audio>", "</b>", "</base>", "</basefont>", "</bdi>", "</bdo>", "</big>", "</blockquote>", "</body>", "</br>", "</button>", "</canvas>", "</caption>", "</center>", "</cite>", "</code>", "</col>", "</colgroup>", "</datalist>", "</dd>", "</del>", "</details>", "</dfn>", "</dialog>", "</dir>", "</div>", "</dl>", "</dt>", "</em>", "</embed>", "</fieldset>", "</figcaption>", "</figure>", "</font>", "</footer>", "</form>", "</frame>", "</frameset>", "</h1>", "</head>", "</header>", "</hr>", "</html>", "</i>", "</iframe>", "</img>", "</input>", "</ins>", "</kbd>", "</label>", "</legend>", "</li>", "</link>", "</main>", "</map>", "</mark>", "</menu>", "</menuitem>", "</meta>", "</meter>", "</nav>", "</noframes>", "</noscript>", "</object>", "</ol>", "</optgroup>", "</option>", "</output>", "</p>", "</param>", "</picture>", "</pre>", "</progress>", "</q>", "</rp>", "</rt>", "</ruby>", "</s>", "</samp>", "</script>", "</section>", "</select>", "</small>", "</source>", "</span>", "</strike>", "</strong>", "</style>", "</sub>", "</summary>", "</sup>", "</table>", "</tbody>", "</td>", "</template>", "</textarea>", "</tfoot>", "</th>", "</thead>", "</time>", "</title>", "</tr>", "</track>", "</tt>", "</u>", "</ul>", "</var>", "</video>",
-            "</wbr>", "</SCR'+'IPT>", "</!DOCTYPE>", "</A>", "</ABBR>", "</ACRONYM>", "</ADDRESS>", "</APPLET>", "</AREA>", "</ARTICLE>", "</ASIDE>", "</AUDIO>", "</B>", "</BASE>", "</BASEFONT>", "</BDI>", "</BDO>", "</BIG>", "</BLOCKQUOTE>", "</BODY>", "</BR>", "</BUTTON>", "</CANVAS>", "</CAPTION>", "</CENTER>", "</CITE>", "</CODE>", "</COL>", "</COLGROUP>", "</DATALIST>", "</DD>", "</DEL>", "</DETAILS>", "</DFN>", "</DIALOG>", "</DIR>", "</DIV>", "</DL>", "</DT>", "</EM>", "</EMBED>", "</FIELDSET>", "</FIGCAPTION>", "</FIGURE>", "</FONT>", "</FOOTER>", "</FORM>", "</FRAME>", "</FRAMESET>", "</H1>", "</HEAD>", "</HEADER>", "</HR>", "</HTML>", "</I>", "</IFRAME>", "</IMG>", "</INPUT>", "</INS>", "</KBD>", "</LABEL>", "</LEGEND>", "</LI>", "</LINK>", "</MAIN>", "</MAP>", "</MARK>", "</MENU>", "</MENUITEM>", "</META>", "</METER>", "</NAV>", "</NOFRAMES>", "</NOSCRIPT>", "</OBJECT>", "</OL>", "</OPTGROUP>", "</OPTION>", "</OUTPUT>", "</P>", "</PARAM>", "</PICTURE>", "</PRE>", "</PROGRESS>", "</Q>", "</RP>", "</RT>", "</RUBY>", "</S>", "</SAMP>", "</SCRIPT>", "</SECTION>", "</SELECT>", "</SMALL>", "</SOURCE>", "</SPAN>", "</STRIKE>", "</STRONG>", "</STYLE>", "</SUB>", "</SUMMARY>", "</SUP>", "</TABLE>", "</TBODY>", "</TD>", "</TEMPLATE>", "</TEXTAREA>", "</TFOOT>", "</TH>", "</THEAD>", "</TIME>", "</TITLE>", "</TR>", "</TRACK>", "</TT>", "</U>", "</UL>", "</VAR>", "</VIDEO>", "</WBR>"]
-start_tags = ["&nbsp;", "<scr'+'ipt>", "<!----!>", "<!DOCTYPE>", "<a>", "<abbr>", "<acronym>", "<address>", "<applet>", "<area>", "<article>", "<aside>", "<audio>", "<b>", "<base>", "<basefont>", "<bdi>", "<bdo>", "<big>", "<blockquote>", "<body>", "<br>", "<button>", "<canvas>", "<caption>", "<center>", "<cite>", "<code>", "<col>", "<colgroup>", "<datalist>", "<dd>", "<del>", "<details>", "<dfn>", "<dialog>", "<dir>", "<div>", "<dl>", "<dt>", "<em>", "<embed>", "<fieldset>", "<figcaption>", "<figure>", "<font>", "<footer>", "<form>", "<frame>", "<frameset>", "<h1>", "<head>", "<header>", "<hr>", "<html>", "<i>", "<iframe>", "<img>", "<input>", "<ins>", "<kbd>", "<label>", "<legend>", "<li>", "<link>", "<main>", "<map>", "<mark>", "<menu>", "<menuitem>", "<meta>", "<meter>", "<nav>", "<noframes>", "<noscript>", "<object>", "<ol>", "<optgroup>", "<option>", "<output>", "<p>", "<param>", "<picture>", "<pre>", "<progress>", "<q>", "<rp>", "<rt>", "<ruby>", "<s>", "<samp>", "<script>", "<section>", "<select>", "<small>", "<source>", "<span>", "<strike>", "<strong>", "<style>", "<sub>", "<summary>", "<sup>", "<table>", "<tbody>", "<td>", "<template>", "<textarea>", "<tfoot>", "<th>", "<thead>", "<time>", "<title>", "<tr>", "<track>", "<tt>", "<u>", "<ul>", "<var>", "<video>",
-              "<wbr>", "<SCR'+'IPT>", "<!-->", "<!DOCTYPE>", "<A>", "<ABBR>", "<ACRONYM>", "<ADDRESS>", "<APPLET>", "<AREA>", "<ARTICLE>", "<ASIDE>", "<AUDIO>", "<B>", "<BASE>", "<BASEFONT>", "<BDI>", "<BDO>", "<BIG>", "<BLOCKQUOTE>", "<BODY>", "<BR>", "<BUTTON>", "<CANVAS>", "<CAPTION>", "<CENTER>", "<CITE>", "<CODE>", "<COL>", "<COLGROUP>", "<DATALIST>", "<DD>", "<DEL>", "<DETAILS>", "<DFN>", "<DIALOG>", "<DIR>", "<DIV>", "<DL>", "<DT>", "<EM>", "<EMBED>", "<FIELDSET>", "<FIGCAPTION>", "<FIGURE>", "<FONT>", "<FOOTER>", "<FORM>", "<FRAME>", "<FRAMESET>", "<H1>", "<HEAD>", "<HEADER>", "<HR>", "<HTML>", "<I>", "<IFRAME>", "<IMG>", "<INPUT>", "<INS>", "<KBD>", "<LABEL>", "<LEGEND>", "<LI>", "<LINK>", "<MAIN>", "<MAP>", "<MARK>", "<MENU>", "<MENUITEM>", "<META>", "<METER>", "<NAV>", "<NOFRAMES>", "<NOSCRIPT>", "<OBJECT>", "<OL>", "<OPTGROUP>", "<OPTION>", "<OUTPUT>", "<P>", "<PARAM>", "<PICTURE>", "<PRE>", "<PROGRESS>", "<Q>", "<RP>", "<RT>", "<RUBY>", "<S>", "<SAMP>", "<SCRIPT>", "<SECTION>", "<SELECT>", "<SMALL>", "<SOURCE>", "<SPAN>", "<STRIKE>", "<STRONG>", "<STYLE>", "<SUB>", "<SUMMARY>", "<SUP>", "<TABLE>", "<TBODY>", "<TD>", "<TEMPLATE>", "<TEXTAREA>", "<TFOOT>", "<TH>", "<THEAD>", "<TIME>", "<TITLE>", "<TR>", "<TRACK>", "<TT>", "<U>", "<UL>", "<VAR>", "<VIDEO>", "<WBR>"]
 
 use_cuda = torch.cuda.is_available()
 FloatTensor = torch.cuda.FloatTensor if use_cuda else torch.FloatTensor
@@ -29,6 +29,41 @@ def variable(v, arg_use_cuda=True, volatile=False):
     return Variable(v, volatile=volatile)
 
 
+def split_parameters(model):
+    ## (dense, sparse) parameters of a model; the weights of embeddings with sparse=True get sparse gradients
+    sparse_ids = set(id(module.weight) for module in model.modules() if isinstance(module, nn.Embedding) and module.sparse)
+    parameters = list(model.parameters())
+    return [p for p in parameters if id(p) not in sparse_ids], [p for p in parameters if id(p) in sparse_ids]
+
+
+class SparseDenseOptimizer(object):
+    """
+    Adam for the dense parameters and SparseAdam for the sparse embeddings of a model, so that a step only updates
+    the rows and moments of the words in the batch instead of the whole embedding table. Without sparse embeddings
+    this is plain Adam over all parameters.
+    """
+    def __init__(self, model, learning_rate):
+        self.dense_parameters, self.sparse_parameters = split_parameters(model)
+        self.optimizers = [optim.Adam(self.dense_parameters, lr=learning_rate)]
+        if len(self.sparse_parameters) > 0:
+            self.optimizers.append(optim.SparseAdam(self.sparse_parameters, lr=learning_rate))
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
 def pad_seq(seq, max_len, pad_token=0):
     seq += [pad_token for i in range(max_len - len(seq))]
     return seq
@@ -51,32 +86,74 @@ def pad_seq_elmo(seq, max_len,size=1024):
     padded_batch=np.concatenate((seq ,padded),axis=0)
     return padded_batch
 
-def get_pretrained_emb(embedding_path, word_to_id, dim):
-    word_emb = []
-    print("Loading pretrained embeddings from {0}".format(embedding_path))
-    for _ in range(len(word_to_id)):
-        word_emb.append(np.random.uniform(-math.sqrt(3.0 / dim), math.sqrt(3.0 / dim), size=dim))
+def pretrained_source(embedding_path):
+    ## size and modification time of the text file a cache was converted from
+    stat = os.stat(embedding_path)
+    return stat.st_size, stat.st_mtime
+
+def convert_pretrained_emb(embedding_path, dim, cache_path):
+    """
+    One-time conversion of a text embedding file (GloVe format) into a binary cache that get_pretrained_emb
+    memory-maps instead of parsing the text again:
+    <cache_path>.data  : float32 (words, dim) matrix, one row per word of the file
+    <cache_path>.index : pickled (dim, {word: row}, (size, mtime) of the text file)
+    """
+    print("Converting pretrained embeddings {0} to {1}".format(embedding_path, cache_path))
+    source = pretrained_source(embedding_path)
+    index = {}
+    rows = 0
+    with open(cache_path + ".data.tmp", "wb") as fout:
+        for line in codecs.open(embedding_path, "r", "utf-8", errors='replace'):
+            items = line.strip().split()
+            if len(items) == dim + 1:
+                try:
+                    vector = np.asarray(items[1:]).astype(np.float32)
+                except ValueError:
+                    continue
+                fout.write(vector.tobytes())
+                ## a word that occurs twice keeps its last vector, as the dict of the text loader did
+                index[items[0]] = rows
+                rows += 1
+    ## the index is written last, so a cache with an index always has complete data
+    os.rename(cache_path + ".data.tmp", cache_path + ".data")
+    with open(cache_path + ".index.tmp", "wb") as fout:
+        pickle.dump((dim, index, source), fout, pickle.HIGHEST_PROTOCOL)
+    os.rename(cache_path + ".index.tmp", cache_path + ".index")
+    return dim, index, source
+
+
+def get_pretrained_emb(embedding_path, word_to_id, dim, cache_path=None):
+    ## the text file is converted once to a binary cache next to it (or at cache_path), later runs memory-map the
+    ## cache and only read the rows of the words in word_to_id
+    cache_path = embedding_path if cache_path is None else cache_path
+    cache = None
+    if os.path.exists(cache_path + ".index"):
+        with open(cache_path + ".index", "rb") as fin:
+            cache = pickle.load(fin)
+    ## a cache of another version of the text file, or one without the source recorded, is converted again
+    if cache is None or len(cache) != 3 or cache[2] != pretrained_source(embedding_path):
+        cache = convert_pretrained_emb(embedding_path, dim, cache_path)
+    print("Loading pretrained embeddings from {0}".format(cache_path))
+    cache_dim, index, _ = cache
+    assert cache_dim == dim, "{0} holds {1} dimensional embeddings".format(cache_path, cache_dim)
 
     print("length of dict: {0}".format(len(word_to_id)))
-    pretrain_word_emb = {}
-    for line in codecs.open(embedding_path, "r", "utf-8", errors='replace'):
-        items = line.strip().split()
-        if len(items) == dim + 1:
-            try:
-                pretrain_word_emb[items[0]] = np.asarray(items[1:]).astype(np.float32)
-            except ValueError:
-                continue
-
-    not_covered = 0
+    emb = np.random.uniform(-math.sqrt(3.0 / dim), math.sqrt(3.0 / dim), size=(len(word_to_id), dim)).astype(np.float32)
+
+    ids = []
+    rows = []
     for word, id in word_to_id.iteritems():
-        if word in pretrain_word_emb:
-            word_emb[id] = pretrain_word_emb[word]
-        elif word.lower() in pretrain_word_emb:
-            word_emb[id] = pretrain_word_emb[word.lower()]
-        else:
-            not_covered += 1
-
-    emb = np.array(word_emb, dtype=np.float32)
+        row = index.get(word, index.get(word.lower()))
+        if row is not None:
+            ids.append(id)
+            rows.append(row)
+    not_covered = len(word_to_id) - len(ids)
+
+    if len(rows) > 0:
+        data = np.memmap(cache_path + ".data", dtype=np.float32, mode="r").reshape(-1, dim)
+        ## rows are read in file order
+        order = np.argsort(rows)
+        emb[np.array(ids)[order]] = data[np.array(rows)[order]]
 
     print("Word number not covered in pretrain embedding: {0}".format(not_covered))
     return emb
@@ -0,0 +1,142 @@
+import numpy as np
+import hashlib
+from collections import Counter
+from retrieval.preprocessing import encode_strings, decode_strings
+
+
+class Vocabulary(object):
+    """
+    Word, NER tag and POS tag ids. Every namespace is a {token: id} dict and a list of tokens by id; only the lists
+    are saved and pickled, the dicts are rebuilt from them, so a vocabulary is cheap to store and to send to pool
+    workers. A frozen vocabulary adds no words anymore, unknown words map to unk.
+    """
+    def __init__(self, pad_token='pad', unk='unk', sos='<sos>',eos='<eos>', min_frequency=1, max_size=0):
+
+        self.pad_token = pad_token
+        self.unk = unk
+        self.id_to_vocab = [pad_token, unk, sos, eos]
+        self.vocabulary = dict((word, index) for index, word in enumerate(self.id_to_vocab))
+
+        self.id_to_nertag = []
+        self.id_to_postag = []
+        self.nertag_to_id = dict()
+        self.postag_to_id = dict()
+
+        ## with min_frequency > 1 or max_size > 0 (0: no limit), build adds the frequent words only and freezes the
+        ## vocabulary, after which every other word maps to unk
+        self.min_frequency = min_frequency
+        self.max_size = max_size
+        self.frozen = False
+
+
+    def add_and_get_index(self, word):
+        if word in self.vocabulary:
+            return self.vocabulary[word]
+        elif self.frozen:
+            return self.vocabulary[self.unk]
+        else:
+            length = len(self.id_to_vocab)
+            self.vocabulary[word] = length
+            self.id_to_vocab.append(word)
+            return length
+
+    def add_and_get_indices(self, words):
+        return [self.add_and_get_index(word) for word in words]
+
+    def encode(self, words):
+        ## ids of words without adding any, unknown words map to unk
+        unk = self.vocabulary[self.unk]
+        return [self.vocabulary.get(word, unk) for word in words]
+
+    def decode(self, ids):
+        return [self.get_word(index) for index in ids]
+
+    def digest(self):
+        ## sha1 of the words and their ids, e.g. to check that word ids stored with a dataset still match
+        return hashlib.sha1(repr(self.id_to_vocab).encode("utf-8")).hexdigest()
+
+    def freeze(self):
+        self.frozen = True
+
+    def pruned(self):
+        return self.min_frequency > 1 or self.max_size > 0
+
+    def build(self, words):
+        ## adds the words occurring at least min_frequency times, most frequent first up to max_size words in total
+        counts = Counter(words)
+        kept = sorted([word for word, count in counts.items() if count >= self.min_frequency and word not in self.vocabulary],
+                      key=lambda word: (-counts[word], word))
+        if self.max_size > 0:
+            kept = kept[:max(0, self.max_size - len(self.vocabulary))]
+        for word in kept:
+            self.add_and_get_index(word)
+        self.freeze()
+
+    def get_index(self, word):
+        return self.vocabulary.get(word, self.vocabulary[self.unk])
+
+    def get_length(self):
+        return len(self.id_to_vocab)
+
+    def get_word(self,index):
+        if index < len(self.id_to_vocab):
+            return self.id_to_vocab[index]
+        else:
+            return ""
+
+    def ner_tag_size(self):
+        return len(self.id_to_nertag)
+
+    def pos_tag_size(self):
+        return len(self.id_to_postag)
+
+    def add_and_get_indices_NER(self, words):
+        return [self.add_and_get_index_NER(str(word)) for word in words]
+
+    def add_and_get_indices_POS(self, words):
+        return [self.add_and_get_index_POS(str(word)) for word in words]
+
+    def add_and_get_index_NER(self, word):
+        if word not in self.nertag_to_id:
+            self.nertag_to_id[word] = len(self.id_to_nertag)
+            self.id_to_nertag.append(word)
+        return self.nertag_to_id[word]
+
+    def add_and_get_index_POS(self, word):
+        if word not in self.postag_to_id:
+            self.postag_to_id[word] = len(self.id_to_postag)
+            self.id_to_postag.append(word)
+        return self.postag_to_id[word]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ["vocabulary", "nertag_to_id", "postag_to_id"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.vocabulary = dict((word, index) for index, word in enumerate(self.id_to_vocab))
+        self.nertag_to_id = dict((tag, index) for index, tag in enumerate(self.id_to_nertag))
+        self.postag_to_id = dict((tag, index) for index, tag in enumerate(self.id_to_postag))
+
+    def save(self, path):
+        ## one .npz of the tokens of every namespace as utf-8 bytes with their lengths
+        arrays = {"settings": np.array([self.min_frequency, self.max_size, self.frozen], dtype=np.int64)}
+        for name, tokens in [("words", self.id_to_vocab), ("ner", self.id_to_nertag), ("pos", self.id_to_postag),
+                             ("special", [self.pad_token, self.unk])]:
+            arrays[name], arrays[name + "_lengths"] = encode_strings(tokens)
+        with open(path, "wb") as fout:
+            np.savez(fout, **arrays)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as fin:
+            arrays = np.load(fin)
+            tokens = dict((name, decode_strings(arrays[name], arrays[name + "_lengths"])) for name in ["words", "ner", "pos", "special"])
+            min_frequency, max_size, frozen = arrays["settings"].tolist()
+        vocab = Vocabulary.__new__(Vocabulary)
+        vocab.__setstate__({"pad_token": tokens["special"][0], "unk": tokens["special"][1], "id_to_vocab": tokens["words"],
+                            "id_to_nertag": tokens["ner"], "id_to_postag": tokens["pos"],
+                            "min_frequency": min_frequency, "max_size": max_size, "frozen": bool(frozen)})
+        return vocab
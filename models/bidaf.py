@@ -19,7 +19,7 @@ def masked_softmax(vector, mask):
 		# To limit numerical errors from large vector elements outside the mask, we zero these out.
 		result = torch.nn.functional.softmax(vector * mask, dim=-1)
 		result = result * mask
-		result = result / (result.sum(dim=1, keepdim=True) + 1e-13)
+		result = result / (result.sum(dim=-1, keepdim=True) + 1e-13)
 	return result
 
 def replace_masked_values(tensor, mask, replace_with):
@@ -36,6 +36,27 @@ def replace_masked_values(tensor, mask, replace_with):
 	values_to_add = replace_with * one_minus_mask
 	return tensor * mask + values_to_add
 
+def padded_masked_softmax(vector, mask):
+	"""
+	Same normalization as ``masked_softmax``, but masked elements are excluded from the softmax itself instead of
+	being set to zero, so padding of a batch does not change the values of the real elements.
+	``mask`` must have the same shape as ``vector``.
+	"""
+	result = F.softmax(replace_masked_values(vector, mask, -1e7), dim=-1)
+	result = result * mask
+	result = result / (result.sum(dim=-1, keepdim=True) + 1e-13)
+	return result
+
+def scatter_scores(scores, pair_question_index, pair_position, batch_size, num_candidates):
+	"""
+	Scatters the scores of the real (question, candidate) pairs of a batch, shape ``(P,)``, into a
+	``(batch_size, num_candidates)`` matrix. Candidates a question does not have are filled with -1e7.
+	"""
+	flat_index = pair_question_index * num_candidates + pair_position
+	padding = scores.data.new(batch_size * num_candidates).fill_(-1e7)
+	padding.index_fill_(0, flat_index.data, 0)
+	return Variable(padding).index_add(0, flat_index, scores).view(batch_size, num_candidates)
+
 def last_dim_softmax(tensor,mask):
 	tensor_shape = tensor.size()
 	reshaped_tensor = tensor.view(-1, tensor.size()[-1])
@@ -56,6 +77,26 @@ class BiDAF(nn.Module):
 		self.similarity_layer = nn.Linear(3*input_size, 1)
 		self.similarity_layer.bias.data.fill_(1)
 
+	def similarity(self, U, H):
+		"""
+		Trilinear similarity ``S[n, t, j] = w . [h; u; h*u] + bias`` between every row of ``H`` (N, T, 2d) and of
+		``U`` (N, J, 2d). The weight is split into its h, u and h*u parts and applied with matmuls, so the
+		(N, T, J, 6d) input of ``similarity_layer`` is never built. A ``U`` with a single row is shared by all N.
+		"""
+		batch_size, T, hidden_size = H.size()
+		J = U.size(1)
+		w_H, w_U, w_HU = torch.split(self.similarity_layer.weight.view(-1), hidden_size)
+		flat_H = H.contiguous().view(batch_size * T, hidden_size)
+		if U.size(0) == 1:
+			shared_U = U.contiguous().view(J, hidden_size)
+			S = torch.mm(flat_H * w_HU.unsqueeze(0), shared_U.t()).view(batch_size, T, J)
+			U_part = torch.mv(shared_U, w_U).view(1, 1, J)
+		else:
+			S = torch.bmm(H * w_HU.view(1, 1, -1), U.transpose(1, 2))
+			U_part = torch.mv(U.contiguous().view(-1, hidden_size), w_U).view(batch_size, 1, J)
+		H_part = torch.mv(flat_H, w_H).view(batch_size, T, 1)
+		return S + H_part + U_part + self.similarity_layer.bias
+
 	## TODO: Add capability of sentence mask (scoring) for sentence selection model
 	def forward(self, U, H, U_mask, H_mask): #H:context U: query
 		T = H.size(1)   #Context Length
@@ -66,14 +107,7 @@ class BiDAF(nn.Module):
 
 		## compute S from H and U
 		## shape of ctx_C: (N, T, 2d) and ctx_Q : # (N, J, 2d)
-		## make both matrices of shape (N, T, J, 2d) to compute S
-
-		expanded_U = U.unsqueeze(1).expand((U.size(0), H.size(1), U.size(1), U.size(2)))  # (N, T, J, 2d)
-		expanded_H = H.unsqueeze(2).expand((H.size(0), H.size(1), U.size(1), H.size(2)))  # (N, T, J, 2d)
-
-		HU = torch.mul(expanded_H, expanded_U)  # (N, T, J, 4d)
-		cat_data = torch.cat([expanded_H, expanded_U, HU], 3)  # (N, T, J, 6d)
-		S = self.similarity_layer(cat_data).view(-1, T, J)  # (N, T, J, 1) => (N, T, J)
+		S = self.similarity(U, H)  # (N, T, J)
 
 		#Query aware context representation.
 		c2q = torch.bmm(masked_softmax(S, U_mask), U)
@@ -95,3 +129,66 @@ class BiDAF(nn.Module):
 		G = torch.cat([H, c2q, H * c2q, H * tiled_q2c], dim=-1)
 
 		return G, c2q, q2c
+
+	def forward_padded(self, U, H, U_mask, H_mask):
+		"""
+		Same as ``forward`` for a batch of padded sequences. ``U_mask`` is (N, J) and ``H_mask`` is (N, T); the
+		attention of each example only sees its own real positions, so its results do not depend on the padding.
+		"""
+		T = H.size(1)
+		J = U.size(1)
+		batch_size = U.size(0)
+
+		S = self.similarity(U, H)  # (N, T, J)
+
+		## (N, T, J): a pair is real only if both the context and the query position are
+		similarity_mask = H_mask.unsqueeze(2) * U_mask.unsqueeze(1)
+
+		#Query aware context representation.
+		c2q = torch.bmm(padded_masked_softmax(S, similarity_mask), U)
+
+		masked_similarity = replace_masked_values(S, similarity_mask, -1e7)
+		mb = torch.max(masked_similarity, dim=-1)[0]
+		b = padded_masked_softmax(mb, H_mask)
+
+		## (N, 1, 2d) = (N,1,T) * (N, T, 2d)
+		q2c = torch.bmm(b.unsqueeze(1), H).squeeze(1)
+
+		## (N, 1, 2d) => (N, T, 2d)
+		tiled_q2c = q2c.unsqueeze(1).expand(batch_size, T, q2c.size(-1))
+
+		G = torch.cat([H, c2q, H * c2q, H * tiled_q2c], dim=-1)
+
+		return G, c2q, q2c
+
+	def forward_broadcast(self, U, H, U_mask, H_mask):
+		"""
+		Same as ``forward(U.repeat(N, 1, 1), H, U_mask, H_mask)`` for a single ``U`` of shape (1, J, 2d) that is
+		shared by all N rows of ``H``, without materializing the repeated ``U``. ``U_mask`` holds the J positions of
+		``U`` in any shape, ``H_mask`` is (N, T).
+		"""
+		T = H.size(1)
+		J = U.size(1)
+		batch_size = H.size(0)
+		hidden_size = H.size(2)
+		shared_U = U.contiguous().view(J, hidden_size)
+		U_mask = U_mask.contiguous().view(1, 1, J)
+
+		S = self.similarity(U, H)  # (N, T, J)
+
+		#Query aware context representation.
+		c2q = torch.mm(masked_softmax(S, U_mask).view(batch_size * T, J), shared_U).view(batch_size, T, hidden_size)
+
+		masked_similarity = replace_masked_values(S, U_mask, -1e7)
+		mb = torch.max(masked_similarity, dim=-1)[0]
+		b = masked_softmax(mb, H_mask)
+
+		## (N, 1, 2d) = (N,1,T) * (N, T, 2d)
+		q2c = torch.bmm(b.unsqueeze(1), H).squeeze(1)
+
+		## (N, 1, 2d) => (N, T, 2d)
+		tiled_q2c = q2c.unsqueeze(1).expand(batch_size, T, q2c.size(-1))
+
+		G = torch.cat([H, c2q, H * c2q, H * tiled_q2c], dim=-1)
+
+		return G, c2q, q2c
@@ -2,7 +2,8 @@ import torch
 from torch import nn
 from torch.autograd import Variable
 import torch.nn.functional as F
-from bidaf import BiDAF
+import numpy as np
+from bidaf import BiDAF, replace_masked_values, scatter_scores
 
 class ContextMRR(nn.Module):
 	def __init__(self, args, loader):
@@ -47,11 +48,22 @@ class ContextMRR(nn.Module):
 
 		self.loss = torch.nn.CrossEntropyLoss()
 
+	## The context and candidate encodings do not depend on the question, so callers can compute them once per
+	## document and pass them to forward/eval of every question of that document. Dropout is applied afterwards.
+	def encode_context(self, batch_context, batch_context_length):
+		# (N, T, d) => (N, T, 2d)
+		context_encoded, _ = self.contextual_embedding_layer(batch_context.unsqueeze(0), batch_context_length)
+		return context_encoded
+
+	def encode_candidates(self, batch_candidates_sorted, batch_candidate_lengths_sorted):
+		# (N1, K, d) => (N1, K, 2d)
+		batch_candidates_encoded, _ = self.contextual_embedding_layer(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		return batch_candidates_encoded
 
 	def forward(self, batch_query, batch_query_length,batch_query_mask,
 				batch_context, batch_context_length,batch_context_mask,
 				batch_candidates_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,batch_candidate_unsort,
-				gold_index, negative_indices):
+				gold_index, negative_indices, context_encoding=None, candidates_encoding=None):
 
 		## Embed query and context
 		# (N, J, d)
@@ -60,14 +72,14 @@ class ContextMRR(nn.Module):
 		#context_embedded = self.word_embedding_layer(batch_context.unsqueeze(0))
 
 		query_embedded = batch_query.unsqueeze(0)
-		context_embedded = batch_context.unsqueeze(0)
 		## Encode query and context
 		# (N, J, 2d)
 		query_encoded,_ = self.contextual_embedding_layer(query_embedded, batch_query_length)
 		query_encoded = self._dropout(query_encoded)
 		# (N, T, 2d)
-		context_encoded,_ = self.contextual_embedding_layer(context_embedded, batch_context_length)
-		context_encoded = self._dropout(context_encoded)
+		if context_encoding is None:
+			context_encoding = self.encode_context(batch_context, batch_context_length)
+		context_encoded = self._dropout(context_encoding)
 
 		## required to support single element batch of question
 		batch_query_mask = batch_query_mask.unsqueeze(0)
@@ -75,7 +87,7 @@ class ContextMRR(nn.Module):
 
 		## BiDAF 1 to get ~U, ~h and G (8d) between context and query
 		# (N, T, 8d) , (N, T ,2d) , (N, 1, 2d)
-		context_attention_encoded, query_aware_context_encoded, context_aware_query_encoded = self.attention_flow_layer1(query_encoded, context_encoded,batch_query_mask,batch_context_mask)
+		context_attention_encoded, query_aware_context_encoded, context_aware_query_encoded = self.attention_flow_layer1(query_encoded, context_encoded,batch_query_mask.unsqueeze(1),batch_context_mask)
 
 		## modelling layer 1
 		# (N, T, 8d) => (N, T, 2d)
@@ -86,17 +98,12 @@ class ContextMRR(nn.Module):
 		BIDAF 2
 		'''
 		## BiDAF for answers
-		batch_size = batch_candidates_sorted.size(0)
-		# N=1 so (N, T, 2d) => (N1, T, 2d)
-		batch_context_modeled = context_modeled.repeat(batch_size,1,1)
-		# (N1, K, d)
-		#batch_candidates_embedded = self.word_embedding_layer(batch_candidates_sorted)
-		batch_candidates_embedded = batch_candidates_sorted
 		# (N1, K, 2d)
-		batch_candidates_encoded,_ = self.contextual_embedding_layer(batch_candidates_embedded, batch_candidate_lengths_sorted)
-		batch_candidates_encoded = self._dropout(batch_candidates_encoded)
-
-		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2(batch_context_modeled, batch_candidates_encoded, batch_context_mask,batch_candidate_masks_sorted)
+		if candidates_encoding is None:
+			candidates_encoding = self.encode_candidates(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_encoded = self._dropout(candidates_encoding)
+		## N=1, the context is broadcast over the N1 candidates instead of being repeated
+		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2.forward_broadcast(context_modeled, batch_candidates_encoded, batch_context_mask,batch_candidate_masks_sorted)
 
 		## concatenate original answer and context aware answer
 		input_to_answer_model = torch.cat([batch_candidates_encoded,context_aware_answer_encoded,batch_candidates_encoded * context_aware_answer_encoded],dim=-1)
@@ -106,12 +113,13 @@ class ContextMRR(nn.Module):
 		answer_modeled, (answer_hidden_state, answer_cell_state) = self.modeling_layer2(input_to_answer_model, batch_candidate_lengths_sorted)
 		answer_modeled = self._dropout(answer_modeled)
 
-		answer_modeled_replaced = self.attention_flow_layer2.replace_masked_values(answer_modeled.transpose(1, 2),
+		## max and mean over the real positions of each candidate, so its score does not depend on the padding of the pool
+		answer_modeled_replaced = replace_masked_values(answer_modeled.transpose(1, 2),
 																				   batch_candidate_masks_sorted.unsqueeze(
-																					   1), 1e-7)
+																					   1), -1e7)
 		answer_modeled_mask = answer_modeled.transpose(1, 2) * batch_candidate_masks_sorted.unsqueeze(1)
 		answer_concat_hidden = torch.cat(
-			(torch.max(answer_modeled_replaced, dim=2)[0], torch.mean(answer_modeled_mask, dim=2)), dim=1)
+			(torch.max(answer_modeled_replaced, dim=2)[0], torch.sum(answer_modeled_mask, dim=2) / batch_candidate_masks_sorted.sum(1).unsqueeze(1)), dim=1)
 
 		## output layer : concatenate hidden dimension of the final answer model layer and run through an MLP : (N1, 2d) => (N1, d)
 		# (N1, 2d) => (N1, 1)
@@ -142,7 +150,8 @@ class ContextMRR(nn.Module):
 
 	def eval(self,batch_query, batch_query_length,batch_query_mask,
 				batch_context, batch_context_length,batch_context_mask,
-			 batch_candidates_sorted, batch_candidate_lengths_sorted,batch_candidate_masks_sorted, batch_candidate_unsort):
+			 batch_candidates_sorted, batch_candidate_lengths_sorted,batch_candidate_masks_sorted, batch_candidate_unsort,
+			 context_encoding=None, candidates_encoding=None):
 		## Embed query and context
 		# (N, J, d)
 		#query_embedded = self.word_embedding_layer(batch_query.unsqueeze(0))
@@ -150,13 +159,14 @@ class ContextMRR(nn.Module):
 		#context_embedded = self.word_embedding_layer(batch_context.unsqueeze(0))
 
 		query_embedded = batch_query.unsqueeze(0)
-		context_embedded = batch_context.unsqueeze(0)
 
 		## Encode query and context
 		# (N, J, 2d)
 		query_encoded, _ = self.contextual_embedding_layer(query_embedded, batch_query_length)
 		# (N, T, 2d)
-		context_encoded, _ = self.contextual_embedding_layer(context_embedded, batch_context_length)
+		if context_encoding is None:
+			context_encoding = self.encode_context(batch_context, batch_context_length)
+		context_encoded = context_encoding
 
 		## BiDAF 1 to get ~U, ~h and G (8d) between context and query
 		# (N, T, 8d) , (N, T ,2d) , (N, 1, 2d)
@@ -164,24 +174,20 @@ class ContextMRR(nn.Module):
 		batch_context_mask = batch_context_mask.unsqueeze(0)
 
 		context_attention_encoded, query_aware_context_encoded, context_aware_query_encoded = self.attention_flow_layer1(
-			query_encoded, context_encoded,batch_query_mask,batch_context_mask)
+			query_encoded, context_encoded,batch_query_mask.unsqueeze(1),batch_context_mask)
 
 		## modelling layer 1
 		# (N, T, 8d) => (N, T, 2d)
 		context_modeled, _ = self.modeling_layer1(context_attention_encoded, batch_context_length)
 
 		## BiDAF for answers
-		batch_size = batch_candidates_sorted.size(0)
-		# N=1 so (N, T, 2d) => (N1, T, 2d)
-		batch_context_modeled = context_modeled.repeat(batch_size, 1, 1)
-		# (N1, K, d)
-		#batch_candidates_embedded = self.word_embedding_layer(batch_candidates_sorted)
-		batch_candidates_embedded = batch_candidates_sorted
 		# (N1, K, 2d)
-		batch_candidates_encoded, _ = self.contextual_embedding_layer(batch_candidates_embedded,
-																	  batch_candidate_lengths_sorted)
-		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2(
-			batch_context_modeled, batch_candidates_encoded,batch_context_mask,batch_candidate_masks_sorted)
+		if candidates_encoding is None:
+			candidates_encoding = self.encode_candidates(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_encoded = candidates_encoding
+		## N=1, the context is broadcast over the N1 candidates instead of being repeated
+		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2.forward_broadcast(
+			context_modeled, batch_candidates_encoded,batch_context_mask,batch_candidate_masks_sorted)
 
 		input_to_answer_model = torch.cat([batch_candidates_encoded, context_aware_answer_encoded,
 										   batch_candidates_encoded * context_aware_answer_encoded], dim=-1)
@@ -191,12 +197,13 @@ class ContextMRR(nn.Module):
 		answer_modeled, (answer_hidden_state, answer_cell_state) = self.modeling_layer2(input_to_answer_model,
 																						batch_candidate_lengths_sorted,)
 
-		answer_modeled_replaced = self.attention_flow_layer2.replace_masked_values(answer_modeled.transpose(1, 2),
+		## max and mean over the real positions of each candidate, so its score does not depend on the padding of the pool
+		answer_modeled_replaced = replace_masked_values(answer_modeled.transpose(1, 2),
 																				   batch_candidate_masks_sorted.unsqueeze(
-																					   1), 1e-7)
+																					   1), -1e7)
 		answer_modeled_mask = answer_modeled.transpose(1, 2) * batch_candidate_masks_sorted.unsqueeze(1)
 		answer_concat_hidden = torch.cat(
-			(torch.max(answer_modeled_replaced, dim=2)[0], torch.mean(answer_modeled_mask, dim=2)), dim=1)
+			(torch.max(answer_modeled_replaced, dim=2)[0], torch.sum(answer_modeled_mask, dim=2) / batch_candidate_masks_sorted.sum(1).unsqueeze(1)), dim=1)
 
 		## output layer : concatenate hidden dimension of the final answer model layer and run through an MLP : (N1, 2d) => (N1, d)
 		# (N1, 2d) => (N1, 1)
@@ -212,6 +219,89 @@ class ContextMRR(nn.Module):
 		sorted, indices = torch.sort(	F.log_softmax(answer_scores_unsorted, dim=0), dim=0, descending=True)
 		return indices
 
+	## Batched variants of forward/eval for N questions at once. Queries and contexts are padded, candidates are
+	## flattened into the pairs of (question, candidate) that actually exist:
+	##   batch_query (N, J, d), batch_query_mask (N, J)
+	##   batch_context (M, T, d), batch_context_mask (M, T): one row per distinct context, context_index (N) maps
+	##   each question to its row
+	##   batch_candidates (P, K, d), batch_candidate_masks (P, K): candidates of all distinct pools, in any order
+	##   pair_candidate_index, pair_question_index, pair_position (Pq): candidate row, question and position of
+	##   each pair in the question's own candidate list
+	## Lengths are numpy arrays and need not be sorted. Scores come back as (N, num_candidates), padded with -1e7.
+	def forward_batch(self, batch_query, batch_query_lengths, batch_query_mask,
+					  batch_context, batch_context_lengths, batch_context_mask, context_index,
+					  batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+					  pair_candidate_index, pair_question_index, pair_position, num_candidates, gold_index=None):
+
+		batch_size = batch_query.size(0)
+		## Encode query and context
+		# (N, J, 2d)
+		query_encoded, _ = self.contextual_embedding_layer.forward_unsorted(batch_query, batch_query_lengths)
+		query_encoded = self._dropout(query_encoded)
+		# (M, T, 2d) => (N, T, 2d)
+		context_encoded, _ = self.contextual_embedding_layer.forward_unsorted(batch_context, batch_context_lengths)
+		context_encoded = self._dropout(context_encoded.index_select(0, context_index))
+		batch_context_mask = batch_context_mask.index_select(0, context_index)
+		context_lengths = np.asarray(batch_context_lengths)[context_index.data.cpu().numpy()]
+
+		## BiDAF 1 to get ~U, ~h and G (8d) between context and query
+		# (N, T, 8d)
+		context_attention_encoded, query_aware_context_encoded, context_aware_query_encoded = self.attention_flow_layer1.forward_padded(
+			query_encoded, context_encoded, batch_query_mask, batch_context_mask)
+
+		## modelling layer 1
+		# (N, T, 8d) => (N, T, 2d)
+		context_modeled, _ = self.modeling_layer1.forward_unsorted(context_attention_encoded, context_lengths)
+		context_modeled = self._dropout(context_modeled)
+
+		'''
+		BIDAF 2
+		'''
+		## BiDAF between the modeled context of each question and each of its candidates
+		# (N, T, 2d) => (Pq, T, 2d)
+		batch_context_modeled = context_modeled.index_select(0, pair_question_index)
+		pair_context_mask = batch_context_mask.index_select(0, pair_question_index)
+		# (P, K, 2d) => (Pq, K, 2d)
+		batch_candidates_encoded, _ = self.contextual_embedding_layer.forward_unsorted(batch_candidates, batch_candidate_lengths)
+		batch_candidates_encoded = self._dropout(batch_candidates_encoded.index_select(0, pair_candidate_index))
+		pair_candidate_masks = batch_candidate_masks.index_select(0, pair_candidate_index)
+		pair_candidate_lengths = np.asarray(batch_candidate_lengths)[pair_candidate_index.data.cpu().numpy()]
+
+		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2.forward_padded(
+			batch_context_modeled, batch_candidates_encoded, pair_context_mask, pair_candidate_masks)
+
+		## concatenate original answer and context aware answer
+		input_to_answer_model = torch.cat([batch_candidates_encoded,context_aware_answer_encoded,batch_candidates_encoded * context_aware_answer_encoded],dim=-1)
+
+		## modelling layer 2
+		# (Pq, K, 6d) => (Pq, K, 2d)
+		answer_modeled, _ = self.modeling_layer2.forward_unsorted(input_to_answer_model, pair_candidate_lengths)
+		answer_modeled = self._dropout(answer_modeled)
+
+		## max and mean over the real positions of each candidate, as in the per-question model
+		answer_modeled_replaced = replace_masked_values(answer_modeled.transpose(1, 2), pair_candidate_masks.unsqueeze(1), -1e7)
+		answer_modeled_mask = answer_modeled.transpose(1, 2) * pair_candidate_masks.unsqueeze(1)
+		answer_concat_hidden = torch.cat(
+			(torch.max(answer_modeled_replaced, dim=2)[0], torch.sum(answer_modeled_mask, dim=2) / pair_candidate_masks.sum(1).unsqueeze(1)), dim=1)
+
+		# (Pq, 4d) => (Pq) => (N, C)
+		answer_scores = self.output_layer(answer_concat_hidden).squeeze(1)
+		answer_scores = scatter_scores(answer_scores, pair_question_index, pair_position, batch_size, num_candidates)
+		sorted, indices = torch.sort(F.log_softmax(answer_scores, dim=1), dim=1, descending=True)
+		if gold_index is None:
+			return indices
+		loss = self.loss(answer_scores, gold_index)
+		return loss, indices
+
+	def eval_batch(self, batch_query, batch_query_lengths, batch_query_mask,
+				   batch_context, batch_context_lengths, batch_context_mask, context_index,
+				   batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+				   pair_candidate_index, pair_question_index, pair_position, num_candidates):
+		return self.forward_batch(batch_query, batch_query_lengths, batch_query_mask,
+								  batch_context, batch_context_lengths, batch_context_mask, context_index,
+								  batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+								  pair_candidate_index, pair_question_index, pair_position, num_candidates)
+
 
 
 class OutputLayer(nn.Module):
@@ -243,12 +333,26 @@ class RecurrentContext(nn.Module):
 		outputs_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
 		return outputs_unpacked, hidden
 
+	def forward_unsorted(self, batch, batch_length):
+		## pack_padded_sequence needs decreasing lengths: sort the batch, run it and restore the original order
+		batch_length = np.asarray(batch_length)
+		sort = np.argsort(-batch_length, kind="mergesort")
+		sort_index = Variable(batch.data.new(sort.tolist()).long())
+		unsort_index = Variable(batch.data.new(np.argsort(sort).tolist()).long())
+		outputs, hidden = self.forward(batch.index_select(0, sort_index), batch_length[sort])
+		outputs = outputs.index_select(0, unsort_index)
+		if isinstance(hidden, tuple):
+			hidden = tuple(h.index_select(1, unsort_index) for h in hidden)
+		else:
+			hidden = hidden.index_select(1, unsort_index)
+		return outputs, hidden
+
 
 class LookupEncoder(nn.Module):
-    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None):
+    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None, sparse=False):
         super(LookupEncoder, self).__init__()
         self.embedding_dim = embedding_dim
-        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim)
+        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
         if pretrain_embedding is not None:
             self.word_embeddings.weight.data.copy_(torch.from_numpy(pretrain_embedding))
     def forward(self, batch):
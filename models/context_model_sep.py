@@ -2,7 +2,8 @@ import torch
 from torch import nn
 from torch.autograd import Variable
 import torch.nn.functional as F
-from bidaf import BiDAF
+import numpy as np
+from bidaf import BiDAF, scatter_scores
 
 class ContextMRR_Sep(nn.Module):
 	def __init__(self, args, loader):
@@ -47,11 +48,25 @@ class ContextMRR_Sep(nn.Module):
 
 		self.loss = torch.nn.CrossEntropyLoss()
 
+	## The context and candidate encodings do not depend on the question, so callers can compute them once per
+	## document and pass them to forward/eval of every question of that document. Dropout is applied afterwards.
+	def encode_context(self, batch_context, batch_context_length):
+		context_embedded = batch_context.unsqueeze(0)
+		# (N, T, 2d) for BiDAF 1 and BiDAF 2
+		context_encoded, _ = self.contextual_embedding_layer(context_embedded, batch_context_length)
+		context_encoded_2, _ = self.contextual_embedding_layer_2(context_embedded, batch_context_length)
+		return context_encoded, context_encoded_2
+
+	def encode_candidates(self, batch_candidates_sorted, batch_candidate_lengths_sorted):
+		# (N1, K, 2d), (N1, 2d)
+		batch_candidates_encoded, batch_candidates_hidden = self.contextual_embedding_layer_2(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
+		return batch_candidates_encoded, batch_candidates_hidden
 
 	def forward(self, batch_query, batch_query_length,batch_query_mask,
 				batch_context, batch_context_length,batch_context_mask,
 				batch_candidates_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,batch_candidate_unsort,
-				gold_index, negative_indices):
+				gold_index, negative_indices, context_encoding=None, candidates_encoding=None):
 
 		## Embed query and context
 		# (N, J, d)
@@ -60,15 +75,15 @@ class ContextMRR_Sep(nn.Module):
 		#context_embedded = self.word_embedding_layer(batch_context.unsqueeze(0))
 
 		query_embedded = batch_query.unsqueeze(0)
-		context_embedded = batch_context.unsqueeze(0)
 		## Encode query and context
 		# (N, J, 2d)
 		query_encoded,query_encoded_hidden = self.contextual_embedding_layer(query_embedded, batch_query_length)
 		query_encoded_hidden = torch.cat([query_encoded_hidden[-2], query_encoded_hidden[-1]], dim=1)
 		query_encoded = self._dropout(query_encoded)
 		# (N, T, 2d)
-		context_encoded,_ = self.contextual_embedding_layer(context_embedded, batch_context_length)
-		context_encoded = self._dropout(context_encoded)
+		if context_encoding is None:
+			context_encoding = self.encode_context(batch_context, batch_context_length)
+		context_encoded = self._dropout(context_encoding[0])
 
 		## required to support single element batch of question
 		batch_query_mask = batch_query_mask.unsqueeze(0)
@@ -79,7 +94,7 @@ class ContextMRR_Sep(nn.Module):
 		#context_attention_encoded, query_aware_context_encoded, context_aware_query_encoded = self.attention_flow_layer1(query_encoded, context_encoded,batch_query_mask,batch_context_mask)
 
 		query_attention_encoded, context_aware_query_encoded, query_aware_context_encoded = self.attention_flow_layer1(
-			context_encoded, query_encoded, batch_context_mask,batch_query_mask)
+			context_encoded, query_encoded, batch_context_mask.unsqueeze(1),batch_query_mask)
 
 		## modelling layer 1
 		# (N, T, 8d) => (N, T, 2d)
@@ -91,21 +106,15 @@ class ContextMRR_Sep(nn.Module):
 		BIDAF 2
 		'''
 		## BiDAF for answers
-		batch_size = batch_candidates_sorted.size(0)
 		# N=1 so (N, T, 2d) => (N1, T, 2d)
-		context_encoded_2, _ = self.contextual_embedding_layer_2(context_embedded, batch_context_length)
-		context_encoded_2 = self._dropout(context_encoded_2)
-		batch_context_modeled = context_encoded_2.expand(batch_size,context_encoded_2.size(1), context_encoded_2.size(2))
-		# (N1, K, d)
-
-		batch_candidates_embedded = batch_candidates_sorted
+		context_encoded_2 = self._dropout(context_encoding[1])
 		# (N1, K, 2d)
-		batch_candidates_encoded,batch_candidates_hidden = self.contextual_embedding_layer_2(batch_candidates_embedded, batch_candidate_lengths_sorted)
-		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
+		if candidates_encoding is None:
+			candidates_encoding = self.encode_candidates(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_encoded, batch_candidates_hidden = candidates_encoding
 		batch_candidates_encoded = self._dropout(batch_candidates_encoded)
-
-		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2(
-			batch_context_modeled, batch_candidates_encoded, batch_context_mask, batch_candidate_masks_sorted)
+		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2.forward_broadcast(
+			context_encoded_2, batch_candidates_encoded, batch_context_mask, batch_candidate_masks_sorted)
 
 		## modelling layer 2
 		# (N1, K, 8d) => (N1, K, 2d)
@@ -124,7 +133,8 @@ class ContextMRR_Sep(nn.Module):
 
 	def eval(self,batch_query, batch_query_length,batch_query_mask,
 				batch_context, batch_context_length,batch_context_mask,
-			 batch_candidates_sorted, batch_candidate_lengths_sorted,batch_candidate_masks_sorted, batch_candidate_unsort):
+			 batch_candidates_sorted, batch_candidate_lengths_sorted,batch_candidate_masks_sorted, batch_candidate_unsort,
+			 context_encoding=None, candidates_encoding=None):
 		## Embed query and context
 		# (N, J, d)
 		# query_embedded = self.word_embedding_layer(batch_query.unsqueeze(0))
@@ -132,7 +142,6 @@ class ContextMRR_Sep(nn.Module):
 		# context_embedded = self.word_embedding_layer(batch_context.unsqueeze(0))
 
 		query_embedded = batch_query.unsqueeze(0)
-		context_embedded = batch_context.unsqueeze(0)
 		## Encode query and context
 		# (N, J, 2d)
 		query_encoded, query_encoded_hidden = self.contextual_embedding_layer(query_embedded,
@@ -140,8 +149,9 @@ class ContextMRR_Sep(nn.Module):
 		query_encoded_hidden = torch.cat([query_encoded_hidden[-2], query_encoded_hidden[-1]], dim=1)
 		query_encoded = self._dropout(query_encoded)
 		# (N, T, 2d)
-		context_encoded, _ = self.contextual_embedding_layer(context_embedded, batch_context_length)
-		context_encoded = self._dropout(context_encoded)
+		if context_encoding is None:
+			context_encoding = self.encode_context(batch_context, batch_context_length)
+		context_encoded = self._dropout(context_encoding[0])
 
 		## required to support single element batch of question
 		batch_query_mask = batch_query_mask.unsqueeze(0)
@@ -152,7 +162,7 @@ class ContextMRR_Sep(nn.Module):
 		# context_attention_encoded, query_aware_context_encoded, context_aware_query_encoded = self.attention_flow_layer1(query_encoded, context_encoded,batch_query_mask,batch_context_mask)
 
 		query_attention_encoded, context_aware_query_encoded, query_aware_context_encoded = self.attention_flow_layer1(
-			context_encoded, query_encoded, batch_context_mask, batch_query_mask)
+			context_encoded, query_encoded, batch_context_mask.unsqueeze(1), batch_query_mask)
 
 		## modelling layer 1
 		# (N, T, 8d) => (N, T, 2d)
@@ -164,23 +174,15 @@ class ContextMRR_Sep(nn.Module):
         BIDAF 2
         '''
 		## BiDAF for answers
-		batch_size = batch_candidates_sorted.size(0)
 		# N=1 so (N, T, 2d) => (N1, T, 2d)
-		context_encoded_2, _ = self.contextual_embedding_layer_2(context_embedded, batch_context_length)
-		context_encoded_2 = self._dropout(context_encoded_2)
-		batch_context_modeled = context_encoded_2.expand(batch_size, context_encoded_2.size(1),
-														 context_encoded_2.size(2))
-		# (N1, K, d)
-
-		batch_candidates_embedded = batch_candidates_sorted
+		context_encoded_2 = self._dropout(context_encoding[1])
 		# (N1, K, 2d)
-		batch_candidates_encoded, batch_candidates_hidden = self.contextual_embedding_layer_2(
-			batch_candidates_embedded, batch_candidate_lengths_sorted)
-		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
+		if candidates_encoding is None:
+			candidates_encoding = self.encode_candidates(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_encoded, batch_candidates_hidden = candidates_encoding
 		batch_candidates_encoded = self._dropout(batch_candidates_encoded)
-
-		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2(
-			batch_context_modeled, batch_candidates_encoded, batch_context_mask, batch_candidate_masks_sorted)
+		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2.forward_broadcast(
+			context_encoded_2, batch_candidates_encoded, batch_context_mask, batch_candidate_masks_sorted)
 
 		## modelling layer 2
 		# (N1, K, 8d) => (N1, K, 2d)
@@ -197,6 +199,84 @@ class ContextMRR_Sep(nn.Module):
 		sorted, indices = torch.sort(F.log_softmax(answer_scores_unsorted.squeeze(0), dim=0), dim=0, descending=True)
 		return indices
 
+	## Batched variants of forward/eval for N questions at once. Queries and contexts are padded, candidates are
+	## flattened into the pairs of (question, candidate) that actually exist:
+	##   batch_query (N, J, d), batch_query_mask (N, J)
+	##   batch_context (M, T, d), batch_context_mask (M, T): one row per distinct context, context_index (N) maps
+	##   each question to its row
+	##   batch_candidates (P, K, d), batch_candidate_masks (P, K): candidates of all distinct pools, in any order
+	##   pair_candidate_index, pair_question_index, pair_position (Pq): candidate row, question and position of
+	##   each pair in the question's own candidate list
+	## Lengths are numpy arrays and need not be sorted. Scores come back as (N, num_candidates), padded with -1e7.
+	def forward_batch(self, batch_query, batch_query_lengths, batch_query_mask,
+					  batch_context, batch_context_lengths, batch_context_mask, context_index,
+					  batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+					  pair_candidate_index, pair_question_index, pair_position, num_candidates, gold_index=None):
+
+		batch_size = batch_query.size(0)
+		## Encode query and context
+		# (N, J, 2d), (N, 2d)
+		query_encoded, query_encoded_hidden = self.contextual_embedding_layer.forward_unsorted(batch_query, batch_query_lengths)
+		query_encoded_hidden = torch.cat([query_encoded_hidden[-2], query_encoded_hidden[-1]], dim=1)
+		query_encoded = self._dropout(query_encoded)
+		# (M, T, 2d) => (N, T, 2d)
+		context_encoded, _ = self.contextual_embedding_layer.forward_unsorted(batch_context, batch_context_lengths)
+		context_encoded = self._dropout(context_encoded.index_select(0, context_index))
+		batch_context_mask = batch_context_mask.index_select(0, context_index)
+
+		query_attention_encoded, context_aware_query_encoded, query_aware_context_encoded = self.attention_flow_layer1.forward_padded(
+			context_encoded, query_encoded, batch_context_mask, batch_query_mask)
+
+		## modelling layer 1
+		# (N, J, 8d) => (N, 6d)
+		query_modeled, query_modeled_hidden = self.modeling_layer1.forward_unsorted(query_attention_encoded, batch_query_lengths)
+		query_modeled = torch.cat([query_encoded_hidden, query_modeled_hidden[-2], query_modeled_hidden[-1]], dim=1)
+
+		'''
+		BIDAF 2
+		'''
+		## BiDAF between the context of each question and each of its candidates
+		# (M, T, 2d) => (N, T, 2d) => (Pq, T, 2d)
+		context_encoded_2, _ = self.contextual_embedding_layer_2.forward_unsorted(batch_context, batch_context_lengths)
+		context_encoded_2 = self._dropout(context_encoded_2.index_select(0, context_index))
+		batch_context_modeled = context_encoded_2.index_select(0, pair_question_index)
+		pair_context_mask = batch_context_mask.index_select(0, pair_question_index)
+
+		# (P, K, 2d) => (Pq, K, 2d)
+		batch_candidates_encoded, batch_candidates_hidden = self.contextual_embedding_layer_2.forward_unsorted(batch_candidates, batch_candidate_lengths)
+		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
+		batch_candidates_hidden = batch_candidates_hidden.index_select(0, pair_candidate_index)
+		batch_candidates_encoded = self._dropout(batch_candidates_encoded.index_select(0, pair_candidate_index))
+		pair_candidate_masks = batch_candidate_masks.index_select(0, pair_candidate_index)
+		pair_candidate_lengths = np.asarray(batch_candidate_lengths)[pair_candidate_index.data.cpu().numpy()]
+
+		answer_attention_encoded, context_aware_answer_encoded, answer_aware_context_encoded = self.attention_flow_layer2.forward_padded(
+			batch_context_modeled, batch_candidates_encoded, pair_context_mask, pair_candidate_masks)
+
+		## modelling layer 2
+		# (Pq, K, 8d) => (Pq, 6d)
+		answer_modeled, answer_hidden_state = self.modeling_layer2.forward_unsorted(answer_attention_encoded, pair_candidate_lengths)
+		answer_hidden_state = torch.cat([batch_candidates_hidden, answer_hidden_state[-2], answer_hidden_state[-1]], dim=1)
+		answer_modeled = self._dropout(answer_hidden_state)
+
+		# (Pq, 6d) . (Pq, 6d) => (Pq) => (N, C)
+		answer_scores = torch.sum(answer_modeled * query_modeled.index_select(0, pair_question_index), dim=1)
+		answer_scores = scatter_scores(answer_scores, pair_question_index, pair_position, batch_size, num_candidates)
+		sorted, indices = torch.sort(F.log_softmax(answer_scores, dim=1), dim=1, descending=True)
+		if gold_index is None:
+			return indices
+		loss = self.loss(answer_scores, gold_index)
+		return loss, indices
+
+	def eval_batch(self, batch_query, batch_query_lengths, batch_query_mask,
+				   batch_context, batch_context_lengths, batch_context_mask, context_index,
+				   batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+				   pair_candidate_index, pair_question_index, pair_position, num_candidates):
+		return self.forward_batch(batch_query, batch_query_lengths, batch_query_mask,
+								  batch_context, batch_context_lengths, batch_context_mask, context_index,
+								  batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+								  pair_candidate_index, pair_question_index, pair_position, num_candidates)
+
 
 
 
@@ -230,12 +310,26 @@ class RecurrentContext(nn.Module):
 		outputs_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
 		return outputs_unpacked, hidden
 
+	def forward_unsorted(self, batch, batch_length):
+		## pack_padded_sequence needs decreasing lengths: sort the batch, run it and restore the original order
+		batch_length = np.asarray(batch_length)
+		sort = np.argsort(-batch_length, kind="mergesort")
+		sort_index = Variable(batch.data.new(sort.tolist()).long())
+		unsort_index = Variable(batch.data.new(np.argsort(sort).tolist()).long())
+		outputs, hidden = self.forward(batch.index_select(0, sort_index), batch_length[sort])
+		outputs = outputs.index_select(0, unsort_index)
+		if isinstance(hidden, tuple):
+			hidden = tuple(h.index_select(1, unsort_index) for h in hidden)
+		else:
+			hidden = hidden.index_select(1, unsort_index)
+		return outputs, hidden
+
 
 class LookupEncoder(nn.Module):
-    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None):
+    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None, sparse=False):
         super(LookupEncoder, self).__init__()
         self.embedding_dim = embedding_dim
-        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim)
+        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
         if pretrain_embedding is not None:
             self.word_embeddings.weight.data.copy_(torch.from_numpy(pretrain_embedding))
     def forward(self, batch):
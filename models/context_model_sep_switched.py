@@ -2,7 +2,8 @@ import torch
 from torch import nn
 from torch.autograd import Variable
 import torch.nn.functional as F
-from bidaf import BiDAF
+import numpy as np
+from bidaf import BiDAF, replace_masked_values, scatter_scores
 
 class ContextMRR_Sep_Switched(nn.Module):
 	def __init__(self, args, loader):
@@ -32,23 +33,35 @@ class ContextMRR_Sep_Switched(nn.Module):
 
 		self.loss = torch.nn.CrossEntropyLoss()
 
+	## The context and candidate encodings do not depend on the question, so callers can compute them once per
+	## document and pass them to forward/eval of every question of that document. Dropout is applied afterwards.
+	def encode_context(self, batch_context, batch_context_length):
+		# (N, T, d) => (N, T, 2d)
+		context_encoded, _ = self.contextual_embedding_layer(batch_context.unsqueeze(0), batch_context_length)
+		return context_encoded
+
+	def encode_candidates(self, batch_candidates_sorted, batch_candidate_lengths_sorted):
+		## only the final hidden states of the candidates are used
+		# (N1, K, d) => (N1, 2d)
+		_, batch_candidates_hidden = self.contextual_embedding_layer(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		return torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
 
 	def forward(self, batch_query, batch_query_length,batch_query_mask,
 				batch_context, batch_context_length,batch_context_mask,
 				batch_candidates_sorted, batch_candidate_lengths_sorted, batch_candidate_masks_sorted,batch_candidate_unsort,
-				gold_index, negative_indices):
+				gold_index, negative_indices, context_encoding=None, candidates_encoding=None):
 
 
 		query_embedded = batch_query.unsqueeze(0)
-		context_embedded = batch_context.unsqueeze(0)
 		## Encode query and context
 		# (N, J, 2d)
 		query_encoded,query_encoded_hidden = self.contextual_embedding_layer(query_embedded, batch_query_length)
 		query_encoded_hidden = torch.cat([query_encoded_hidden[-2], query_encoded_hidden[-1]], dim=1)
 		query_encoded = self._dropout(query_encoded)
 		# (N, T, 2d)
-		context_encoded,_ = self.contextual_embedding_layer(context_embedded, batch_context_length)
-		context_encoded = self._dropout(context_encoded)
+		if context_encoding is None:
+			context_encoding = self.encode_context(batch_context, batch_context_length)
+		context_encoded = self._dropout(context_encoding)
 
 		## required to support single element batch of question
 		batch_query_mask = batch_query_mask.unsqueeze(0)
@@ -68,15 +81,13 @@ class ContextMRR_Sep_Switched(nn.Module):
 		# query_aware_context_modeled = self._dropout(query_aware_context_modeled)
 
 
-		batch_size = batch_candidates_sorted.size(0)
+		# (N1, 2d)
+		if candidates_encoding is None:
+			candidates_encoding = self.encode_candidates(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_hidden = self._dropout(candidates_encoding)
+		batch_size = batch_candidates_hidden.size(0)
 		batch_context_modeled = context_avg_pool.expand(batch_size,context_avg_pool.size(1))
 
-		batch_candidates_embedded = batch_candidates_sorted
-		# (N1, K, 2d)
-		batch_candidates_encoded,batch_candidates_hidden = self.contextual_embedding_layer(batch_candidates_embedded, batch_candidate_lengths_sorted)
-		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
-		batch_candidates_hidden = self._dropout(batch_candidates_hidden)
-
 		context_answer_hidden_state = torch.cat([batch_candidates_hidden,batch_context_modeled, query_encoded_hidden.expand(batch_size,query_encoded_hidden.size(1))], dim=1)
 		answer_scores = self.output_layer(context_answer_hidden_state)
 		answer_modeled = self._dropout(answer_scores)
@@ -91,18 +102,19 @@ class ContextMRR_Sep_Switched(nn.Module):
 
 	def eval(self,batch_query, batch_query_length,batch_query_mask,
 				batch_context, batch_context_length,batch_context_mask,
-			 batch_candidates_sorted, batch_candidate_lengths_sorted,batch_candidate_masks_sorted, batch_candidate_unsort):
+			 batch_candidates_sorted, batch_candidate_lengths_sorted,batch_candidate_masks_sorted, batch_candidate_unsort,
+			 context_encoding=None, candidates_encoding=None):
 
 		query_embedded = batch_query.unsqueeze(0)
-		context_embedded = batch_context.unsqueeze(0)
 		## Encode query and context
 		# (N, J, 2d)
 		query_encoded, query_encoded_hidden = self.contextual_embedding_layer(query_embedded, batch_query_length)
 		query_encoded_hidden = torch.cat([query_encoded_hidden[-2], query_encoded_hidden[-1]], dim=1)
 		query_encoded = self._dropout(query_encoded)
 		# (N, T, 2d)
-		context_encoded, _ = self.contextual_embedding_layer(context_embedded, batch_context_length)
-		context_encoded = self._dropout(context_encoded)
+		if context_encoding is None:
+			context_encoding = self.encode_context(batch_context, batch_context_length)
+		context_encoded = self._dropout(context_encoding)
 
 		## required to support single element batch of question
 		batch_query_mask = batch_query_mask.unsqueeze(0)
@@ -122,16 +134,13 @@ class ContextMRR_Sep_Switched(nn.Module):
 		# query_aware_context_modeled = self.linearrelu(context_avg_pool)
 		# query_aware_context_modeled = self._dropout(query_aware_context_modeled)
 
-		batch_size = batch_candidates_sorted.size(0)
+		# (N1, 2d)
+		if candidates_encoding is None:
+			candidates_encoding = self.encode_candidates(batch_candidates_sorted, batch_candidate_lengths_sorted)
+		batch_candidates_hidden = self._dropout(candidates_encoding)
+		batch_size = batch_candidates_hidden.size(0)
 		batch_context_modeled = context_avg_pool.expand(batch_size, context_avg_pool.size(1))
 
-		batch_candidates_embedded = batch_candidates_sorted
-		# (N1, K, 2d)
-		batch_candidates_encoded, batch_candidates_hidden = self.contextual_embedding_layer(batch_candidates_embedded,
-																							batch_candidate_lengths_sorted)
-		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
-		batch_candidates_hidden = self._dropout(batch_candidates_hidden)
-
 		context_answer_hidden_state = torch.cat([batch_candidates_hidden, batch_context_modeled, query_encoded_hidden.expand(batch_size,query_encoded_hidden.size(1))], dim=1)
 		answer_scores = self.output_layer(context_answer_hidden_state)
 		answer_modeled = self._dropout(answer_scores)
@@ -142,6 +151,71 @@ class ContextMRR_Sep_Switched(nn.Module):
 		sorted, indices = torch.sort(answer_modeled, dim=0, descending=True)
 		return indices
 
+	## Batched variants of forward/eval for N questions at once. Queries and contexts are padded, candidates are
+	## flattened into the pairs of (question, candidate) that actually exist:
+	##   batch_query (N, J, d), batch_query_mask (N, J)
+	##   batch_context (M, T, d), batch_context_mask (M, T): one row per distinct context, context_index (N) maps
+	##   each question to its row
+	##   batch_candidates (P, K, d), batch_candidate_masks (P, K): candidates of all distinct pools, in any order
+	##   pair_candidate_index, pair_question_index, pair_position (Pq): candidate row, question and position of
+	##   each pair in the question's own candidate list
+	## Lengths are numpy arrays and need not be sorted. Scores come back as (N, num_candidates), padded with -1e7.
+	def forward_batch(self, batch_query, batch_query_lengths, batch_query_mask,
+					  batch_context, batch_context_lengths, batch_context_mask, context_index,
+					  batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+					  pair_candidate_index, pair_question_index, pair_position, num_candidates, gold_index=None):
+
+		batch_size = batch_query.size(0)
+		## Encode query and context
+		# (N, J, 2d), (N, 2d)
+		query_encoded, query_encoded_hidden = self.contextual_embedding_layer.forward_unsorted(batch_query, batch_query_lengths)
+		query_encoded_hidden = torch.cat([query_encoded_hidden[-2], query_encoded_hidden[-1]], dim=1)
+		query_encoded = self._dropout(query_encoded)
+		# (M, T, 2d) => (N, T, 2d)
+		context_encoded, _ = self.contextual_embedding_layer.forward_unsorted(batch_context, batch_context_lengths)
+		context_encoded = self._dropout(context_encoded.index_select(0, context_index))
+		batch_context_mask = batch_context_mask.index_select(0, context_index)
+		context_lengths = np.asarray(batch_context_lengths)[context_index.data.cpu().numpy()]
+
+		context_attention_encoded, context_aware_query_encoded, query_aware_context_encoded = self.attention_flow_layer1.forward_padded(
+			query_encoded, context_encoded, batch_query_mask, batch_context_mask)
+
+		# (N,T,2d) => (N,4d), pooling only over the real positions of each context
+		context_modeled, _ = self.modeling_layer1.forward_unsorted(context_aware_query_encoded, context_lengths)
+		context_modeled = self._dropout(context_modeled)
+		context_max_pool = torch.max(replace_masked_values(context_modeled, batch_context_mask.unsqueeze(2), -1e7), dim=1)[0]
+		context_mean_pool = torch.sum(context_modeled * batch_context_mask.unsqueeze(2), dim=1) / batch_context_mask.sum(1).unsqueeze(1)
+		context_avg_pool = torch.cat([context_max_pool, context_mean_pool], dim=1)
+
+		# (P, K, d) => (P, 2d) => (Pq, 2d)
+		_, batch_candidates_hidden = self.contextual_embedding_layer.forward_unsorted(batch_candidates, batch_candidate_lengths)
+		batch_candidates_hidden = torch.cat([batch_candidates_hidden[-2], batch_candidates_hidden[-1]], dim=1)
+		batch_candidates_hidden = self._dropout(batch_candidates_hidden.index_select(0, pair_candidate_index))
+
+		context_answer_hidden_state = torch.cat([batch_candidates_hidden,
+												 context_avg_pool.index_select(0, pair_question_index),
+												 query_encoded_hidden.index_select(0, pair_question_index)], dim=1)
+		answer_scores = self.output_layer(context_answer_hidden_state)
+		answer_modeled = self._dropout(answer_scores).squeeze(1)
+
+		# (Pq) => (N, C)
+		answer_modeled = scatter_scores(answer_modeled, pair_question_index, pair_position, batch_size, num_candidates)
+		answer_modeled = F.log_softmax(answer_modeled, dim=1)
+		sorted, indices = torch.sort(answer_modeled, dim=1, descending=True)
+		if gold_index is None:
+			return indices
+		loss = self.loss(answer_modeled, gold_index)
+		return loss, indices
+
+	def eval_batch(self, batch_query, batch_query_lengths, batch_query_mask,
+				   batch_context, batch_context_lengths, batch_context_mask, context_index,
+				   batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+				   pair_candidate_index, pair_question_index, pair_position, num_candidates):
+		return self.forward_batch(batch_query, batch_query_lengths, batch_query_mask,
+								  batch_context, batch_context_lengths, batch_context_mask, context_index,
+								  batch_candidates, batch_candidate_lengths, batch_candidate_masks,
+								  pair_candidate_index, pair_question_index, pair_position, num_candidates)
+
 
 
 
@@ -191,12 +265,26 @@ class RecurrentContext(nn.Module):
 		outputs_unpacked, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
 		return outputs_unpacked, hidden
 
+	def forward_unsorted(self, batch, batch_length):
+		## pack_padded_sequence needs decreasing lengths: sort the batch, run it and restore the original order
+		batch_length = np.asarray(batch_length)
+		sort = np.argsort(-batch_length, kind="mergesort")
+		sort_index = Variable(batch.data.new(sort.tolist()).long())
+		unsort_index = Variable(batch.data.new(np.argsort(sort).tolist()).long())
+		outputs, hidden = self.forward(batch.index_select(0, sort_index), batch_length[sort])
+		outputs = outputs.index_select(0, unsort_index)
+		if isinstance(hidden, tuple):
+			hidden = tuple(h.index_select(1, unsort_index) for h in hidden)
+		else:
+			hidden = hidden.index_select(1, unsort_index)
+		return outputs, hidden
+
 
 class LookupEncoder(nn.Module):
-    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None):
+    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None, sparse=False):
         super(LookupEncoder, self).__init__()
         self.embedding_dim = embedding_dim
-        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim)
+        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
         if pretrain_embedding is not None:
             self.word_embeddings.weight.data.copy_(torch.from_numpy(pretrain_embedding))
     def forward(self, batch):
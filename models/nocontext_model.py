@@ -4,10 +4,10 @@ from torch import nn
 import torch.nn.functional as F
 
 class LookupEncoder(nn.Module):
-    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None):
+    def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None, sparse=False):
         super(LookupEncoder, self).__init__()
         self.embedding_dim = embedding_dim
-        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim)
+        self.word_embeddings = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
         if pretrain_embedding is not None:
             self.word_embeddings.weight.data.copy_(torch.from_numpy(pretrain_embedding))
     def forward(self, batch):
@@ -27,7 +27,8 @@ class NoContext(nn.Module):
         self.args = args
         # self.loader = loader
         #Embedding layer
-        self.embedding = LookupEncoder(input_size, embed_size,loader.pretrain_embedding)
+        ## with sparse embeddings only the rows of the words in a batch get a gradient and an optimizer update
+        self.embedding = LookupEncoder(input_size, embed_size,loader.pretrain_embedding, sparse=args.sparse_embeddings)
         #self.ner_embedding = nn.Embedding(ner_tag_size, ner_dim)
         #self.pos_embedding = nn.Embedding(pos_tag_size, pos_dim)
         embed_rep = embed_size #+ ner_dim + pos_dim
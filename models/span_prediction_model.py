@@ -308,10 +308,10 @@ class RecurrentContext(nn.Module):
 
 
 class LookupEncoder(nn.Module):
-	def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None):
+	def __init__(self, vocab_size, embedding_dim, pretrain_embedding=None, sparse=False):
 		super(LookupEncoder, self).__init__()
 		self.embedding_dim = embedding_dim
-		self.word_embeddings = nn.Embedding(vocab_size, embedding_dim)
+		self.word_embeddings = nn.Embedding(vocab_size, embedding_dim, sparse=sparse)
 		# self.word_embeddings.weight.data.copy_(torch.from_numpy(pretrain_embedding))
 
 	def forward(self, batch):
@@ -1,12 +1,13 @@
 import argparse
 import sys
+import os
 
-from dataloaders.dataloader import DataLoader, create_batches,view_batch
+from dataloaders.dataloader import DataLoader, Vocabulary, create_batches,view_batch
 from models.nocontext_model import NoContext
 
 import torch
 from torch import optim
-from dataloaders.utility import variable,view_data_point,get_pretrained_emb
+from dataloaders.utility import variable,view_data_point,get_pretrained_emb,SparseDenseOptimizer
 import numpy as np
 from time import time
 import random
@@ -86,7 +87,8 @@ def train_epochs(model, vocab):
     clip_threshold = args.clip_threshold
     eval_interval = args.eval_interval
 
-    optimizer = optim.Adam(model.parameters(), lr= args.learning_rate)
+    ## SparseAdam for the embeddings with --sparse_embeddings, Adam for everything else
+    optimizer = SparseDenseOptimizer(model, args.learning_rate)
     train_loss = 0
     train_denom = 0
     validation_history = []
@@ -187,7 +189,8 @@ def train_epochs(model, vocab):
 
             mean_loss = torch.mean(loss_total,0)
             mean_loss.backward()
-            torch.nn.utils.clip_grad_norm(model.parameters(), clip_threshold)
+            ## sparse embedding gradients are left out of the norm
+            torch.nn.utils.clip_grad_norm(optimizer.dense_parameters, clip_threshold)
             optimizer.step()
 
 
@@ -225,6 +228,7 @@ if __name__ == "__main__":
     parser.add_argument("--model_path", type=str, default="../best.md")
     parser.add_argument("--job_size", type=int, default=5)
     parser.add_argument("--pretrain_path", type=str, default=None, help="Path to the pre-trained word embeddings")
+    parser.add_argument("--pretrain_cache", type=str, default=None, help="Path prefix of the binary cache of --pretrain_path (.data and .index), next to it by default")
     parser.add_argument("--max_documents", type=int, default=0, help="If greater than 0, load at most this many documents")
 
     #Model parameters
@@ -242,6 +246,10 @@ if __name__ == "__main__":
     parser.add_argument("--pos_dim", type=int, default=32)
     parser.add_argument("--dropout", type=float,default=0.5)
     parser.add_argument("--meteor_path", type=str, default=10)
+    parser.add_argument("--sparse_embeddings", action="store_true", default=False, help="Sparse gradients and SparseAdam updates for the word embeddings")
+    parser.add_argument("--min_frequency", type=int, default=1, help="Words of the training set occurring less often map to unk")
+    parser.add_argument("--max_vocab_size", type=int, default=0, help="If greater than 0, keep at most this many of the most frequent words")
+    parser.add_argument("--vocab_path", type=str, default=None, help="Vocabulary saved by an earlier run, or where to save this one")
 
     args = parser.parse_args()
 
@@ -253,6 +261,12 @@ if __name__ == "__main__":
         vars(args)['use_cuda'] = False
 
     loader = DataLoader(args)
+    ## a saved vocabulary keeps the word ids of the model it was trained with
+    vocab_exists = args.vocab_path is not None and os.path.exists(args.vocab_path)
+    if vocab_exists:
+        loader.vocab = Vocabulary.load(args.vocab_path)
+    else:
+        loader.vocab = Vocabulary(min_frequency=args.min_frequency, max_size=args.max_vocab_size)
 
 
     start = time()
@@ -262,11 +276,13 @@ if __name__ == "__main__":
 
     end = time()
     print(end-start)
+    if args.vocab_path is not None and not vocab_exists:
+        loader.vocab.save(args.vocab_path)
 
 
     #Get pre_trained embeddings
     if args.pretrain_path is not None:
-        word_embedding = get_pretrained_emb(args.pretrain_path, loader.vocab.vocabulary, args.embed_size)
+        word_embedding = get_pretrained_emb(args.pretrain_path, loader.vocab.vocabulary, args.embed_size, cache_path=args.pretrain_cache)
         loader.pretrain_embedding = word_embedding
 
     model = NoContext(args, loader)
@@ -23,13 +23,17 @@ if __name__ == "__main__":
     parser.add_argument("--summary_only", action="store_true", help="create summary pickles")
     parser.add_argument("--small_number", type=int, default=-1,
                         help="Pickle small number of documents for testing purposes")                                                
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes that tokenize and tag documents in parallel")
+    parser.add_argument("--cache_folder", type=str, default=None,
+                        help="Path to a directory that caches every processed document, so interrupted runs can resume")
 
     
     args = parser.parse_args()
     loader=DataLoader(args)
 
 
-    loader.process_data(args.input_folder, args.summary_path, args.qap_path, args.document_path, args.pickle_folder, small_number=args.small_number, summary_only=args.summary_only)
+    loader.process_data(args.input_folder, args.summary_path, args.qap_path, args.document_path, args.pickle_folder, small_number=args.small_number, summary_only=args.summary_only, workers=args.workers, cache_folder=args.cache_folder)
 
 
 
@@ -0,0 +1,74 @@
+import numpy as np
+from collections import Counter
+from scipy import sparse
+from preprocessing import top_k_indices
+
+
+class BM25(object):
+	"""
+	Okapi BM25 over a corpus of tokenized chunks, with the scores of gensim's BM25 (up to 3.6): the idf of a term is
+	log(N - df + 0.5) - log(df + 0.5), and terms with a negative idf get epsilon * the average idf instead.
+	The weight of every (chunk, term) pair is computed once into a sparse matrix, so all queries of a document are
+	scored with one sparse matrix product instead of a python loop over the words of every query and chunk.
+	"""
+	def __init__(self, corpus=None, k1=1.5, b=0.75, epsilon=0.25, vocabulary=None, counts=None):
+		## either a corpus of tokenized chunks, or its {term: column} vocabulary and (chunks, terms) sparse counts
+		self.k1 = k1
+		self.b = b
+		self.epsilon = epsilon
+		if corpus is not None:
+			vocabulary, counts = corpus_counts(corpus)
+		self.vocabulary = vocabulary
+		self.corpus_size = counts.shape[0]
+
+		counts = counts.tocoo()
+		rows = counts.row.astype(np.int64)
+		columns = counts.col.astype(np.int64)
+		counts_data = counts.data.astype(np.float64)
+
+		document_frequency = np.bincount(columns, minlength=len(self.vocabulary)).astype(np.float64)
+		self.idf = np.log(self.corpus_size - document_frequency + 0.5) - np.log(document_frequency + 0.5)
+		self.average_idf = float(self.idf.mean()) if len(self.idf) > 0 else 0.0
+		idf = np.where(self.idf >= 0, self.idf, self.epsilon * self.average_idf)
+
+		chunk_lengths = np.bincount(rows, weights=counts_data, minlength=self.corpus_size)
+		average_length = chunk_lengths.sum() / max(self.corpus_size, 1)
+		normalization = self.k1 * (1 - self.b + self.b * chunk_lengths[rows] / average_length) if average_length > 0 else self.k1
+		weights = idf[columns] * counts_data * (self.k1 + 1) / (counts_data + normalization)
+		## (terms, chunks), so a query matrix of term counts multiplies it directly
+		self.weights = sparse.csr_matrix((weights, (columns, rows)), shape=(len(self.vocabulary), self.corpus_size))
+
+	def query_matrix(self, queries):
+		## (queries, terms) counts; a repeated query word counts as often as it occurs, as in gensim, unknown words score 0
+		rows = []
+		columns = []
+		for index, query in enumerate(queries):
+			for word in query:
+				if word in self.vocabulary:
+					rows.append(index)
+					columns.append(self.vocabulary[word])
+		data = np.ones(len(rows), dtype=np.float64)
+		return sparse.csr_matrix((data, (rows, columns)), shape=(len(queries), len(self.vocabulary)))
+
+	def get_scores(self, queries):
+		## (queries, chunks) dense array of scores
+		return np.asarray((self.query_matrix(queries) * self.weights).todense())
+
+	def top_k(self, queries, k):
+		## indices of the k best chunks of every query, best first
+		return top_k_indices(self.get_scores(queries), k)
+
+
+def corpus_counts(corpus):
+	## {term: column} vocabulary and (chunks, terms) sparse term counts of a corpus of tokenized chunks
+	vocabulary = {}
+	rows = []
+	columns = []
+	counts = []
+	for index, chunk in enumerate(corpus):
+		for word, count in Counter(chunk).items():
+			rows.append(index)
+			columns.append(vocabulary.setdefault(word, len(vocabulary)))
+			counts.append(count)
+	return vocabulary, sparse.csr_matrix((np.array(counts, dtype=np.float64), (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64))),
+										 shape=(len(corpus), len(vocabulary)))
@@ -0,0 +1,72 @@
+import numpy as np
+from scipy import sparse
+from preprocessing import DocumentCache, encode_strings, decode_strings, flatten
+
+
+class ChunkIndex(object):
+	"""
+	Everything retrieval needs to know about the chunks of one document, so that runs with another --ir_model or
+	--num_chunks do not tokenize, parse and chunk the book again:
+	the tokens and sentence boundaries of every chunk, and the term counts bm25 and tfidf score with, as sparse
+	(chunks x terms) matrices over the document's own lemma and n-gram vocabularies.
+	Stored as one .npz of flat arrays; strings are stored as utf-8 bytes with their lengths.
+	"""
+	def __init__(self, chunks, sentence_boundaries, lemma_terms, lemma_counts, tfidf_terms, tfidf_counts):
+		self.chunks = chunks
+		self.sentence_boundaries = sentence_boundaries
+		self.lemma_terms = lemma_terms
+		self.lemma_counts = lemma_counts
+		self.tfidf_terms = tfidf_terms
+		self.tfidf_counts = tfidf_counts
+
+	def __len__(self):
+		return len(self.chunks)
+
+	def chunk_text(self, index):
+		return " ".join(self.chunks[index])
+
+	def chunk_texts(self):
+		return [" ".join(chunk) for chunk in self.chunks]
+
+	def save(self, fout):
+		token_vocabulary = {}
+		token_ids, chunk_offsets = flatten([[token_vocabulary.setdefault(token, len(token_vocabulary)) for token in chunk]
+											for chunk in self.chunks])
+		tokens = sorted(token_vocabulary, key=token_vocabulary.get)
+		boundaries, boundary_offsets = flatten(self.sentence_boundaries)
+		arrays = {"token_ids": token_ids, "chunk_offsets": chunk_offsets, "boundaries": boundaries, "boundary_offsets": boundary_offsets}
+		for name, strings in [("tokens", tokens), ("lemma_terms", self.lemma_terms), ("tfidf_terms", self.tfidf_terms)]:
+			arrays[name], arrays[name + "_lengths"] = encode_strings(strings)
+		for name, counts in [("lemma", self.lemma_counts), ("tfidf", self.tfidf_counts)]:
+			arrays[name + "_data"] = counts.data.astype(np.int32)
+			arrays[name + "_indices"] = counts.indices.astype(np.int32)
+			arrays[name + "_indptr"] = counts.indptr.astype(np.int64)
+			arrays[name + "_shape"] = np.array(counts.shape, dtype=np.int64)
+		np.savez(fout, **arrays)
+
+
+def load_chunk_index(fin):
+	arrays = np.load(fin)
+	tokens = decode_strings(arrays["tokens"], arrays["tokens_lengths"])
+	token_ids, chunk_offsets = arrays["token_ids"], arrays["chunk_offsets"]
+	chunks = [[tokens[i] for i in token_ids[chunk_offsets[c]:chunk_offsets[c + 1]]] for c in range(len(chunk_offsets) - 1)]
+	boundaries, boundary_offsets = arrays["boundaries"].tolist(), arrays["boundary_offsets"]
+	sentence_boundaries = [boundaries[boundary_offsets[c]:boundary_offsets[c + 1]] for c in range(len(boundary_offsets) - 1)]
+	counts = {}
+	for name in ["lemma", "tfidf"]:
+		counts[name] = sparse.csr_matrix((arrays[name + "_data"].astype(np.float64), arrays[name + "_indices"], arrays[name + "_indptr"]),
+										 shape=tuple(arrays[name + "_shape"]))
+	return ChunkIndex(chunks, sentence_boundaries,
+					  decode_strings(arrays["lemma_terms"], arrays["lemma_terms_lengths"]), counts["lemma"],
+					  decode_strings(arrays["tfidf_terms"], arrays["tfidf_terms_lengths"]), counts["tfidf"])
+
+
+class ChunkIndexCache(DocumentCache):
+	## a DocumentCache of the ChunkIndex of every document, in the .npz format instead of pickles
+	extension = "npz"
+
+	def read(self, fin):
+		return load_chunk_index(fin)
+
+	def write(self, value, fout):
+		value.save(fout)
@@ -1,26 +1,20 @@
 from __future__ import division
-import json
 import random
 import argparse
 import numpy as np
+from utility import ChunkReader
 
 
 def load_chunks(chunk_path):
-	with open(chunk_path) as file:
-		information = json.load(file)
-
-	chunks = information["chunks"]
-	questions = information["questions"]
-	locations = information["order"]
-	answers = information["answers"]
-	return chunks, questions, answers, locations
+	## the documents of the json lines file are only parsed when they are indexed
+	return ChunkReader(chunk_path)
 
 
 if __name__ == "__main__":
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--chunk_path", type=str,
-						default="/home/michiel/Downloads/train_raw_chunks.pickle")
+						default="/home/michiel/Downloads/train_raw_chunks.jsonl")
 	parser.add_argument("--num_questions", type=int, default=10)
 	parser.add_argument("--seed", type=int, default=0)
 
@@ -28,12 +22,13 @@ if __name__ == "__main__":
 
 	chunk_numbers = [1, 5, 10]
 
-	chunks, questions, answers, locations = load_chunks(args.chunk_path)
+	documents = load_chunks(args.chunk_path)
 
 	random.seed(8)
 
-	document_ids = random.sample(range(len(chunks) - 1), args.num_questions)
-	question_ids = [random.randint(0, len(questions[document_ids[i]]) - 1)
+	document_ids = random.sample(range(len(documents) - 1), args.num_questions)
+	sampled = [documents[document_ids[i]] for i in range(args.num_questions)]
+	question_ids = [random.randint(0, len(sampled[i]["questions"]) - 1)
 					for i in range(args.num_questions)]
 
 	scores = dict()
@@ -42,10 +37,10 @@ if __name__ == "__main__":
 
 	for i in range(args.num_questions):
 
-		doc_id = document_ids[i]
+		document = sampled[i]
 
-		question_chunks = chunks[document_ids[i]][question_ids[i]]
-		question_chunk_locations = locations[document_ids[i]][question_ids[i]]
+		question_chunks = document["chunks"][question_ids[i]]
+		question_chunk_locations = document["order"][question_ids[i]]
 		question_chunk_locations = question_chunk_locations.strip("[]").split()
 		question_chunk_locations = np.array([int(location) for location in question_chunk_locations])
 		question_chunk_order = np.argsort(question_chunk_locations)
@@ -61,8 +56,8 @@ if __name__ == "__main__":
 				## each chunk will be a list of sentences
 				print("\n".join([" ".join(sentence) for sentence in ordered_chunks[j]]))
 				print("*"*50 + "\n")
-			print("Question: {0}".format(questions[doc_id][question_ids[i]]))
-			print("True Answer: {0}".format(answers[doc_id][question_ids[i]]))
+			print("Question: {0}".format(document["questions"][question_ids[i]]))
+			print("True Answer: {0}".format(document["answers"][question_ids[i]]))
 			print("\n")
 
 			while True:
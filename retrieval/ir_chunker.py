@@ -1,12 +1,12 @@
-import numpy as np
+import os
 import spacy
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
-from gensim.summarization.bm25 import BM25
 import re
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfTransformer
-from sklearn.metrics.pairwise import linear_kernel
+from preprocessing import pipe_windows, top_k_indices
+from bm25 import BM25, corpus_counts
+from tfidf import TfidfIndex
+from chunk_index import ChunkIndex
 
 
 class Chunk(object):
@@ -32,6 +32,13 @@ class Chunking(object):
 		self.args = args
 		self.stop_words = list(stopwords.words('english'))
 		self.lemmatizer = WordNetLemmatizer()
+		self.stop_word_set = set(self.stop_words)
+		self.lemmas = {}
+		self.tfidf = TfidfIndex(preprocessor=self.lemmatizer.lemmatize, stop_words=self.stop_words, ngram_range=(1, 2))
+		## corpus level vocabulary and idf, fitted once by ChunkRetriever.fit_tfidf_index
+		self.corpus_tfidf = args.tfidf_index is not None and os.path.exists(args.tfidf_index)
+		if self.corpus_tfidf:
+			self.tfidf.load(args.tfidf_index)
 
 
 	def improve_sentence_splitting(self, original_sentences, maximum_sentence_length):
@@ -80,35 +87,39 @@ class Chunking(object):
 				final_sentences.append(s)
 		return bad_counter, final_sentences
 
-	def retrieve_chunks(self, context, references, chunk_length=200, num_chunks=1):
-
+	def split_sentences(self, joint_context):
+		## streams the sentences of the document as lists of tokens; a sentence is cut only where it starts in the core
+		## region of a window, so sentences running over a window boundary come out whole
+		sentence = []
+		for start, end, offset, doc in pipe_windows(self.nlp, joint_context, ["parser"]):
+			for sent in doc.sents:
+				for index, token in enumerate(sent):
+					position = offset + token.idx
+					if position < start or position >= end:
+						continue
+					if index == 0 and len(sentence) > 0:
+						yield sentence
+						sentence = []
+					sentence.append(token.string.strip())
+		if len(sentence) > 0:
+			yield sentence
+
+	def lemmatize(self, words):
+		## lowercased lemmas of the words that are not stop words, every distinct word is lemmatized once
+		lemmatized = []
+		for w in words:
+			w = w.lower()
+			if w not in self.stop_word_set:
+				if w not in self.lemmas:
+					self.lemmas[w] = self.lemmatizer.lemmatize(w)
+				lemmatized.append(self.lemmas[w])
+		return lemmatized
+
+	def build_chunk_index(self, context, chunk_length=200):
+		## tokenizes, splits and chunks the document once; the ChunkIndex holds all that retrieval needs afterwards
 		joint_context = " ".join(context)
-		joint_references = []
-		for r in references:
-			joint_references.append(" ".join(r))
-		## break the document down to 4 parts and send to spacy sentence splitter, then combine while still handling sentence split on boundary
-		if len(context) > 100000:
-			q1 = len(context) / 4
-			first_quarter = context[0:q1]
-			second_quarter = context[q1:q1 * 2]
-			third_quarter = context[q1 * 2:q1 * 3]
-			fourth_quarter = context[q1 * 3:]
-			context_tokens1 = self.nlp(" ".join(first_quarter))
-			context_tokens2 = self.nlp(" ".join(second_quarter))
-			context_tokens3 = self.nlp(" ".join(third_quarter))
-			context_tokens4 = self.nlp(" ".join(fourth_quarter))
-			sentences1 = [[token.string.strip() for token in s] for s in list(context_tokens1.sents)]
-			sentences2 = [[token.string.strip() for token in s] for s in list(context_tokens2.sents)]
-			sentences3 = [[token.string.strip() for token in s] for s in list(context_tokens3.sents)]
-			sentences4 = [[token.string.strip() for token in s] for s in list(context_tokens4.sents)]
-			sentences = sentences1[:-1] + [sentences1[-1] + sentences2[0]] + \
-						sentences2[1:-1] + [sentences2[-1] + sentences3[0]] + \
-						sentences3[1:-1] + [sentences3[-1] + sentences4[0]] + \
-						sentences4[1:]
-		else:
-			context_tokens = self.nlp(joint_context)
-			sentences = list(context_tokens.sents)
-			sentences = [[token.string.strip() for token in s] for s in sentences]
+		## sentences are split on overlapping windows of the document and stitched back, so books of any length fit in memory
+		sentences = list(self.split_sentences(joint_context))
 
 		chunk_storage = []
 		sentence_boundaries_storage = []
@@ -141,62 +152,69 @@ class Chunking(object):
 				## restart from the previous chunk in this case
 				e -= 1
 				if len(current_chunk) > 0:
-					chunk_storage.append(" ".join(current_chunk))
+					chunk_storage.append(current_chunk)
 					sentence_boundaries_storage.append(sentence_boundaries)
 			else:
 				## if out of sentences, use the last chunk as is
 				if len(current_chunk) > 0:
-					chunk_storage.append(" ".join(current_chunk))
+					chunk_storage.append(current_chunk)
 					sentence_boundaries_storage.append(sentence_boundaries)
 
-		print("maximum chunk size: {0}".format(max([len(chunk.split()) for chunk in chunk_storage])))
-		print("minimum chunk size: {0}".format(min([len(chunk.split()) for chunk in chunk_storage])))
+		print("maximum chunk size: {0}".format(max([len(" ".join(chunk).split()) for chunk in chunk_storage])))
+		print("minimum chunk size: {0}".format(min([len(" ".join(chunk).split()) for chunk in chunk_storage])))
 		print("Total Number of chunks: {0}\n\n".format(len(chunk_storage)))
 
 		## checking if all chunking was done correctly
 		# print(" ".join(chunk_storage))
 		# print(joint_context)
 
+		chunk_texts = [" ".join(chunk) for chunk in chunk_storage]
+		lemma_vocabulary, lemma_counts = corpus_counts([self.lemmatize(chunk.split()) for chunk in chunk_texts])
+		tfidf_terms, tfidf_counts = self.tfidf.local_counts(chunk_texts)
+		return ChunkIndex(chunk_storage, sentence_boundaries_storage, sorted(lemma_vocabulary, key=lemma_vocabulary.get), lemma_counts,
+						  tfidf_terms, tfidf_counts)
+
+	def retrieve_chunks(self, context, references, chunk_length=200, num_chunks=1, index=None):
+		## the chunk index of the document is built from context unless it was loaded already
+		if index is None:
+			index = self.build_chunk_index(context, chunk_length)
+		joint_references = []
+		for r in references:
+			joint_references.append(" ".join(r))
+		chunk_storage = index.chunk_texts()
+		sentence_boundaries_storage = index.sentence_boundaries
+
 		top_chunks = []
 		top_chunks_ids = []
 
 		if self.args.ir_model == "tfidf":
-			length = len(chunk_storage)
-			## append queries to the end of the vector
-			for reference in joint_references:
-				chunk_storage.append(reference)
-			vectorizer = CountVectorizer(preprocessor=self.lemmatizer.lemmatize, stop_words = self.stop_words, ngram_range = (1,2))
-			transformer = TfidfTransformer(sublinear_tf = True)
-			counts = vectorizer.fit_transform(chunk_storage)
-			tfidf = transformer.fit_transform(counts)
-			chunk_docs = tfidf[0:length]
-			reference_docs = tfidf[length:]
-			related_docs_indices = linear_kernel(reference_docs, chunk_docs).argsort()[:, -num_chunks:]
+			if self.corpus_tfidf:
+				chunk_counts = self.tfidf.reindex(index.tfidf_terms, index.tfidf_counts)
+				query_counts = self.tfidf.count_matrix(joint_references)
+			else:
+				## the same as refitting the vectorizer on the chunks and questions of the document
+				self.tfidf.reset()
+				chunk_counts = self.tfidf.reindex(index.tfidf_terms, index.tfidf_counts, grow=True)
+				self.tfidf.add_counts(chunk_counts)
+				query_counts = self.tfidf.partial_fit(joint_references)
+			related_docs_indices = top_k_indices(self.tfidf.score_counts(query_counts, chunk_counts), num_chunks)
 			for idx in range(len(references)):
 				chunks_per_ref = []
-				doc_ids = related_docs_indices[idx][::-1]
+				doc_ids = related_docs_indices[idx]
 				for doc_id in range(len(doc_ids)):
 					chunks_per_ref.append(Chunk(chunk_storage[doc_ids[doc_id]] , sentence_boundaries_storage[doc_ids[doc_id]]))
 				top_chunks.append(chunks_per_ref)
 				top_chunks_ids.append(doc_ids)
 		elif self.args.ir_model == "bm25":
-			## bm25 standard parameters
-			# PARAM_K1 = 1.5
-			# PARAM_B = 0.75
-			# EPSILON = 0.25
-			## remove stop words, lowerase and lemmatize from chunks
-			lemmatized_chunk_storage = []
-			for e, chunk in enumerate(chunk_storage):
-				lemmatized_chunk_storage.append([self.lemmatizer.lemmatize(w.lower()) for w in chunk.split() if not w.lower() in self.stop_words])
-			lemmatized_references = []
-			for e, reference in enumerate(references):
-				lemmatized_references.append([self.lemmatizer.lemmatize(w.lower()) for w in reference if w.lower() not in self.stop_words])
-			bm25_object = BM25(lemmatized_chunk_storage)
-			average_idf = sum(map(lambda k: float(bm25_object.idf[k]), bm25_object.idf.keys())) / len(bm25_object.idf.keys())
+			## remove stop words, lowerase and lemmatize from questions, the chunks were lemmatized into the index
+			lemmatized_references = [self.lemmatize(reference) for reference in references]
+			## the questions of a document are scored against all chunks with one sparse product
+			bm25_object = BM25(vocabulary=dict((term, i) for i, term in enumerate(index.lemma_terms)), counts=index.lemma_counts,
+							   k1=self.args.bm25_k1, b=self.args.bm25_b, epsilon=self.args.bm25_epsilon)
+			related_docs_indices = bm25_object.top_k(lemmatized_references, num_chunks)
 			for idx in range(len(lemmatized_references)):
-				related_docs_indices = np.argsort(bm25_object.get_scores(lemmatized_references[idx], average_idf))[-num_chunks:]
 				chunks_per_ref = []
-				doc_ids = related_docs_indices[::-1]
+				doc_ids = related_docs_indices[idx]
 				for doc_id in range(len(doc_ids)):
 					chunks_per_ref.append(Chunk(chunk_storage[doc_ids[doc_id]], sentence_boundaries_storage[doc_ids[doc_id]]))
 				top_chunks.append(chunks_per_ref)
@@ -0,0 +1,203 @@
+import os
+import re
+import numpy as np
+import glob
+import hashlib
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+start_tags_with_attributes = ["<scr'+'ipt", "<!--", "<!DOCTYPE", "<a", "<abbr", "<acronym", "<address", "<applet", "<area", "<article", "<aside", "<audio", "<b", "<base", "<basefont", "<bdi", "<bdo", "<big", "<blockquote", "<body", "<br", "<button", "<canvas", "<caption", "<center", "<cite", "<code", "<col", "<colgroup", "<datalist", "<dd", "<del", "<details", "<dfn", "<dialog", "<dir", "<div", "<dl", "<dt", "<em", "<embed", "<fieldset", "<figcaption", "<figure", "<font", "<footer", "<form", "<frame", "<frameset", "<h1", "<head", "<header", "<hr", "<html", "<i", "<iframe", "<img", "<input", "<ins", "<kbd", "<label", "<legend", "<li", "<link", "<main", "<map", "<mark", "<menu", "<menuitem", "<meta", "<meter", "<nav", "<noframes", "<noscript", "<object", "<ol", "<optgroup", "<option", "<output", "<p", "<param", "<picture", "<pre", "<progress", "<q", "<rp", "<rt", "<ruby", "<s", "<samp", "<script", "<section", "<select", "<small", "<source", "<span", "<strike", "<strong", "<style", "<sub", "<summary", "<sup", "<table", "<tbody", "<td", "<template", "<textarea", "<tfoot", "<th", "<thead", "<time", "<title", "<tr", "<track", "<tt", "<u", "<ul", "<var",
+                              "<video", "<wbr", "<SCR'+'IPT", "<!--", "<!DOCTYPE", "<A", "<ABBR", "<ACRONYM", "<ADDRESS", "<APPLET", "<AREA", "<ARTICLE", "<ASIDE", "<AUDIO", "<B", "<BASE", "<BASEFONT", "<BDI", "<BDO", "<BIG", "<BLOCKQUOTE", "<BODY", "<BR", "<BUTTON", "<CANVAS", "<CAPTION", "<CENTER", "<CITE", "<CODE", "<COL", "<COLGROUP", "<DATALIST", "<DD", "<DEL", "<DETAILS", "<DFN", "<DIALOG", "<DIR", "<DIV", "<DL", "<DT", "<EM", "<EMBED", "<FIELDSET", "<FIGCAPTION", "<FIGURE", "<FONT", "<FOOTER", "<FORM", "<FRAME", "<FRAMESET", "<H1", "<HEAD", "<HEADER", "<HR", "<HTML", "<I", "<IFRAME", "<IMG", "<INPUT", "<INS", "<KBD", "<LABEL", "<LEGEND", "<LI", "<LINK", "<MAIN", "<MAP", "<MARK", "<MENU", "<MENUITEM", "<META", "<METER", "<NAV", "<NOFRAMES", "<NOSCRIPT", "<OBJECT", "<OL", "<OPTGROUP", "<OPTION", "<OUTPUT", "<P", "<PARAM", "<PICTURE", "<PRE", "<PROGRESS", "<Q", "<RP", "<RT", "<RUBY", "<S", "<SAMP", "<SCRIPT", "<SECTION", "<SELECT", "<SMALL", "<SOURCE", "<SPAN", "<STRIKE", "<STRONG", "<STYLE", "<SUB", "<SUMMARY", "<SUP", "<TABLE", "<TBODY", "<TD", "<TEMPLATE", "<TEXTAREA", "<TFOOT", "<TH", "<THEAD", "<TIME", "<TITLE", "<TR", "<TRACK", "<TT", "<U", "<UL", "<VAR", "<VIDEO", "<WBR"]
+end_tags = ["</scr'+'ipt>", "</!DOCTYPE>", "</a>", "</abbr>", "</acronym>", "</address>", "</applet>", "</area>", "</article>", "</aside>", "</audio>", "</b>", "</base>", "</basefont>", "</bdi>", "</bdo>", "</big>", "</blockquote>", "</body>", "</br>", "</button>", "</canvas>", "</caption>", "</center>", "</cite>", "</code>", "</col>", "</colgroup>", "</datalist>", "</dd>", "</del>", "</details>", "</dfn>", "</dialog>", "</dir>", "</div>", "</dl>", "</dt>", "</em>", "</embed>", "</fieldset>", "</figcaption>", "</figure>", "</font>", "</footer>", "</form>", "</frame>", "</frameset>", "</h1>", "</head>", "</header>", "</hr>", "</html>", "</i>", "</iframe>", "</img>", "</input>", "</ins>", "</kbd>", "</label>", "</legend>", "</li>", "</link>", "</main>", "</map>", "</mark>", "</menu>", "</menuitem>", "</meta>", "</meter>", "</nav>", "</noframes>", "</noscript>", "</object>", "</ol>", "</optgroup>", "</option>", "</output>", "</p>", "</param>", "</picture>", "</pre>", "</progress>", "</q>", "</rp>", "</rt>", "</ruby>", "</s>", "</samp>", "</script>", "</section>", "</select>", "</small>", "</source>", "</span>", "</strike>", "</strong>", "</style>", "</sub>", "</summary>", "</sup>", "</table>", "</tbody>", "</td>", "</template>", "</textarea>", "</tfoot>", "</th>", "</thead>", "</time>", "</title>", "</tr>", "</track>", "</tt>", "</u>", "</ul>", "</var>", "</video>",
+            "</wbr>", "</SCR'+'IPT>", "</!DOCTYPE>", "</A>", "</ABBR>", "</ACRONYM>", "</ADDRESS>", "</APPLET>", "</AREA>", "</ARTICLE>", "</ASIDE>", "</AUDIO>", "</B>", "</BASE>", "</BASEFONT>", "</BDI>", "</BDO>", "</BIG>", "</BLOCKQUOTE>", "</BODY>", "</BR>", "</BUTTON>", "</CANVAS>", "</CAPTION>", "</CENTER>", "</CITE>", "</CODE>", "</COL>", "</COLGROUP>", "</DATALIST>", "</DD>", "</DEL>", "</DETAILS>", "</DFN>", "</DIALOG>", "</DIR>", "</DIV>", "</DL>", "</DT>", "</EM>", "</EMBED>", "</FIELDSET>", "</FIGCAPTION>", "</FIGURE>", "</FONT>", "</FOOTER>", "</FORM>", "</FRAME>", "</FRAMESET>", "</H1>", "</HEAD>", "</HEADER>", "</HR>", "</HTML>", "</I>", "</IFRAME>", "</IMG>", "</INPUT>", "</INS>", "</KBD>", "</LABEL>", "</LEGEND>", "</LI>", "</LINK>", "</MAIN>", "</MAP>", "</MARK>", "</MENU>", "</MENUITEM>", "</META>", "</METER>", "</NAV>", "</NOFRAMES>", "</NOSCRIPT>", "</OBJECT>", "</OL>", "</OPTGROUP>", "</OPTION>", "</OUTPUT>", "</P>", "</PARAM>", "</PICTURE>", "</PRE>", "</PROGRESS>", "</Q>", "</RP>", "</RT>", "</RUBY>", "</S>", "</SAMP>", "</SCRIPT>", "</SECTION>", "</SELECT>", "</SMALL>", "</SOURCE>", "</SPAN>", "</STRIKE>", "</STRONG>", "</STYLE>", "</SUB>", "</SUMMARY>", "</SUP>", "</TABLE>", "</TBODY>", "</TD>", "</TEMPLATE>", "</TEXTAREA>", "</TFOOT>", "</TH>", "</THEAD>", "</TIME>", "</TITLE>", "</TR>", "</TRACK>", "</TT>", "</U>", "</UL>", "</VAR>", "</VIDEO>", "</WBR>"]
+start_tags = ["&nbsp;", "<scr'+'ipt>", "<!----!>", "<!DOCTYPE>", "<a>", "<abbr>", "<acronym>", "<address>", "<applet>", "<area>", "<article>", "<aside>", "<audio>", "<b>", "<base>", "<basefont>", "<bdi>", "<bdo>", "<big>", "<blockquote>", "<body>", "<br>", "<button>", "<canvas>", "<caption>", "<center>", "<cite>", "<code>", "<col>", "<colgroup>", "<datalist>", "<dd>", "<del>", "<details>", "<dfn>", "<dialog>", "<dir>", "<div>", "<dl>", "<dt>", "<em>", "<embed>", "<fieldset>", "<figcaption>", "<figure>", "<font>", "<footer>", "<form>", "<frame>", "<frameset>", "<h1>", "<head>", "<header>", "<hr>", "<html>", "<i>", "<iframe>", "<img>", "<input>", "<ins>", "<kbd>", "<label>", "<legend>", "<li>", "<link>", "<main>", "<map>", "<mark>", "<menu>", "<menuitem>", "<meta>", "<meter>", "<nav>", "<noframes>", "<noscript>", "<object>", "<ol>", "<optgroup>", "<option>", "<output>", "<p>", "<param>", "<picture>", "<pre>", "<progress>", "<q>", "<rp>", "<rt>", "<ruby>", "<s>", "<samp>", "<script>", "<section>", "<select>", "<small>", "<source>", "<span>", "<strike>", "<strong>", "<style>", "<sub>", "<summary>", "<sup>", "<table>", "<tbody>", "<td>", "<template>", "<textarea>", "<tfoot>", "<th>", "<thead>", "<time>", "<title>", "<tr>", "<track>", "<tt>", "<u>", "<ul>", "<var>", "<video>",
+              "<wbr>", "<SCR'+'IPT>", "<!-->", "<!DOCTYPE>", "<A>", "<ABBR>", "<ACRONYM>", "<ADDRESS>", "<APPLET>", "<AREA>", "<ARTICLE>", "<ASIDE>", "<AUDIO>", "<B>", "<BASE>", "<BASEFONT>", "<BDI>", "<BDO>", "<BIG>", "<BLOCKQUOTE>", "<BODY>", "<BR>", "<BUTTON>", "<CANVAS>", "<CAPTION>", "<CENTER>", "<CITE>", "<CODE>", "<COL>", "<COLGROUP>", "<DATALIST>", "<DD>", "<DEL>", "<DETAILS>", "<DFN>", "<DIALOG>", "<DIR>", "<DIV>", "<DL>", "<DT>", "<EM>", "<EMBED>", "<FIELDSET>", "<FIGCAPTION>", "<FIGURE>", "<FONT>", "<FOOTER>", "<FORM>", "<FRAME>", "<FRAMESET>", "<H1>", "<HEAD>", "<HEADER>", "<HR>", "<HTML>", "<I>", "<IFRAME>", "<IMG>", "<INPUT>", "<INS>", "<KBD>", "<LABEL>", "<LEGEND>", "<LI>", "<LINK>", "<MAIN>", "<MAP>", "<MARK>", "<MENU>", "<MENUITEM>", "<META>", "<METER>", "<NAV>", "<NOFRAMES>", "<NOSCRIPT>", "<OBJECT>", "<OL>", "<OPTGROUP>", "<OPTION>", "<OUTPUT>", "<P>", "<PARAM>", "<PICTURE>", "<PRE>", "<PROGRESS>", "<Q>", "<RP>", "<RT>", "<RUBY>", "<S>", "<SAMP>", "<SCRIPT>", "<SECTION>", "<SELECT>", "<SMALL>", "<SOURCE>", "<SPAN>", "<STRIKE>", "<STRONG>", "<STYLE>", "<SUB>", "<SUMMARY>", "<SUP>", "<TABLE>", "<TBODY>", "<TD>", "<TEMPLATE>", "<TEXTAREA>", "<TFOOT>", "<TH>", "<THEAD>", "<TIME>", "<TITLE>", "<TR>", "<TRACK>", "<TT>", "<U>", "<UL>", "<VAR>", "<VIDEO>", "<WBR>"]
+
+script_regex = r"<script.*>.*?</script>|<SCRIPT.*>.*?</SCRIPT>"
+
+def literal_prefix(tag):
+    ## the part of a tag pattern that is matched literally, e.g. "<scr" for "<scr'+'ipt" (the quote is quantified)
+    for index, character in enumerate(tag):
+        if character in ".^$*+?{}[]\\|()":
+            return tag[:index - 1] if character in "*+?{" else tag[:index]
+    return tag
+
+## every step of the movie script cleaner, in order: (literals one of which must be in a line, substitution or None
+## for a plain str.replace of the literal)
+html_cleaning_steps = [(("<script", "<SCRIPT"), re.compile(script_regex).sub)] + \
+    [((literal_prefix(tag),), re.compile(r'{0}.*=.*?>'.format(tag)).sub) for tag in start_tags_with_attributes] + \
+    [((tag,), None) for tag in end_tags + start_tags]
+
+## step indices by the first three characters of their literals ("<b", "<bo", "</b", "&nb", ...)
+html_steps_by_prefix = {}
+for step, (literals, _) in enumerate(html_cleaning_steps):
+    for literal in literals:
+        html_steps_by_prefix.setdefault(literal[:3], set()).add(step)
+
+def tag_prefixes(line):
+    ## two and three characters from every "<" or "&", since some literals are only two characters long
+    prefixes = set()
+    for match in re.finditer("[<&]", line):
+        prefixes.add(line[match.start():match.start() + 2])
+        prefixes.add(line[match.start():match.start() + 3])
+    return prefixes
+
+def clean_html(text):
+    """
+    Removes the script blocks and the tags of start_tags_with_attributes, end_tags and start_tags from a movie script.
+    None of the patterns can match across a newline, so instead of ~600 passes over the whole text the same steps are
+    applied one line at a time, in the same order, and only the steps whose tag can occur in the line are tried.
+    The result is identical to the sequential passes.
+    """
+    lines = text.split("\n")
+    for index, line in enumerate(lines):
+        if "<" not in line and "&" not in line:
+            continue
+        prefixes = tag_prefixes(line)
+        pending = sorted(set().union(*[html_steps_by_prefix.get(prefix, ()) for prefix in prefixes]))
+        position = 0
+        while position < len(pending):
+            step = pending[position]
+            position += 1
+            literals, substitute = html_cleaning_steps[step]
+            for literal in literals:
+                if literal in line:
+                    cleaned = line.replace(literal, "") if substitute is None else substitute("", line)
+                    if cleaned != line:
+                        line = cleaned
+                        ## removing a tag can join the text around it into a new tag, which the later steps must see
+                        new_prefixes = tag_prefixes(line) - prefixes
+                        if len(new_prefixes) > 0:
+                            prefixes |= new_prefixes
+                            later = set().union(*[html_steps_by_prefix.get(prefix, ()) for prefix in new_prefixes])
+                            pending = pending[:position] + sorted(set(pending[position:]) | set(s for s in later if s > step))
+                    break
+        lines[index] = line
+    return "\n".join(lines)
+
+
+def text_windows(text, window, overlap):
+    """
+    Cuts a space separated text into consecutive core regions of about window characters, each with up to overlap
+    characters of context on both sides. Every boundary falls on a token start, so every token begins in exactly
+    one core region. Yields (core_start, core_end, context_start, context_end) character offsets.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find(" ", start + window)
+        end = len(text) if end == -1 else end + 1
+        context_start = text.rfind(" ", 0, max(0, start - overlap)) + 1
+        context_end = text.find(" ", end + overlap)
+        context_end = len(text) if context_end == -1 else context_end
+        yield start, end, context_start, context_end
+        start = end
+
+
+def pipe_windows(nlp, text, keep, window=100000, overlap=2000, batch_size=4, n_threads=2):
+    """
+    Runs the spacy pipeline over the overlapping windows of text instead of the whole text, so memory is bounded by
+    the window size however long the document is, and nlp.pipe can work on several windows at once.
+    Only the components in keep are run. Yields (core_start, core_end, context_start, doc) per window, in order:
+    the offsets in doc are relative to context_start, and only what starts in the core region belongs to the window.
+    """
+    windows = list(text_windows(text, window, overlap))
+    disabled = [name for name in nlp.pipe_names if name not in keep]
+    with nlp.disable_pipes(*disabled):
+        docs = nlp.pipe((text[context_start:context_end] for _, _, context_start, context_end in windows),
+                        batch_size=batch_size, n_threads=n_threads)
+        for (start, end, context_start, _), doc in zip(windows, docs):
+            yield start, end, context_start, doc
+
+
+def top_k_indices(scores, k):
+    ## argpartition picks the k largest of every row in linear time, only those k are sorted
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    rows = np.arange(scores.shape[0])[:, None]
+    order = np.argsort(-scores[rows, candidates], axis=1, kind="mergesort")
+    return candidates[rows, order]
+
+
+def file_digest(path):
+    ## sha1 of the contents of a file, read in blocks so large documents are never held in memory
+    digest = hashlib.sha1()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            digest.update(block)
+    return digest
+
+
+def encode_strings(strings):
+    ## utf-8 bytes of all strings back to back, and the byte length of every string
+    encoded = [string.encode("utf-8") for string in strings]
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), np.array([len(string) for string in encoded], dtype=np.int32)
+
+
+def decode_strings(data, lengths):
+    data = data.tobytes()
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(lengths))]
+
+
+def flatten(lists, dtype=np.int32):
+    ## one flat array of all the lists, and the offsets where every list starts and the last one ends
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(values) for values in lists])
+    return np.array([value for values in lists for value in values], dtype=dtype), offsets
+
+
+class DocumentCache(object):
+    """
+    Per-document cache of preprocessing results. Entries are keyed by a hash of the raw document file
+    and the settings that influence the result, so reruns skip documents that were already processed
+    and only documents whose file or settings changed are recomputed.
+    """
+    def __init__(self, cache_folder, **settings):
+        self.cache_folder = cache_folder
+        self.settings = repr(sorted(settings.items()))
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+    def key(self, content_path, *extra):
+        digest = file_digest(content_path)
+        digest.update(self.settings.encode("utf-8"))
+        for item in extra:
+            digest.update(repr(item).encode("utf-8"))
+        return digest.hexdigest()
+
+    ## subclasses can store entries in another format by overriding extension, read and write
+    extension = "pickle"
+
+    def read(self, fin):
+        return pickle.load(fin)
+
+    def write(self, value, fout):
+        pickle.dump(value, fout, pickle.HIGHEST_PROTOCOL)
+
+    def path(self, doc_id, key):
+        return os.path.join(self.cache_folder, "{0}.{1}.{2}".format(doc_id, key, self.extension))
+
+    def load(self, doc_id, key):
+        path = self.path(doc_id, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as fin:
+            return self.read(fin)
+
+    def store(self, doc_id, key, value):
+        path = self.path(doc_id, key)
+        ## write to a temporary file first so a crash never leaves a truncated entry behind
+        with open(path + ".tmp", "wb") as fout:
+            self.write(value, fout)
+        os.rename(path + ".tmp", path)
+        ## entries of older versions of this document are stale now
+        for stale_path in glob.glob(os.path.join(self.cache_folder, "{0}.*.{1}".format(doc_id, self.extension))):
+            if stale_path != path:
+                os.remove(stale_path)
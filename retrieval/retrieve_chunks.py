@@ -5,14 +5,30 @@ import glob
 from nltk import word_tokenize
 from csv import reader
 import sys
-from utility import start_tags, end_tags, start_tags_with_attributes, Query
+from utility import Query, ChunkWriter
+from preprocessing import clean_html, DocumentCache, file_digest
+from chunk_index import ChunkIndexCache
 from ir_chunker import *
 import json
+import numpy as np
+from multiprocessing import Pool
 
 class ChunkRetriever():
 	def __init__(self, args):
 		self.args = args
 		self.chunkRetrieval = Chunking(args)
+		## retrieved chunks are cached per document, so a crashed run resumes where it stopped
+		self.cache = None
+		if args.cache_folder is not None:
+			self.cache = DocumentCache(args.cache_folder, chunk_size=args.chunk_size, num_chunks=args.num_chunks,
+									   ir_model=args.ir_model, anonymization=False,
+									   bm25=(args.bm25_k1, args.bm25_b, args.bm25_epsilon))
+		## the cache keys hash the contents of the tfidf index, which can be refitted at the same path
+		self.tfidf_index_digest = None
+		## the tokenized, split and chunked documents are stored per document, so runs with other retrieval settings only score
+		self.index_cache = None
+		if args.chunk_index_folder is not None:
+			self.index_cache = ChunkIndexCache(args.chunk_index_folder, chunk_size=args.chunk_size)
 
 	def load_data(self):
 		reload(sys)
@@ -62,6 +78,9 @@ class ChunkRetriever():
 				index = index + 1
 		print("Loaded documents file")
 
+		if self.args.ir_model == "tfidf" and self.args.tfidf_index is not None and not self.chunkRetrieval.corpus_tfidf:
+			self.fit_tfidf_index(documents)
+
 		if self.args.mode == "test":
 			## get K random train and test files
 			train_ids = np.array(train_ids)
@@ -69,31 +88,9 @@ class ChunkRetriever():
 			random_train_documents = train_ids[np.random.randint(0, len(train_ids), 30)]
 			random_test_documents = test_ids[np.random.randint(0, len(test_ids), 30)]
 
-		document_tokens = []
-
-		train_raw_chunks = []
-		valid_raw_chunks = []
-		test_raw_chunks = []
-
-		train_questions = []
-		valid_questions = []
-		test_questions = []
-
-		train_answers = []
-		valid_answers = []
-		test_answers = []
-
-		train_docids = []
-		valid_docids = []
-		test_docids = []
-
-		train_chunk_ids = []
-		valid_chunk_ids = []
-		test_chunk_ids = []
-
-		counter = 0
 		chunk_size = self.args.chunk_size
 		num_chunks = self.args.num_chunks
+		jobs = []
 		for filename in glob.glob(os.path.join(self.args.input_folder, '*.content')):
 			doc_id = os.path.basename(filename).replace(".content", "")
 			if doc_id not in documents:
@@ -103,58 +100,6 @@ class ChunkRetriever():
 			if self.args.mode == "test":
 				if doc_id not in random_train_documents and doc_id not in random_test_documents:
 					continue
-			counter += 1
-			if kind == "gutenberg":
-				try:
-					with codecs.open(self.args.input_folder + doc_id + ".content", "r", encoding='utf-8',
-									 errors='replace') as fin:
-						data = fin.read()
-						data = data.replace('"', '')
-						tokenized_data = " ".join(word_tokenize(data))
-						start_index = tokenized_data.find(start_tag)
-						end_index = tokenized_data.rfind(end_tag, start_index)
-						filtered_data = tokenized_data[start_index:end_index]
-						if len(filtered_data) == 0:
-							print "Error in book extraction: ", filename, start_tag, end_tag
-						else:
-							print(filename)
-							filtered_data = filtered_data.replace(" 's ", " s ")
-							document_tokens = filtered_data.split()
-				except Exception as error:
-					print error
-					print "Books for which 'utf-8' doesnt work: ", doc_id
-			else:
-				try:
-					with codecs.open(self.args.input_folder + doc_id + ".content", "r", encoding="utf-8",
-									 errors="replace") as fin:
-						text = fin.read()
-						text = text.replace('"', '')
-						script_regex = r"<script.*>.*?</script>|<SCRIPT.*>.*?</SCRIPT>"
-						text = re.sub(script_regex, '', text)
-						for tag in start_tags_with_attributes:
-							my_regex = r'{0}.*=.*?>'.format(tag)
-							text = re.sub(my_regex, '', text)
-						for tag in end_tags:
-							text = text.replace(tag, "")
-						for tag in start_tags:
-							text = text.replace(tag, "")
-						## this step was required for few movies so start tags were changed
-						start_tag = start_tag.replace(" S ", " 'S ").replace(" s ", " 's ")
-						tokenized_data = " ".join(word_tokenize(text))
-						start_index = tokenized_data.find(start_tag)
-						if start_index == -1:
-							pass
-						end_index = tokenized_data.rfind(end_tag, start_index)
-						filtered_data = tokenized_data[start_index:end_index]
-						if len(filtered_data) == 0:
-							print "Error in movie extraction: ", filename, start_tag
-						else:
-							print(filename)
-							filtered_data == filtered_data.replace(" 's ", " s ")
-							document_tokens = filtered_data.split()
-
-				except:
-					print "Movie for which html extraction doesnt work doesnt work: ", doc_id
 
 			## TODO (Aditi): ner code  +  anonymization
 
@@ -170,59 +115,151 @@ class ChunkRetriever():
 				answers.append(answer1_tokens)
 
 			## chunking
-			chunk_size  = self.args.chunk_size
-			num_chunks = self.args.num_chunks
 			if self.args.load_summary:
 				### Todo: Write chunking code for summary
-				pass
-			else:
-				# Storing both documents and the chunks
-				if set == "train":
-					combined_reference = [q+a for q,a in zip(questions, answers)]
-					extracted, ids = self.chunkRetrieval.retrieve_chunks(document_tokens, combined_reference, chunk_size, num_chunks=num_chunks)
-					train_docids.append(doc_id)
-					train_questions.append([" ".join(q) for q in questions])
-					serialized_chunks = [
-						[chunk.get_sentences() for chunk in extracted[i]] for i in
-						range(len(extracted))]
-					train_raw_chunks.append(serialized_chunks)
-					train_chunk_ids.append([str(id) for id in ids])
-					train_answers.append([" ".join(a) for a in answers])
-				elif set == "valid":
-					extracted, ids = self.chunkRetrieval.retrieve_chunks(document_tokens, questions, chunk_size, num_chunks=num_chunks)
-					serialized_chunks = [
-						[chunk.get_sentences() for chunk in extracted[i]] for i in
-						range(len(extracted))]
-					valid_docids.append(doc_id)
-					valid_questions.append([" ".join(q) for q in questions])
-					valid_raw_chunks.append(serialized_chunks)
-					valid_chunk_ids.append([str(id) for id in ids])
-					valid_answers.append([" ".join(a) for a in answers])
-				elif set == "test":
-					extracted, ids = self.chunkRetrieval.retrieve_chunks(document_tokens, questions, chunk_size, num_chunks=num_chunks)
-					serialized_chunks = [
-						[chunk.get_sentences() for chunk in extracted[i]] for i in
-						range(len(extracted))]
-					test_docids.append(doc_id)
-					test_questions.append([" ".join(q) for q in questions])
-					test_raw_chunks.append(serialized_chunks)
-					test_chunk_ids.append([str(id) for id in ids])
-					test_answers.append([" ".join(a) for a in answers])
-
-		myObj = {"id": train_docids, "questions": train_questions, "answers":train_answers, "chunks": train_raw_chunks,
-				 "order": train_chunk_ids}
-		self.saveChunks(myObj, self.args.output_folder + "train_raw_chunks_{0}_{1}.json".format(num_chunks, chunk_size))
-
-		myObj = {"id": valid_docids, "questions": valid_questions, "answers":valid_answers, "chunks": valid_raw_chunks,
-				 "order": valid_chunk_ids}
-		self.saveChunks(myObj, self.args.output_folder + "valid_raw_chunks_{0}_{1}.json".format(num_chunks, chunk_size))
-
-		myObj = {"id": test_docids, "questions": test_questions, "answers":test_answers, "chunks": test_raw_chunks, "order": test_chunk_ids};
-		self.saveChunks(myObj, self.args.output_folder + "test_raw_chunks_{0}_{1}.json".format(num_chunks, chunk_size))
-
-	def saveChunks(self, chunks, output_path):
-			with open(output_path, "w") as fout:
-				json.dump(chunks, fout)
+				continue
+			jobs.append((filename, doc_id, set, kind, start_tag, end_tag, questions, answers))
+
+		## every document is written out as a json line as soon as it is retrieved, only one document is held in memory at a time
+		writers = dict((set, ChunkWriter(self.args.output_folder + "{0}_raw_chunks_{1}_{2}.jsonl".format(set, num_chunks, chunk_size)))
+					   for set in ["train", "valid", "test"])
+		if self.args.workers > 1:
+			## the largest documents are started first so no worker is left with a long book at the end
+			jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+			job_pool = Pool(self.args.workers, initializer=init_retrieval_worker, initargs=(self.args,))
+			records = job_pool.imap_unordered(retrieve_document_job, jobs, chunksize=1)
+		else:
+			records = (self.retrieve_document(job) for job in jobs)
+		for record in records:
+			if record["set"] in writers:
+				writers[record["set"]].write(record)
+		if self.args.workers > 1:
+			job_pool.close()
+			job_pool.join()
+		for writer in writers.values():
+			writer.close()
+
+	def retrieve_document(self, job):
+		filename, doc_id, set, kind, start_tag, end_tag, questions, answers = job
+		chunk_size = self.args.chunk_size
+		num_chunks = self.args.num_chunks
+		if set == "train":
+			references = [q+a for q,a in zip(questions, answers)]
+		else:
+			references = questions
+
+		retrieved = None
+		if self.cache is not None:
+			key = self.cache.key(filename, kind, start_tag, end_tag, references, self.get_tfidf_index_digest())
+			retrieved = self.cache.load(doc_id, key)
+		if retrieved is None:
+			index = self.load_chunk_index(filename, doc_id, kind, start_tag, end_tag)
+			extracted, ids = self.chunkRetrieval.retrieve_chunks(None, references, chunk_size, num_chunks=num_chunks, index=index)
+			serialized_chunks = [
+				[chunk.get_sentences() for chunk in extracted[i]] for i in
+				range(len(extracted))]
+			retrieved = (serialized_chunks, [str(id) for id in ids])
+			if self.cache is not None:
+				self.cache.store(doc_id, key, retrieved)
+		else:
+			print("Loaded from cache: {0}".format(filename))
+		serialized_chunks, chunk_ids = retrieved
+
+		# Storing both documents and the chunks
+		return {"set": set, "id": doc_id, "questions": [" ".join(q) for q in questions], "answers": [" ".join(a) for a in answers],
+				"chunks": serialized_chunks, "order": chunk_ids}
+
+	def get_tfidf_index_digest(self):
+		## read once the index exists, i.e. after fit_tfidf_index
+		if self.tfidf_index_digest is None and self.args.tfidf_index is not None and os.path.exists(self.args.tfidf_index):
+			self.tfidf_index_digest = file_digest(self.args.tfidf_index).hexdigest()
+		return self.tfidf_index_digest
+
+	def load_chunk_index(self, filename, doc_id, kind, start_tag, end_tag):
+		index = None
+		if self.index_cache is not None:
+			key = self.index_cache.key(filename, kind, start_tag, end_tag)
+			index = self.index_cache.load(doc_id, key)
+			if index is not None:
+				print("Loaded chunk index: {0}".format(filename))
+		if index is None:
+			document_tokens = self.read_document_tokens(filename, doc_id, kind, start_tag, end_tag)
+			index = self.chunkRetrieval.build_chunk_index(document_tokens, self.args.chunk_size)
+			if self.index_cache is not None:
+				self.index_cache.store(doc_id, key, index)
+		return index
+
+	def fit_tfidf_index(self, documents):
+		## the tfidf vocabulary and idf are fitted once on the training documents and saved to --tfidf_index; the sentence
+		## aligned chunks are only known after parsing, so document frequencies are counted over chunk_size token windows
+		tfidf = self.chunkRetrieval.tfidf
+		tfidf.reset()
+		chunk_size = self.args.chunk_size
+		for doc_id, (set, kind, start_tag, end_tag) in sorted(documents.items()):
+			filename = os.path.join(self.args.input_folder, doc_id + ".content")
+			if set != "train" or not os.path.exists(filename):
+				continue
+			document_tokens = self.read_document_tokens(filename, doc_id, kind, start_tag, end_tag)
+			tfidf.partial_fit([" ".join(document_tokens[i:i + chunk_size]) for i in range(0, len(document_tokens), chunk_size)])
+		tfidf.save(self.args.tfidf_index)
+		self.chunkRetrieval.corpus_tfidf = True
+		self.tfidf_index_digest = None
+		print("Fitted tfidf index on {0} chunks, {1} terms".format(tfidf.num_documents, len(tfidf.vocabulary)))
+
+	def read_document_tokens(self, filename, doc_id, kind, start_tag, end_tag):
+		document_tokens = []
+		if kind == "gutenberg":
+			try:
+				with codecs.open(self.args.input_folder + doc_id + ".content", "r", encoding='utf-8',
+								 errors='replace') as fin:
+					data = fin.read()
+					data = data.replace('"', '')
+					tokenized_data = " ".join(word_tokenize(data))
+					start_index = tokenized_data.find(start_tag)
+					end_index = tokenized_data.rfind(end_tag, start_index)
+					filtered_data = tokenized_data[start_index:end_index]
+					if len(filtered_data) == 0:
+						print "Error in book extraction: ", filename, start_tag, end_tag
+					else:
+						print(filename)
+						filtered_data = filtered_data.replace(" 's ", " s ")
+						document_tokens = filtered_data.split()
+			except Exception as error:
+				print error
+				print "Books for which 'utf-8' doesnt work: ", doc_id
+		else:
+			try:
+				with codecs.open(self.args.input_folder + doc_id + ".content", "r", encoding="utf-8",
+								 errors="replace") as fin:
+					text = fin.read()
+					text = text.replace('"', '')
+					text = clean_html(text)
+					## this step was required for few movies so start tags were changed
+					start_tag = start_tag.replace(" S ", " 'S ").replace(" s ", " 's ")
+					tokenized_data = " ".join(word_tokenize(text))
+					start_index = tokenized_data.find(start_tag)
+					if start_index == -1:
+						pass
+					end_index = tokenized_data.rfind(end_tag, start_index)
+					filtered_data = tokenized_data[start_index:end_index]
+					if len(filtered_data) == 0:
+						print "Error in movie extraction: ", filename, start_tag
+					else:
+						print(filename)
+						filtered_data == filtered_data.replace(" 's ", " s ")
+						document_tokens = filtered_data.split()
+
+			except:
+				print "Movie for which html extraction doesnt work doesnt work: ", doc_id
+		return document_tokens
+
+def init_retrieval_worker(args):
+	## each worker process loads its own spacy model and lemmatizer once
+	global worker_retriever
+	worker_retriever = ChunkRetriever(args)
+
+def retrieve_document_job(job):
+	return worker_retriever.retrieve_document(job)
 
 def main():
 	parser = argparse.ArgumentParser()
@@ -236,6 +273,13 @@ def main():
 	parser.add_argument("--mode", type=str, default="train")
 	parser.add_argument("--num_chunks", type=int, default=20)
 	parser.add_argument("--chunk_size", type=int, default=200)
+	parser.add_argument("--bm25_k1", type=float, default=1.5, help="Term frequency saturation of bm25")
+	parser.add_argument("--bm25_b", type=float, default=0.75, help="Length normalization of bm25")
+	parser.add_argument("--bm25_epsilon", type=float, default=0.25, help="Share of the average idf given to terms with a negative idf")
+	parser.add_argument("--cache_folder", type=str, default=None, help="Directory that caches the retrieved chunks of every document")
+	parser.add_argument("--chunk_index_folder", type=str, default=None, help="Directory that stores the chunk index of every document, reused by runs with other retrieval settings")
+	parser.add_argument("--workers", type=int, default=1, help="Number of processes that retrieve documents in parallel")
+	parser.add_argument("--tfidf_index", type=str, default=None, help="Corpus level tfidf vocabulary and idf, fitted on the training documents if the file does not exist")
 	args = parser.parse_args()
 	dataloader = ChunkRetriever(args)
 	dataloader.load_data()
@@ -0,0 +1,122 @@
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from preprocessing import top_k_indices
+try:
+	import cPickle as pickle
+except:
+	import pickle
+
+
+class TfidfIndex(object):
+	"""
+	TF-IDF retrieval of chunks for questions, with the weights of CountVectorizer + TfidfTransformer(sublinear_tf=True):
+	1 + log(tf) times the smoothed idf log((1 + N) / (1 + df)) + 1, l2 normalized, scored with a sparse dot product.
+	The analyzer is built once. The vocabulary and document frequencies are either fitted on the corpus once
+	(partial_fit over all chunks, then save/load), or refitted per document with fit=True, which reproduces the old
+	per-document vectorizer exactly.
+	"""
+	def __init__(self, preprocessor=None, stop_words=None, ngram_range=(1, 2)):
+		self.analyzer = CountVectorizer(preprocessor=preprocessor, stop_words=stop_words, ngram_range=ngram_range).build_analyzer()
+		self.reset()
+
+	def reset(self):
+		self.vocabulary = {}
+		self.document_frequency = np.zeros(0, dtype=np.int64)
+		self.num_documents = 0
+		self.idf = None
+
+	def count_matrix(self, texts, grow=False, vocabulary=None):
+		## (texts, terms) term counts, every text is analyzed once; with grow, new terms are added to the vocabulary
+		vocabulary = self.vocabulary if vocabulary is None else vocabulary
+		columns = []
+		indptr = [0]
+		for text in texts:
+			if grow:
+				columns.extend(vocabulary.setdefault(term, len(vocabulary)) for term in self.analyzer(text))
+			else:
+				columns.extend(vocabulary[term] for term in self.analyzer(text) if term in vocabulary)
+			indptr.append(len(columns))
+		counts = sparse.csr_matrix((np.ones(len(columns)), np.array(columns, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+								   shape=(len(texts), len(vocabulary)))
+		## repeated terms of a text are summed into one count
+		counts.sum_duplicates()
+		return counts
+
+	def local_counts(self, texts):
+		## term counts of texts over their own vocabulary, independent of the index; returns (terms, counts)
+		vocabulary = {}
+		counts = self.count_matrix(texts, grow=True, vocabulary=vocabulary)
+		return sorted(vocabulary, key=vocabulary.get), counts
+
+	def reindex(self, terms, counts, grow=False):
+		## moves counts over the vocabulary terms to the vocabulary of the index; without grow, unknown terms are dropped
+		if grow:
+			columns = np.array([self.vocabulary.setdefault(term, len(self.vocabulary)) for term in terms], dtype=np.int64)
+		else:
+			columns = np.array([self.vocabulary.get(term, -1) for term in terms], dtype=np.int64)
+		counts = counts.tocoo()
+		indices = columns[counts.col]
+		known = indices >= 0
+		return sparse.csr_matrix((counts.data[known], (counts.row[known], indices[known])), shape=(counts.shape[0], len(self.vocabulary)))
+
+	def add_counts(self, counts):
+		## adds the document frequencies of the rows of a count matrix
+		frequency = np.bincount(counts.indices, minlength=len(self.vocabulary))
+		frequency[:len(self.document_frequency)] += self.document_frequency
+		self.document_frequency = frequency
+		self.num_documents += counts.shape[0]
+		self.idf = None
+
+	def partial_fit(self, texts):
+		## adds the document frequencies of texts and returns their term counts
+		counts = self.count_matrix(texts, grow=True)
+		self.add_counts(counts)
+		return counts
+
+	def fit(self, texts):
+		self.reset()
+		self.partial_fit(texts)
+		return self
+
+	def weight(self, counts):
+		## l2 normalized tf-idf rows of a count matrix; matrices counted before the vocabulary grew are widened
+		if self.idf is None:
+			self.idf = np.log((1.0 + self.num_documents) / (1.0 + self.document_frequency)) + 1.0
+		weights = sparse.csr_matrix((counts.data, counts.indices, counts.indptr), shape=(counts.shape[0], len(self.vocabulary)))
+		weights.data = (np.log(weights.data) + 1.0) * self.idf[weights.indices]
+		norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+		norms[norms == 0] = 1.0
+		return sparse.csr_matrix(sparse.diags(1.0 / norms) * weights)
+
+	def transform(self, texts):
+		## terms outside the vocabulary are ignored
+		return self.weight(self.count_matrix(texts))
+
+	def score_counts(self, query_counts, chunk_counts):
+		## (queries, chunks) dense array of cosine similarities of two count matrices
+		return np.asarray((self.weight(query_counts) * self.weight(chunk_counts).T).todense())
+
+	def score(self, queries, chunks, fit=False):
+		## with fit, the index is first refitted on chunks and queries, as the per-document vectorizer was
+		if fit:
+			self.reset()
+			chunk_counts = self.partial_fit(chunks)
+			query_counts = self.partial_fit(queries)
+		else:
+			chunk_counts, query_counts = self.count_matrix(chunks), self.count_matrix(queries)
+		return self.score_counts(query_counts, chunk_counts)
+
+	def top_k(self, queries, chunks, k, fit=False):
+		## indices of the k most similar chunks of every query, best first
+		return top_k_indices(self.score(queries, chunks, fit), k)
+
+	def save(self, path):
+		with open(path, "wb") as fout:
+			pickle.dump((self.vocabulary, self.document_frequency, self.num_documents), fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+	def load(self, path):
+		with open(path, "rb") as fin:
+			self.vocabulary, self.document_frequency, self.num_documents = pickle.load(fin)
+		self.idf = None
+		return self
@@ -1,10 +1,5 @@
-start_tags_with_attributes = ["<scr'+'ipt", "<!--", "<!DOCTYPE", "<a", "<abbr", "<acronym", "<address", "<applet", "<area", "<article", "<aside", "<audio", "<b", "<base", "<basefont", "<bdi", "<bdo", "<big", "<blockquote", "<body", "<br", "<button", "<canvas", "<caption", "<center", "<cite", "<code", "<col", "<colgroup", "<datalist", "<dd", "<del", "<details", "<dfn", "<dialog", "<dir", "<div", "<dl", "<dt", "<em", "<embed", "<fieldset", "<figcaption", "<figure", "<font", "<footer", "<form", "<frame", "<frameset", "<h1", "<head", "<header", "<hr", "<html", "<i", "<iframe", "<img", "<input", "<ins", "<kbd", "<label", "<legend", "<li", "<link", "<main", "<map", "<mark", "<menu", "<menuitem", "<meta", "<meter", "<nav", "<noframes", "<noscript", "<object", "<ol", "<optgroup", "<option", "<output", "<p", "<param", "<picture", "<pre", "<progress", "<q", "<rp", "<rt", "<ruby", "<s", "<samp", "<script", "<section", "<select", "<small", "<source", "<span", "<strike", "<strong", "<style", "<sub", "<summary", "<sup", "<table", "<tbody", "<td", "<template", "<textarea", "<tfoot", "<th", "<thead", "<time", "<title", "<tr", "<track", "<tt", "<u", "<ul", "<var",
-                              "<video", "<wbr", "<SCR'+'IPT", "<!--", "<!DOCTYPE", "<A", "<ABBR", "<ACRONYM", "<ADDRESS", "<APPLET", "<AREA", "<ARTICLE", "<ASIDE", "<AUDIO", "<B", "<BASE", "<BASEFONT", "<BDI", "<BDO", "<BIG", "<BLOCKQUOTE", "<BODY", "<BR", "<BUTTON", "<CANVAS", "<CAPTION", "<CENTER", "<CITE", "<CODE", "<COL", "<COLGROUP", "<DATALIST", "<DD", "<DEL", "<DETAILS", "<DFN", "<DIALOG", "<DIR", "<DIV", "<DL", "<DT", "<EM", "<EMBED", "<FIELDSET", "<FIGCAPTION", "<FIGURE", "<FONT", "<FOOTER", "<FORM", "<FRAME", "<FRAMESET", "<H1", "<HEAD", "<HEADER", "<HR", "<HTML", "<I", "<IFRAME", "<IMG", "<INPUT", "<INS", "<KBD", "<LABEL", "<LEGEND", "<LI", "<LINK", "<MAIN", "<MAP", "<MARK", "<MENU", "<MENUITEM", "<META", "<METER", "<NAV", "<NOFRAMES", "<NOSCRIPT", "<OBJECT", "<OL", "<OPTGROUP", "<OPTION", "<OUTPUT", "<P", "<PARAM", "<PICTURE", "<PRE", "<PROGRESS", "<Q", "<RP", "<RT", "<RUBY", "<S", "<SAMP", "<SCRIPT", "<SECTION", "<SELECT", "<SMALL", "<SOURCE", "<SPAN", "<STRIKE", "<STRONG", "<STYLE", "<SUB", "<SUMMARY", "<SUP", "<TABLE", "<TBODY", "<TD", "<TEMPLATE", "<TEXTAREA", "<TFOOT", "<TH", "<THEAD", "<TIME", "<TITLE", "<TR", "<TRACK", "<TT", "<U", "<UL", "<VAR", "<VIDEO", "<WBR"]
-end_tags = ["</scr'+'ipt>", "</!DOCTYPE>", "</a>", "</abbr>", "</acronym>", "</address>", "</applet>", "</area>", "</article>", "</aside>", "</audio>", "</b>", "</base>", "</basefont>", "</bdi>", "</bdo>", "</big>", "</blockquote>", "</body>", "</br>", "</button>", "</canvas>", "</caption>", "</center>", "</cite>", "</code>", "</col>", "</colgroup>", "</datalist>", "</dd>", "</del>", "</details>", "</dfn>", "</dialog>", "</dir>", "</div>", "</dl>", "</dt>", "</em>", "</embed>", "</fieldset>", "</figcaption>", "</figure>", "</font>", "</footer>", "</form>", "</frame>", "</frameset>", "</h1>", "</head>", "</header>", "</hr>", "</html>", "</i>", "</iframe>", "</img>", "</input>", "</ins>", "</kbd>", "</label>", "</legend>", "</li>", "</link>", "</main>", "</map>", "</mark>", "</menu>", "</menuitem>", "</meta>", "</meter>", "</nav>", "</noframes>", "</noscript>", "</object>", "</ol>", "</optgroup>", "</option>", "</output>", "</p>", "</param>", "</picture>", "</pre>", "</progress>", "</q>", "</rp>", "</rt>", "</ruby>", "</s>", "</samp>", "</script>", "</section>", "</select>", "</small>", "</source>", "</span>", "</strike>", "</strong>", "</style>", "</sub>", "</summary>", "</sup>", "</table>", "</tbody>", "</td>", "</template>", "</textarea>", "</tfoot>", "</th>", "</thead>", "</time>", "</title>", "</tr>", "</track>", "</tt>", "</u>", "</ul>", "</var>", "</video>",
-            "</wbr>", "</SCR'+'IPT>", "</!DOCTYPE>", "</A>", "</ABBR>", "</ACRONYM>", "</ADDRESS>", "</APPLET>", "</AREA>", "</ARTICLE>", "</ASIDE>", "</AUDIO>", "</B>", "</BASE>", "</BASEFONT>", "</BDI>", "</BDO>", "</BIG>", "</BLOCKQUOTE>", "</BODY>", "</BR>", "</BUTTON>", "</CANVAS>", "</CAPTION>", "</CENTER>", "</CITE>", "</CODE>", "</COL>", "</COLGROUP>", "</DATALIST>", "</DD>", "</DEL>", "</DETAILS>", "</DFN>", "</DIALOG>", "</DIR>", "</DIV>", "</DL>", "</DT>", "</EM>", "</EMBED>", "</FIELDSET>", "</FIGCAPTION>", "</FIGURE>", "</FONT>", "</FOOTER>", "</FORM>", "</FRAME>", "</FRAMESET>", "</H1>", "</HEAD>", "</HEADER>", "</HR>", "</HTML>", "</I>", "</IFRAME>", "</IMG>", "</INPUT>", "</INS>", "</KBD>", "</LABEL>", "</LEGEND>", "</LI>", "</LINK>", "</MAIN>", "</MAP>", "</MARK>", "</MENU>", "</MENUITEM>", "</META>", "</METER>", "</NAV>", "</NOFRAMES>", "</NOSCRIPT>", "</OBJECT>", "</OL>", "</OPTGROUP>", "</OPTION>", "</OUTPUT>", "</P>", "</PARAM>", "</PICTURE>", "</PRE>", "</PROGRESS>", "</Q>", "</RP>", "</RT>", "</RUBY>", "</S>", "</SAMP>", "</SCRIPT>", "</SECTION>", "</SELECT>", "</SMALL>", "</SOURCE>", "</SPAN>", "</STRIKE>", "</STRONG>", "</STYLE>", "</SUB>", "</SUMMARY>", "</SUP>", "</TABLE>", "</TBODY>", "</TD>", "</TEMPLATE>", "</TEXTAREA>", "</TFOOT>", "</TH>", "</THEAD>", "</TIME>", "</TITLE>", "</TR>", "</TRACK>", "</TT>", "</U>", "</UL>", "</VAR>", "</VIDEO>", "</WBR>"]
-start_tags = ["&nbsp;", "<scr'+'ipt>", "<!----!>", "<!DOCTYPE>", "<a>", "<abbr>", "<acronym>", "<address>", "<applet>", "<area>", "<article>", "<aside>", "<audio>", "<b>", "<base>", "<basefont>", "<bdi>", "<bdo>", "<big>", "<blockquote>", "<body>", "<br>", "<button>", "<canvas>", "<caption>", "<center>", "<cite>", "<code>", "<col>", "<colgroup>", "<datalist>", "<dd>", "<del>", "<details>", "<dfn>", "<dialog>", "<dir>", "<div>", "<dl>", "<dt>", "<em>", "<embed>", "<fieldset>", "<figcaption>", "<figure>", "<font>", "<footer>", "<form>", "<frame>", "<frameset>", "<h1>", "<head>", "<header>", "<hr>", "<html>", "<i>", "<iframe>", "<img>", "<input>", "<ins>", "<kbd>", "<label>", "<legend>", "<li>", "<link>", "<main>", "<map>", "<mark>", "<menu>", "<menuitem>", "<meta>", "<meter>", "<nav>", "<noframes>", "<noscript>", "<object>", "<ol>", "<optgroup>", "<option>", "<output>", "<p>", "<param>", "<picture>", "<pre>", "<progress>", "<q>", "<rp>", "<rt>", "<ruby>", "<s>", "<samp>", "<script>", "<section>", "<select>", "<small>", "<source>", "<span>", "<strike>", "<strong>", "<style>", "<sub>", "<summary>", "<sup>", "<table>", "<tbody>", "<td>", "<template>", "<textarea>", "<tfoot>", "<th>", "<thead>", "<time>", "<title>", "<tr>", "<track>", "<tt>", "<u>", "<ul>", "<var>", "<video>",
-              "<wbr>", "<SCR'+'IPT>", "<!-->", "<!DOCTYPE>", "<A>", "<ABBR>", "<ACRONYM>", "<ADDRESS>", "<APPLET>", "<AREA>", "<ARTICLE>", "<ASIDE>", "<AUDIO>", "<B>", "<BASE>", "<BASEFONT>", "<BDI>", "<BDO>", "<BIG>", "<BLOCKQUOTE>", "<BODY>", "<BR>", "<BUTTON>", "<CANVAS>", "<CAPTION>", "<CENTER>", "<CITE>", "<CODE>", "<COL>", "<COLGROUP>", "<DATALIST>", "<DD>", "<DEL>", "<DETAILS>", "<DFN>", "<DIALOG>", "<DIR>", "<DIV>", "<DL>", "<DT>", "<EM>", "<EMBED>", "<FIELDSET>", "<FIGCAPTION>", "<FIGURE>", "<FONT>", "<FOOTER>", "<FORM>", "<FRAME>", "<FRAMESET>", "<H1>", "<HEAD>", "<HEADER>", "<HR>", "<HTML>", "<I>", "<IFRAME>", "<IMG>", "<INPUT>", "<INS>", "<KBD>", "<LABEL>", "<LEGEND>", "<LI>", "<LINK>", "<MAIN>", "<MAP>", "<MARK>", "<MENU>", "<MENUITEM>", "<META>", "<METER>", "<NAV>", "<NOFRAMES>", "<NOSCRIPT>", "<OBJECT>", "<OL>", "<OPTGROUP>", "<OPTION>", "<OUTPUT>", "<P>", "<PARAM>", "<PICTURE>", "<PRE>", "<PROGRESS>", "<Q>", "<RP>", "<RT>", "<RUBY>", "<S>", "<SAMP>", "<SCRIPT>", "<SECTION>", "<SELECT>", "<SMALL>", "<SOURCE>", "<SPAN>", "<STRIKE>", "<STRONG>", "<STYLE>", "<SUB>", "<SUMMARY>", "<SUP>", "<TABLE>", "<TBODY>", "<TD>", "<TEMPLATE>", "<TEXTAREA>", "<TFOOT>", "<TH>", "<THEAD>", "<TIME>", "<TITLE>", "<TR>", "<TRACK>", "<TT>", "<U>", "<UL>", "<VAR>", "<VIDEO>", "<WBR>"]
-
+import os
+import json
 
 
 class Query:
@@ -28,4 +23,66 @@ class Query:
         self.answer2_tokens = ans_2
 
     def get_answer_tokens(self):
-        return (self.answer1_tokens, self.answer2_tokens)
\ No newline at end of file
+        return (self.answer1_tokens, self.answer2_tokens)
+
+class ChunkWriter(object):
+    """
+    Writes the retrieved chunks of a split as json lines, one document per line, as the documents arrive. The byte
+    offset of every line is kept and written to "<path>.index" on close, so ChunkReader can read any document
+    without parsing the others.
+    """
+    fields = ["id", "questions", "answers", "chunks", "order"]
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.ids = []
+        self.offsets = []
+        self.fout = open(output_path, "wb")
+
+    def write(self, record):
+        self.ids.append(record["id"])
+        self.offsets.append(self.fout.tell())
+        self.fout.write((json.dumps(dict((field, record[field]) for field in self.fields)) + "\n").encode("utf-8"))
+
+    def close(self):
+        self.fout.close()
+        with open(self.output_path + ".index", "w") as fout:
+            json.dump({"id": self.ids, "offsets": self.offsets}, fout)
+
+class ChunkReader(object):
+    """
+    Lazy reader of the json lines written by ChunkWriter: reader[i] seeks to and parses document i only, iterating
+    streams the documents in file order. Without an index file the line offsets are found with one scan of the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path + ".index"):
+            with open(path + ".index") as fin:
+                index = json.load(fin)
+            self.ids, self.offsets = index["id"], index["offsets"]
+        else:
+            self.ids = None
+            self.offsets = []
+            with open(path, "rb") as fin:
+                offset = 0
+                for line in fin:
+                    if line.strip():
+                        self.offsets.append(offset)
+                    offset += len(line)
+        self.fin = open(path, "rb")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        self.fin.seek(self.offsets[index])
+        return json.loads(self.fin.readline().decode("utf-8"))
+
+    def __iter__(self):
+        with open(self.path, "rb") as fin:
+            for line in fin:
+                if line.strip():
+                    yield json.loads(line.decode("utf-8"))
+
+    def close(self):
+        self.fin.close()
@@ -0,0 +1,140 @@
+## Runs the same questions through forward/eval of each context model, one question at a time, and through
+## forward_batch/eval_batch as one padded batch, and compares losses and rankings. Contexts, queries and the
+## candidates of every pool have different lengths, so each batched input is padded.
+## Usage: python test_scripts/batched_parity_check.py [num_questions] [num_documents]
+import os
+import sys
+import random
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+from context_model import ContextMRR
+from context_model_sep import ContextMRR_Sep
+from context_model_sep_switched import ContextMRR_Sep_Switched
+
+EMBED_SIZE = 16
+HIDDEN_SIZE = 8
+TOLERANCE = 1e-4
+
+
+class Args(object):
+	embed_size = EMBED_SIZE
+	hidden_size = HIDDEN_SIZE
+	dropout = 0
+
+
+class Vocabulary(object):
+	def get_length(self):
+		return 100
+
+
+class Loader(object):
+	vocab = Vocabulary()
+
+
+def make_questions(num_questions, num_documents, seed=0):
+	rng = np.random.RandomState(seed)
+	documents = []
+	for _ in range(num_documents):
+		candidate_lengths = rng.randint(1, 9, size=rng.randint(2, 7))
+		documents.append({
+			"context": rng.randn(rng.randint(5, 20), EMBED_SIZE).astype(np.float32),
+			"candidates": [rng.randn(length, EMBED_SIZE).astype(np.float32) for length in candidate_lengths],
+		})
+	questions = []
+	for _ in range(num_questions):
+		doc_id = rng.randint(num_documents)
+		questions.append({
+			"doc_id": doc_id,
+			"query": rng.randn(rng.randint(2, 10), EMBED_SIZE).astype(np.float32),
+			"gold": rng.randint(len(documents[doc_id]["candidates"])),
+		})
+	return documents, questions
+
+
+def pad(sequences):
+	lengths = np.array([len(sequence) for sequence in sequences])
+	padded = np.zeros((len(sequences), lengths.max(), EMBED_SIZE), dtype=np.float32)
+	for index, sequence in enumerate(sequences):
+		padded[index, :len(sequence)] = sequence
+	mask = (np.arange(lengths.max())[None, :] < lengths[:, None]).astype(np.float32)
+	return padded, lengths, mask
+
+
+def per_question_inputs(document, question):
+	## same layout as context.py: candidates sorted by decreasing length and padded to the longest of the pool
+	candidates, lengths, masks = pad(document["candidates"])
+	sort = np.argsort(-lengths, kind="mergesort")
+	unsort = np.argsort(sort)
+	query = question["query"]
+	context = document["context"]
+	return (Variable(torch.from_numpy(query)), [len(query)], Variable(torch.ones(len(query))),
+			Variable(torch.from_numpy(context)), [len(context)], Variable(torch.ones(len(context))),
+			Variable(torch.from_numpy(candidates[sort])), lengths[sort], Variable(torch.from_numpy(masks[sort])),
+			Variable(torch.from_numpy(unsort)))
+
+
+def batch_inputs(documents, questions):
+	## same layout as context.make_batch_tensors: one context and one candidate pool per distinct document
+	doc_ids = sorted(set(question["doc_id"] for question in questions))
+	document_position = dict((doc_id, position) for position, doc_id in enumerate(doc_ids))
+	queries, query_lengths, query_mask = pad([question["query"] for question in questions])
+	contexts, context_lengths, context_mask = pad([documents[doc_id]["context"] for doc_id in doc_ids])
+	pools = [documents[doc_id]["candidates"] for doc_id in doc_ids]
+	pool_offsets = np.cumsum([0] + [len(pool) for pool in pools])
+	candidates, candidate_lengths, candidate_mask = pad([candidate for pool in pools for candidate in pool])
+	pair_candidate_index, pair_question_index, pair_position = [], [], []
+	for index, question in enumerate(questions):
+		position = document_position[question["doc_id"]]
+		num_pool = pool_offsets[position + 1] - pool_offsets[position]
+		pair_candidate_index.extend(range(pool_offsets[position], pool_offsets[position + 1]))
+		pair_question_index.extend([index] * num_pool)
+		pair_position.extend(range(num_pool))
+	long_variable = lambda values: Variable(torch.LongTensor(list(values)))
+	return (Variable(torch.from_numpy(queries)), query_lengths, Variable(torch.from_numpy(query_mask)),
+			Variable(torch.from_numpy(contexts)), context_lengths, Variable(torch.from_numpy(context_mask)),
+			long_variable(document_position[question["doc_id"]] for question in questions),
+			Variable(torch.from_numpy(candidates)), candidate_lengths, Variable(torch.from_numpy(candidate_mask)),
+			long_variable(pair_candidate_index), long_variable(pair_question_index), long_variable(pair_position),
+			max(len(pool) for pool in pools))
+
+
+def check(model_class, documents, questions):
+	torch.manual_seed(0)
+	model = model_class(Args(), Loader())
+	model.train(False)
+
+	losses = []
+	rankings = []
+	for question in questions:
+		inputs = per_question_inputs(documents[question["doc_id"]], question)
+		gold = Variable(torch.LongTensor([question["gold"]]))
+		loss, _ = model.forward(*(inputs + (gold, None)))
+		losses.append(float(loss.data.view(-1)[0]))
+		rankings.append(model.eval(*inputs).data.view(-1).numpy())
+
+	inputs = batch_inputs(documents, questions)
+	gold = Variable(torch.LongTensor([question["gold"] for question in questions]))
+	batch_loss, _ = model.forward_batch(*(inputs + (gold,)))
+	batch_rankings = model.eval_batch(*inputs).data.numpy()
+
+	loss_error = abs(float(batch_loss.data.view(-1)[0]) - np.mean(losses))
+	same_rankings = all((batch_rankings[index][:len(ranking)] == ranking).all() for index, ranking in enumerate(rankings))
+	passed = loss_error < TOLERANCE and same_rankings
+	print("{0:24s} loss error: {1:.2e}  identical rankings: {2}  {3}".format(
+		model_class.__name__, loss_error, same_rankings, "ok" if passed else "FAILED"))
+	return passed
+
+
+def main(num_questions, num_documents):
+	random.seed(0)
+	documents, questions = make_questions(num_questions, num_documents)
+	results = [check(model_class, documents, questions)
+			   for model_class in (ContextMRR, ContextMRR_Sep, ContextMRR_Sep_Switched)]
+	sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 12, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
@@ -0,0 +1,89 @@
+## Batch-build time per 1k questions: the list comprehension masks and pad_seq/pad_seq_elmo padding that
+## create_single_batch(_elmo) used before, against the numpy versions in dataloaders/batching.py.
+## Usage: python test_scripts/batching_benchmark.py [num_questions] [batch_size]
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataloaders"))
+from batching import length_mask, pad_sequences, pad_embeddings
+
+EMBED_SIZE = 1024
+
+
+def legacy_mask(lengths, max_length):
+	return np.array([[int(x < lengths[i]) for x in range(max_length)] for i in range(len(lengths))])
+
+
+def legacy_pad_seq(seq, max_len, pad_token=0):
+	seq += [pad_token for i in range(max_len - len(seq))]
+	return seq
+
+
+def legacy_pad_seq_elmo(seq, max_len, size=EMBED_SIZE):
+	diff = max_len - len(seq)
+	if diff == 0:
+		return seq
+	return np.concatenate((seq, np.zeros((diff, size))), axis=0)
+
+
+def make_questions(num_questions, seed=0):
+	rng = np.random.RandomState(seed)
+	questions = []
+	for _ in range(num_questions):
+		query_length = rng.randint(5, 25)
+		candidate_lengths = rng.randint(1, 30, size=30)
+		questions.append({
+			"tokens": list(rng.randint(1, 50000, size=query_length)),
+			"embed": rng.randn(query_length, EMBED_SIZE).astype(np.float32),
+			"candidates": [list(rng.randint(1, 50000, size=length)) for length in candidate_lengths],
+		})
+	return questions
+
+
+def build_legacy(batch):
+	query_lengths = [len(question["tokens"]) for question in batch]
+	max_query_length = max(query_lengths)
+	query_mask = legacy_mask(query_lengths, max_query_length)
+	queries = np.array([legacy_pad_seq(list(question["tokens"]), max_query_length) for question in batch])
+	queries_embed = np.array([legacy_pad_seq_elmo(question["embed"], max_query_length) for question in batch])
+	candidates = []
+	for question in batch:
+		lengths = [len(answer) for answer in question["candidates"]]
+		candidates.append((np.array([legacy_pad_seq(list(answer), max(lengths)) for answer in question["candidates"]]),
+						   legacy_mask(lengths, max(lengths))))
+	return query_mask, queries, queries_embed, candidates
+
+
+def build_vectorized(batch):
+	query_lengths = [len(question["tokens"]) for question in batch]
+	query_mask = length_mask(query_lengths)
+	queries = pad_sequences([question["tokens"] for question in batch])
+	queries_embed = pad_embeddings([question["embed"] for question in batch])
+	candidates = []
+	for question in batch:
+		lengths = [len(answer) for answer in question["candidates"]]
+		candidates.append((pad_sequences(question["candidates"]), length_mask(lengths)))
+	return query_mask, queries, queries_embed, candidates
+
+
+def main(num_questions, batch_size):
+	questions = make_questions(num_questions)
+	batches = [questions[i:i + batch_size] for i in range(0, num_questions, batch_size)]
+
+	legacy, vectorized = build_legacy(batches[0]), build_vectorized(batches[0])
+	same = all(np.array_equal(a, b) for a, b in zip(legacy[:3], vectorized[:3])) and \
+		all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1]) for a, b in zip(legacy[3], vectorized[3]))
+	print("{0} questions, batches of {1}, identical outputs: {2}".format(num_questions, batch_size, same))
+
+	for name, build in [("legacy", build_legacy), ("vectorized", build_vectorized)]:
+		start = time.time()
+		for batch in batches:
+			build(batch)
+		elapsed = time.time() - start
+		print("{0:>10}: {1:8.1f} ms per 1k questions".format(name, 1000.0 * elapsed * 1000.0 / num_questions))
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
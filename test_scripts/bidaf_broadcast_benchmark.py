@@ -0,0 +1,89 @@
+## Compares BiDAF.forward on a repeated context with BiDAF.forward_broadcast on the shared one, as used by the
+## second attention layer of the context models (every candidate of a question attends over the same context).
+## Usage: python test_scripts/bidaf_broadcast_benchmark.py [context_length] [num_candidates] [candidate_length]
+import os
+import sys
+import time
+import resource
+import subprocess
+import torch
+from torch.autograd import Variable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+from bidaf import BiDAF
+
+HIDDEN_SIZE = 100
+REPEATS = 5
+
+
+def make_inputs(context_length, num_candidates, candidate_length):
+	torch.manual_seed(0)
+	layer = BiDAF(2 * HIDDEN_SIZE)
+	context = Variable(torch.randn(1, context_length, 2 * HIDDEN_SIZE), volatile=True)
+	context_mask = Variable(torch.ones(1, 1, context_length), volatile=True)
+	candidates = Variable(torch.randn(num_candidates, candidate_length, 2 * HIDDEN_SIZE), volatile=True)
+	candidate_mask = torch.ones(num_candidates, candidate_length)
+	## candidates are sorted by length and padded, as in the models
+	for i in range(num_candidates):
+		candidate_mask[i, max(1, candidate_length - i):] = 0
+	candidate_mask = Variable(candidate_mask, volatile=True)
+	return layer, context, context_mask, candidates, candidate_mask
+
+
+def run(layer, context, context_mask, candidates, candidate_mask, mode):
+	if mode == "repeat":
+		return layer(context.repeat(candidates.size(0), 1, 1), candidates, context_mask, candidate_mask)
+	return layer.forward_broadcast(context, candidates, context_mask, candidate_mask)
+
+
+def peak_memory(mode, sizes):
+	## each mode runs in a fresh process so the peak resident size is not shared between them
+	command = [sys.executable, os.path.abspath(__file__), "--peak", mode] + [str(s) for s in sizes]
+	return float(subprocess.check_output(command).decode("utf-8").strip())
+
+
+def main(sizes):
+	## measured first: linux keeps the high-water mark of the parent in the child's ru_maxrss
+	if not torch.cuda.is_available():
+		memory = dict((mode, peak_memory(mode, sizes)) for mode in ["repeat", "broadcast"])
+	layer, context, context_mask, candidates, candidate_mask = make_inputs(*sizes)
+	if torch.cuda.is_available():
+		layer = layer.cuda()
+		context, context_mask, candidates, candidate_mask = [v.cuda() for v in (context, context_mask, candidates, candidate_mask)]
+
+	G, c2q, q2c = run(layer, context, context_mask, candidates, candidate_mask, "repeat")
+	G_b, c2q_b, q2c_b = run(layer, context, context_mask, candidates, candidate_mask, "broadcast")
+	print("context length {0}, {1} candidates of length {2}".format(*sizes))
+	print("max abs difference: G {0:.3e}, c2q {1:.3e}, q2c {2:.3e}".format(
+		(G - G_b).abs().max().item(), (c2q - c2q_b).abs().max().item(), (q2c - q2c_b).abs().max().item()))
+	## the candidate scores are a function of G, so an identical ordering of G rows is what decides the ranking
+	same_order = torch.equal(torch.sort(G.sum(-1).sum(-1))[1], torch.sort(G_b.sum(-1).sum(-1))[1])
+	print("identical candidate ordering: {0}".format(same_order))
+	del G, c2q, q2c, G_b, c2q_b, q2c_b
+
+	for mode in ["repeat", "broadcast"]:
+		if torch.cuda.is_available():
+			torch.cuda.synchronize()
+			torch.cuda.reset_max_memory_allocated()
+		start = time.time()
+		for _ in range(REPEATS):
+			run(layer, context, context_mask, candidates, candidate_mask, mode)
+		if torch.cuda.is_available():
+			torch.cuda.synchronize()
+		elapsed = time.time() - start
+		if torch.cuda.is_available():
+			peak = torch.cuda.max_memory_allocated() / 1024.0 ** 2
+		else:
+			peak = memory[mode]
+		print("{0:>9}: {1:8.1f} ms per call, peak memory {2:8.1f} MB".format(mode, 1000.0 * elapsed / REPEATS, peak))
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--peak":
+		inputs = make_inputs(*[int(s) for s in sys.argv[3:6]])
+		baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		run(*(inputs + (sys.argv[2],)))
+		## ru_maxrss is in kilobytes on linux
+		print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024.0)
+	else:
+		main([int(s) for s in sys.argv[1:4]] if len(sys.argv) > 3 else [1000, 20, 10])
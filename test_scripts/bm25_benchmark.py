@@ -0,0 +1,86 @@
+## Scores the questions of a synthetic book against its chunks with the per-query loop of gensim's BM25 (<= 3.6, the
+## version retrieval/ir_chunker.py used, transcribed below) and with the sparse retrieval/bm25.py, and compares rankings.
+## Usage: python test_scripts/bm25_benchmark.py [num_chunks] [num_questions] [top_k]
+import os
+import sys
+import math
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "retrieval"))
+from bm25 import BM25
+
+PARAM_K1 = 1.5
+PARAM_B = 0.75
+EPSILON = 0.25
+
+
+class LegacyBM25(object):
+	def __init__(self, corpus):
+		self.corpus_size = len(corpus)
+		self.avgdl = sum(float(len(x)) for x in corpus) / self.corpus_size
+		self.corpus = corpus
+		self.f = []
+		self.df = {}
+		self.idf = {}
+		for document in self.corpus:
+			frequencies = {}
+			for word in document:
+				frequencies[word] = frequencies.get(word, 0) + 1
+			self.f.append(frequencies)
+			for word in frequencies:
+				self.df[word] = self.df.get(word, 0) + 1
+		for word, freq in self.df.items():
+			self.idf[word] = math.log(self.corpus_size - freq + 0.5) - math.log(freq + 0.5)
+
+	def get_score(self, document, index, average_idf):
+		score = 0
+		for word in document:
+			if word not in self.f[index]:
+				continue
+			idf = self.idf[word] if self.idf[word] >= 0 else EPSILON * average_idf
+			score += (idf * self.f[index][word] * (PARAM_K1 + 1)
+					  / (self.f[index][word] + PARAM_K1 * (1 - PARAM_B + PARAM_B * len(self.corpus[index]) / self.avgdl)))
+		return score
+
+	def get_scores(self, document, average_idf):
+		return [self.get_score(document, index, average_idf) for index in range(self.corpus_size)]
+
+
+def make_book(num_chunks, num_questions, seed=0):
+	rng = np.random.RandomState(seed)
+	## zipf distributed words, so common words get a negative idf as in real text
+	words = ["w{0}".format(i) for i in range(20000)]
+	draw = lambda size: [words[min(i, len(words)) - 1] for i in rng.zipf(1.3, size=size)]
+	chunks = [draw(rng.randint(120, 200)) for _ in range(num_chunks)]
+	questions = [draw(rng.randint(5, 20)) for _ in range(num_questions)]
+	return chunks, questions
+
+
+def main(num_chunks, num_questions, top_k):
+	chunks, questions = make_book(num_chunks, num_questions)
+
+	start = time.time()
+	legacy = LegacyBM25(chunks)
+	average_idf = sum(map(lambda k: float(legacy.idf[k]), legacy.idf.keys())) / len(legacy.idf.keys())
+	legacy_scores = np.array([legacy.get_scores(question, average_idf) for question in questions])
+	legacy_top = [np.argsort(scores)[-top_k:][::-1] for scores in legacy_scores]
+	legacy_time = time.time() - start
+
+	start = time.time()
+	bm25 = BM25(chunks)
+	top = bm25.top_k(questions, top_k)
+	sparse_time = time.time() - start
+
+	scores = bm25.get_scores(questions)
+	print("{0} chunks, {1} questions, top {2}".format(num_chunks, num_questions, top_k))
+	print("max abs score difference: {0:.3e}".format(np.abs(scores - legacy_scores).max()))
+	## equal scores may be ordered either way, so the rankings are compared by the scores they select
+	same = all(np.allclose(legacy_scores[i][legacy_top[i]], legacy_scores[i][top[i]]) for i in range(num_questions))
+	print("identical rankings (up to ties): {0}".format(same))
+	print("{0:>7}: {1:8.1f} ms".format("gensim", 1000.0 * legacy_time))
+	print("{0:>7}: {1:8.1f} ms".format("sparse", 1000.0 * sparse_time))
+
+
+if __name__ == "__main__":
+	main(*([int(s) for s in sys.argv[1:4]] if len(sys.argv) > 3 else [2000, 300, 20]))
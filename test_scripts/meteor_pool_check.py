@@ -0,0 +1,48 @@
+## Scores the same pairs with MeteorScorer (one process, one SCORE/EVAL round trip per hypothesis) and with
+## MeteorScorerPool, against test_scripts/meteor_stub.py or a real METEOR command, and compares scores and time.
+## Usage: python test_scripts/meteor_pool_check.py [processes] [num_pairs] [command]
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataloaders"))
+from meteor import MeteorScorer, MeteorScorerPool
+
+STUB = "{0} {1} 0.0005".format(sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "meteor_stub.py"))
+WORDS = ["the", "a", "man", "woman", "house", "ship", "captain", "goes", "to", "sea", "and", "finds", "his", "her"]
+
+
+def make_batch(num_pairs, hypotheses_per_reference=10, seed=0):
+	rng = random.Random(seed)
+	sentence = lambda: [rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+	return [(sentence(), [sentence() for _ in range(hypotheses_per_reference)])
+			for _ in range(num_pairs // hypotheses_per_reference)]
+
+
+def main(processes, num_pairs, command):
+	batch = make_batch(num_pairs)
+
+	scorer = MeteorScorer(None, command=command)
+	start = time.time()
+	serial = []
+	for reference, hypotheses in batch:
+		scorer.set_reference(reference)
+		serial.append(scorer._reference.score_matrix(hypotheses))
+	serial_time = time.time() - start
+	scorer.terminate_process()
+
+	pool = MeteorScorerPool(None, processes=processes, command=command)
+	start = time.time()
+	pooled = pool.score_batch(batch)
+	pool_time = time.time() - start
+	pool.terminate_processes()
+
+	print("{0} pairs, identical scores: {1}".format(sum(len(h) for _, h in batch), serial == pooled))
+	print("    serial: {0:6.2f} s".format(serial_time))
+	print("pool of {0}: {1:6.2f} s".format(processes, pool_time))
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 4, int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+		 sys.argv[3] if len(sys.argv) > 3 else STUB)
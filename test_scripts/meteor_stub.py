@@ -0,0 +1,35 @@
+## Stand-in for "java -jar meteor-*.jar - - -l en -stdio": speaks the same SCORE/EVAL line protocol on stdin/stdout,
+## with a unigram F-mean instead of the real METEOR alignment, so the scorer wrappers can be checked without Java.
+## Usage: python test_scripts/meteor_stub.py [seconds of latency per SCORE line]
+import sys
+import time
+from collections import Counter
+
+
+def main(delay):
+	while True:
+		line = sys.stdin.readline()
+		if line == "":
+			return
+		fields = [field.strip() for field in line.split("|||")]
+		if fields[0] == "SCORE" and len(fields) == 3:
+			if delay > 0:
+				time.sleep(delay)
+			reference, hypothesis = fields[1].split(), fields[2].split()
+			matches = sum((Counter(reference) & Counter(hypothesis)).values())
+			sys.stdout.write("{0} {1} {2}\n".format(len(hypothesis), len(reference), matches))
+		elif fields[0] == "EVAL" and len(fields) == 2:
+			hypothesis_length, reference_length, matches = [float(value) for value in fields[1].split()]
+			precision = matches / hypothesis_length if hypothesis_length > 0 else 0.0
+			recall = matches / reference_length if reference_length > 0 else 0.0
+			score = 10 * precision * recall / (recall + 9 * precision) if matches > 0 else 0.0
+			sys.stdout.write("{0}\n".format(score))
+		else:
+			sys.stderr.write("Unrecognized command: {0}\n".format(line.strip()))
+			sys.stderr.flush()
+			return
+		sys.stdout.flush()
+
+
+if __name__ == "__main__":
+	main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.0)
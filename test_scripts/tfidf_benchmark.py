@@ -0,0 +1,76 @@
+## Retrieves the top chunks of every question of synthetic documents with the per-document CountVectorizer +
+## TfidfTransformer + linear_kernel().argsort() that ir_chunker.py and dataloader.py used, and with retrieval/tfidf.py,
+## refitted per document and with one corpus level index.
+## Usage: python test_scripts/tfidf_benchmark.py [num_documents] [num_chunks] [num_questions] [top_k]
+import os
+import sys
+import time
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.metrics.pairwise import linear_kernel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "retrieval"))
+from tfidf import TfidfIndex
+
+STOP_WORDS = ["w{0}".format(i) for i in range(1, 40)]
+
+
+def preprocessor(text):
+	return text
+
+
+def make_documents(num_documents, num_chunks, num_questions, seed=0):
+	rng = np.random.RandomState(seed)
+	words = ["w{0}".format(i) for i in range(20000)]
+	draw = lambda size: " ".join(words[min(i, len(words)) - 1] for i in rng.zipf(1.3, size=size))
+	return [([draw(rng.randint(120, 200)) for _ in range(num_chunks)], [draw(rng.randint(5, 20)) for _ in range(num_questions)])
+			for _ in range(num_documents)]
+
+
+def legacy_top_k(chunks, questions, k):
+	vectorizer = CountVectorizer(preprocessor=preprocessor, stop_words=STOP_WORDS, ngram_range=(1, 2))
+	transformer = TfidfTransformer(sublinear_tf=True)
+	tfidf = transformer.fit_transform(vectorizer.fit_transform(chunks + questions))
+	scores = linear_kernel(tfidf[len(chunks):], tfidf[0:len(chunks)])
+	return scores, scores.argsort()[:, -k:][:, ::-1]
+
+
+def main(num_documents, num_chunks, num_questions, top_k):
+	documents = make_documents(num_documents, num_chunks, num_questions)
+	index = TfidfIndex(preprocessor=preprocessor, stop_words=STOP_WORDS, ngram_range=(1, 2))
+
+	start = time.time()
+	legacy = [legacy_top_k(chunks, questions, top_k) for chunks, questions in documents]
+	legacy_time = time.time() - start
+
+	start = time.time()
+	refitted = [index.top_k(questions, chunks, top_k, fit=True) for chunks, questions in documents]
+	refitted_time = time.time() - start
+
+	same = True
+	difference = 0.0
+	for (chunks, questions), (scores, legacy_ids), ids in zip(documents, legacy, refitted):
+		difference = max(difference, np.abs(index.score(questions, chunks, fit=True) - scores).max())
+		## equal scores may be ordered either way, so the rankings are compared by the scores they select
+		rows = np.arange(len(questions))[:, None]
+		same = same and np.allclose(scores[rows, legacy_ids], scores[rows, ids])
+
+	index.reset()
+	for chunks, _ in documents:
+		index.partial_fit(chunks)
+	start = time.time()
+	for chunks, questions in documents:
+		index.top_k(questions, chunks, top_k)
+	corpus_time = time.time() - start
+
+	print("{0} documents of {1} chunks, {2} questions each, top {3}".format(num_documents, num_chunks, num_questions, top_k))
+	print("max abs score difference: {0:.3e}".format(difference))
+	print("identical rankings (up to ties): {0}".format(same))
+	print("{0:>16}: {1:8.1f} ms per document".format("sklearn", 1000.0 * legacy_time / num_documents))
+	print("{0:>16}: {1:8.1f} ms per document".format("refitted index", 1000.0 * refitted_time / num_documents))
+	print("{0:>16}: {1:8.1f} ms per document".format("corpus index", 1000.0 * corpus_time / num_documents))
+
+
+if __name__ == "__main__":
+	main(*([int(s) for s in sys.argv[1:5]] if len(sys.argv) > 4 else [10, 1000, 100, 20]))